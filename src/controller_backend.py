@@ -1,52 +1,166 @@
 import multiprocessing
 from pathlib import Path
 import queue
-from threading import Thread
-from typing import Optional
+from threading import Lock, Semaphore, Thread
+from typing import Dict, Optional
 import datetime
 import time
 import os
 
+from utility import dip
 from utility.arbiter import Arbiter
+from utility.config import get_parallel_videos, get_inference_max_batch, get_inference_max_delay, \
+    get_examine_workers, get_examine_threads, get_warmup_video_types, get_live_streams
+from utility.inference_server import InferenceServer
+from utility.model_registry import registry, models_of
 from utility.serializer import ResultSerializer
 from viewmodel_backend import ViewModel
 
 
-# 视频检测线程
-def _examine_videos(videos_queue, summary_queue, progress_queue):
+class _VideoProgress:
+    '''
+    tags the progress reported by the Arbiter with the video, so the progress of the
+    videos examined at the same time can be told apart
+    '''
+    def __init__(self, progress_queue, video_path) -> None:
+        self._progress_queue = progress_queue
+        self._video_path = video_path
+
+    def put(self, progress) -> None:
+        i, amount = progress
+        self._progress_queue.put((self._video_path, i, amount))
+
+
+def result_dirs(dest_dir, video_path, video_type) -> Dict[str, Path]:
+    '''
+    the result directory of each sub type of the video: dest_dir/<name> for 'tv' or
+    'fog', dest_dir/tv/<name> and dest_dir/fog/<name> for 'tv+fog'
+    '''
+    name = Path(video_path.rstrip('/\\')).stem
+    if video_type == 'tv+fog':
+        # 同一视频的两类结果分别保存到 tv 与 fog 子目录
+        return {sub_type: Path(dest_dir) / sub_type / name for sub_type in ('tv', 'fog')}
+
+    return {video_type: Path(dest_dir) / name}
+
+
+# 检测单个视频
+def _examine_video(video_path, fps, details, dest_dir, video_type, use_detectors, live, summary_queue, progress_queue):
+    output_dirs = result_dirs(dest_dir, video_path, video_type)
+    for output_dir in output_dirs.values():
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    def save(sub_type, section_results):
+        # 结果保存在 output_dirs[sub_type]，即 <sub_dest_dir>/<name>
+        sub_dest_dir = str(output_dirs[sub_type].parent)
+        summary_queue.put((False, video_path, fps, details, sub_dest_dir, sub_type, list(section_results)))
+
+    # 直播每完成一道工序就保存一次已有的结果
+    on_section = save if live else None
+
+    # 各流水线的调试结果与检测结果保存在同一目录
+    arbiter = Arbiter(0.8, {sub_type: str(output_dir) for sub_type, output_dir in output_dirs.items()},
+                      use_detectors)
+    results = arbiter.arbitrate(video_path, progress_queue=_VideoProgress(progress_queue, video_path),
+                                video_type=video_type, live=live,
+                                on_section=on_section)
+
+    if video_type == 'tv+fog':
+        for sub_type, sub_results in zip(('tv', 'fog'), results):
+            save(sub_type, sub_results)
+    else:
+        save(video_type, results)
+
+    del arbiter
+    del results
+
+
+# 视频检测进程，parallel_videos 大于 1 时同时检测多个视频，各模型的请求由推理服务合并成批
+def _examine_videos(videos_queue, summary_queue, progress_queue, threads=0, ready_event=None, parallel_videos=0):
+    # 多个检测进程时限制每个进程的计算线程数，避免相互争抢 CPU
+    if threads > 0:
+        import cv2
+        import torch
+
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+
+    # 在取第一个视频前并行加载并预热模型
+    registry.warm_up(models_of(get_warmup_video_types()))
+    print(f'models: {registry.report()}')
+    if ready_event is not None:
+        ready_event.set()
+
+    # parallel_videos 为 0 时使用配置
+    parallel_videos = parallel_videos or get_parallel_videos()
+
+    server = None
+    if parallel_videos > 1:
+        server = InferenceServer(get_inference_max_batch(), get_inference_max_delay())
+        dip.set_inference_server(server)
+
+    slots = Semaphore(parallel_videos)
+    workers = []
+
+    def _run(*args):
+        try:
+            _examine_video(*args)
+        except Exception:
+            # 检测失败也发送结束标记，使直播释放名额，并以空结果通知保存线程不再等待该视频的结果
+            video_path, video_type = args[0], args[4]
+            progress_queue.put((video_path, -1, -1))
+            summary_queue.put((False, video_path, None, None, None, video_type, None))
+            raise
+        finally:
+            slots.release()
+
     while True:
-        finished, video_path, fps, details, dest_dir, video_type, use_detectors = videos_queue.get()
+        # 有空闲时才从共享队列中取视频，使排队的视频按顺序分给先空闲的进程
+        slots.acquire()
+        finished, video_path, fps, details, dest_dir, video_type, use_detectors, live = videos_queue.get()
 
         if finished:
-            summary_queue.put((True, None, None, None, None, None, None))
-            break
+            for worker in workers:
+                worker.join()
 
-        name = Path(video_path).stem
-        output_dir = Path(dest_dir) / name
-        output_dir.mkdir(exist_ok=True)
+            if server is not None:
+                print(f'inference server: {server.report()}')
+                dip.set_inference_server(None)
+                server.close()
 
-        arbiter = Arbiter(0.8, str(output_dir), use_detectors)
-        results = arbiter.arbitrate(video_path, progress_queue=progress_queue, video_type=video_type)
+            summary_queue.put((True, None, None, None, None, None, None))
+            break
 
-        summary_queue.put((finished, video_path, fps, details, dest_dir, video_type, results))
+        workers = [worker for worker in workers if worker.is_alive()]
 
-        del arbiter
-        del results
+        worker = Thread(target=_run, args=(video_path, fps, details, dest_dir, video_type, use_detectors, live,
+                                           summary_queue, progress_queue))
+        worker.start()
+        workers.append(worker)
 
 
 # 保存检测结果线程
-def _save_results(summary_queue, controller):
+def _save_results(summary_queue, controller, workers):
     while True:
         finished, video_path, fps, details, dest_dir, video_type, results = summary_queue.get()
 
+        # 每个检测进程结束时各发送一次
         if finished:
-            break
+            workers -= 1
+            if workers == 0:
+                break
+            continue
+
+        # 检测失败
+        if results is None:
+            controller.examine_failed(video_path, video_type)
+            continue
 
         executor, workstation, date_time, memo = details
 
-        name = Path(video_path).stem
+        name = Path(video_path.rstrip('/\\')).stem
         save_dir = Path(dest_dir) / name
-        save_dir.mkdir(exist_ok=True)
+        save_dir.mkdir(parents=True, exist_ok=True)
 
         dic = {
             'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
@@ -61,18 +175,18 @@ def _save_results(summary_queue, controller):
         serializer = ResultSerializer()
         serializer.serialize(save_dir, video_path, fps, executor, workstation, date_time, memo, video_type, results)
         time.sleep(2)
-        controller.set_processing(False)
+        controller.summary_saved(video_path)
 
 
 # 实时监测线程数量，当前无运行线程时结束
 def _progress_notifier(progress_queue, controller):
     while True:
-        i, amount = progress_queue.get()
+        video_path, i, amount = progress_queue.get()
 
-        if i is None:
+        if video_path is None:
             break
 
-        controller.notify_progress(i, amount)
+        controller.notify_progress(video_path, i, amount)
 
 
 # 添加视频线程
@@ -95,12 +209,35 @@ class MainController:
         self.progress_queue = multiprocessing.Queue()
         self.video_path_queue = queue.Queue()
 
-        self.examine_process = multiprocessing.Process(
-            target=_examine_videos, args=(self.videos_queue, self.summary_queue, self.progress_queue)
-        )
+        # 检测进程池，各进程从同一队列中取视频，模型在进程内加载一次后常驻
+        workers = get_examine_workers()
+        threads = get_examine_threads()
+        if threads == 0 and workers > 1:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        # 各检测进程预热完模型后设置
+        self.ready_events = [multiprocessing.Event() for _ in range(workers)]
+        self.examine_processes = [
+            multiprocessing.Process(
+                target=_examine_videos,
+                args=(self.videos_queue, self.summary_queue, self.progress_queue, threads, ready_event)
+            )
+            for ready_event in self.ready_events
+        ]
+
+        # 直播在单独的检测进程中进行，不占用录像的检测名额
+        self.live_streams = get_live_streams()
+        self.live_queue = multiprocessing.Queue()
+        self.live_processes = [
+            multiprocessing.Process(
+                target=_examine_videos,
+                args=(self.live_queue, self.summary_queue, self.progress_queue, threads, None, self.live_streams)
+            )
+        ] if self.live_streams > 0 else []
+        # 正在检测的直播
+        self._live_sources = set()
 
         self.io_thread = Thread(
-            target=_save_results, args=(self.summary_queue, self)
+            target=_save_results, args=(self.summary_queue, self, workers + len(self.live_processes))
         )
 
         self.progress_thread = Thread(
@@ -112,13 +249,19 @@ class MainController:
         )
 
         self.add_video_thread.start()
-        self.examine_process.start()
+        for process in self.examine_processes + self.live_processes:
+            process.start()
         self.io_thread.start()
 
         self.viewmodel: Optional[ViewModel] = None
 
         self.is_processing = False
 
+        # 各视频的检测进度 (i, amount) 与尚未保存的结果数
+        self._lock = Lock()
+        self.progress = {}
+        self._pending_summaries = {}
+
     def set_viewmodel(self, viewmodel):
         self.viewmodel = viewmodel
         self.progress_thread.start()
@@ -148,18 +291,85 @@ class MainController:
         handeler = self.viewmodel.get(idx)
         handeler.set_details(details)
 
-    def notify_progress(self, i, amount):
+    def notify_progress(self, video_path, i, amount):
+        with self._lock:
+            # 只记录正在检测的视频，结果保存后（或失败后）到达的进度不再记录
+            if video_path in self._pending_summaries:
+                self.progress[video_path] = (i, amount)
+            # 直播结束（断流超时或出错）后释放名额
+            if i == -1:
+                self._live_sources.discard(video_path)
+
         if self.viewmodel is not None:
             self.viewmodel.set_progress(i, amount, self.videos_queue.qsize())
 
+    def is_ready(self):
+        '''
+        whether every examine process has warmed up its models
+        '''
+        return all(ready_event.is_set() for ready_event in self.ready_events)
+
+    def get_progress(self):
+        '''
+        the progress of every video being examined in percent, a video is removed
+        once its results are saved or its examination fails
+        '''
+        with self._lock:
+            return {
+                video_path: 100.0 if i == -1 else round(min(100 * i / amount, 100.0), 2) if amount else 0.0
+                for video_path, (i, amount) in self.progress.items()
+            }
+
+    def _summaries_done(self, video_path, count):
+        with self._lock:
+            if video_path in self._pending_summaries:
+                self._pending_summaries[video_path] -= count
+                if self._pending_summaries[video_path] <= 0:
+                    del self._pending_summaries[video_path]
+                    self.progress.pop(video_path, None)
+
+            processing = len(self._pending_summaries) > 0
+
+        self.set_processing(processing)
+
+    def summary_saved(self, video_path):
+        self._summaries_done(video_path, 1)
+
+    def examine_failed(self, video_path, video_type):
+        '''
+        the examination of the video raised, none of its summaries will be saved
+        '''
+        print(f'{video_path}: 检测失败，未保存结果')
+        self._summaries_done(video_path, 2 if video_type == 'tv+fog' else 1)
+
     def examine_video(self, idx, dest_dir, video_type):
         handler = self.viewmodel.get(idx)
         handler.set_examined(True)
+        with self._lock:
+            # tv+fog 的视频分别保存两份结果
+            self._pending_summaries[handler.video_path()] = \
+                self._pending_summaries.get(handler.video_path(), 0) + (2 if video_type == 'tv+fog' else 1)
+            self.progress[handler.video_path()] = (0, 0)
         # 在视频检测线程中添加新视频
         self.videos_queue.put(
-            (False, handler.video_path(), handler.fps(), handler.details(), dest_dir, video_type, self.use_detectors))
+            (False, handler.video_path(), handler.fps(), handler.details(), dest_dir, video_type, self.use_detectors,
+             False))
         self.set_processing(True)
 
+    def examine_stream(self, source, dest_dir, video_type, details) -> bool:
+        '''
+        examines a stream or a directory of recorded segments while it is being recorded,
+        the summary is saved again every time a section is closed. returns False if
+        live_streams streams are being examined (or the source is), see get_live_streams()
+        '''
+        with self._lock:
+            if len(self._live_sources) >= self.live_streams or source in self._live_sources:
+                return False
+            self._live_sources.add(source)
+
+        self.live_queue.put((False, source, 0.0, details, dest_dir, video_type, self.use_detectors, True))
+        return True
+
     def set_processing(self, processing):
         self.is_processing = processing
 
@@ -169,13 +379,19 @@ class MainController:
 
     def exit(self, kill_all=False):
         if kill_all:
-            self.examine_process.terminate()
-            self.summary_queue.put((True, None, None, None, None, None, None))
+            for process in self.examine_processes + self.live_processes:
+                process.terminate()
+                self.summary_queue.put((True, None, None, None, None, None, None))
         else:
-            self.videos_queue.put((True, None, None, None, None, None, None))
-            self.examine_process.join()
-
-        self.progress_queue.put((None, None))
+            # 每个检测进程各取一个结束标记，直播进程等待直播断流结束
+            for _ in self.examine_processes:
+                self.videos_queue.put((True, None, None, None, None, None, None, None))
+            for _ in self.live_processes:
+                self.live_queue.put((True, None, None, None, None, None, None, None))
+            for process in self.examine_processes + self.live_processes:
+                process.join()
+
+        self.progress_queue.put((None, None, None))
         self.video_path_queue.put(None)
 
         self.io_thread.join()
@@ -6,16 +6,18 @@ import torch
 import torch.nn.functional as F
 from pathlib import Path
 import torch.backends.cudnn as cudnn
-import torchvision.transforms as transforms
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 import utility.config
-from utility.dip import OpenCV_to_PIL, tensor_to_OpenCV
+from utility.dip import tensor_to_OpenCV
 from .context_seunet import Context_SEUNet
-from ..helpers import select_device
+from ..helpers import select_device, mask_statistics
+from ..preprocess import Normalizer
+from ..onnx_backend import select_backend
+from ..torchscript_backend import load_compiled_model
 
 model = None
 device = select_device()
@@ -23,11 +25,8 @@ half = None
 weight_name = ''
 
 
-_compose = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.transforms.Normalize(mean=[0.35740975, 0.35927135, 0.36786193],
-                                    std=[0.169528, 0.16850878, 0.17494833])
-])
+_normalize = Normalizer(mean=[0.35740975, 0.35927135, 0.36786193],
+                        std=[0.169528, 0.16850878, 0.17494833])
 
 
 @torch.no_grad()
@@ -42,6 +41,14 @@ def load_model():
     weights = str(ROOT / 'weights' / f'{weight_name}.pth')
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # 已编译的模型无需重建网络与加载权重
+    compiled_model = load_compiled_model('broken', weights, device)
+    if compiled_model is not None:
+        model = compiled_model
+        cudnn.benchmark = True
+        return
+
     checkpoint = torch.load(weights, map_location=device)
 
     model = Context_SEUNet(pretrained=False)
@@ -55,14 +62,14 @@ def load_model():
 
     cudnn.benchmark = True
 
+    model = select_backend('broken', model, weights, (1, 3, 512, 512))
+
 
 @torch.no_grad()
 def segment(imgs):
     global model, device
 
-    imgs = torch.stack([_compose(OpenCV_to_PIL(img)) for img in imgs], dim=0)
-
-    imgs = imgs.to(device)
+    imgs = _normalize(imgs, device)
 
     pred = model(imgs)
 
@@ -74,3 +81,18 @@ def segment(imgs):
     ret = [sub_image for sub_image in ans]
 
     return ret
+
+
+@torch.no_grad()
+def segment_counts(imgs, debug_size=None):
+    '''
+    the foreground pixel counts of the masks (and the downsampled masks if debug_size
+    is given) instead of the full masks, see mask_statistics
+    '''
+    global model, device
+
+    imgs = _normalize(imgs, device)
+
+    pred = model(imgs)
+
+    return mask_statistics(pred, debug_size)
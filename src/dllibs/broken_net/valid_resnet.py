@@ -3,16 +3,17 @@ import torch
 import torch.nn.functional as F
 from pathlib import Path
 import torch.backends.cudnn as cudnn
-import torchvision.transforms as transforms
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 import utility.config
-from utility.dip import OpenCV_to_PIL
 from ..resnet import resnet
 from ..helpers import select_device
+from ..preprocess import Normalizer
+from ..onnx_backend import select_backend
+from ..torchscript_backend import load_compiled_model
 
 
 model = None
@@ -27,11 +28,8 @@ weight_name = ''
 #                                     std=[0.13364828399314022, 0.1321730326816463, 0.13033218443040603])
 # ])
 
-_compose = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.transforms.Normalize(mean=[0.4166430193353317, 0.4182959027833146, 0.41260498572761345],
-                                    std=[0.13783641977586442, 0.1360479262305161, 0.13066597406044492])
-])
+_normalize = Normalizer(mean=[0.4166430193353317, 0.4182959027833146, 0.41260498572761345],
+                        std=[0.13783641977586442, 0.1360479262305161, 0.13066597406044492])
 
 # _resize_compose = transforms.Compose([
 #     transforms.Resize(224),
@@ -52,6 +50,14 @@ def load_model():
 
     weights = str(ROOT / 'weights' / f'{weight_name}.pth.tar')
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # 已编译的模型无需重建网络与加载权重
+    compiled_model = load_compiled_model('valid', weights, device)
+    if compiled_model is not None:
+        model = compiled_model
+        cudnn.benchmark = True
+        return
+
     checkpoint = torch.load(weights, map_location=device)
 
     model = resnet.resnet([3, 4, 6, 3], num_classes=2, arch='senet', drop_layer=True, wider=False, leaky_relu=False)
@@ -63,12 +69,14 @@ def load_model():
 
     cudnn.benchmark = True
 
+    model = select_backend('valid', model, weights, (1, 3, 320, 320))
+
 
 @torch.no_grad()
 def classify(imgs):
     global model, device
 
-    imgs = torch.stack([_compose(OpenCV_to_PIL(img)) for img in imgs], dim=0)
+    imgs = _normalize(imgs, device)
 
     pred = model(imgs)
 
@@ -83,8 +91,7 @@ def classify(imgs):
 def classify_one_image(img):
     global model, device
 
-    img = OpenCV_to_PIL(img)
-    imgs = torch.stack([_compose(img)], dim=0)
+    imgs = _normalize([img], device)
 
     pred = model(imgs)
 
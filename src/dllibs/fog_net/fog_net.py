@@ -1,3 +1,4 @@
+import logging
 import os
 from argparse import ArgumentParser
 from pathlib import Path
@@ -42,20 +43,24 @@ weight_name = ''
 def load_model():
     global model, device, half, weight_name, cfg_path
 
-    # 获取配置文件信息
-    config = Config.fromfile(cfg_path)
-    if 'init_cfg' in config.model.backbone:
-        config.model.backbone.init_cfg = None
-
     if weight_name == utility.config.get_fog_weight():
         return
     weight_name = utility.config.get_fog_weight()
+
+    # 获取配置文件信息，只在加载模型时解析
+    config = Config.fromfile(cfg_path)
+    if 'init_cfg' in config.model.backbone:
+        config.model.backbone.init_cfg = None
     checkpoint = str(ROOT / 'weights' / f'{weight_name}.pth')
 
     device_fog = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     model = init_detector(config, checkpoint, device=device_fog, cfg_options={})
 
+    # mmdet 的检测器需要 mmdeploy 才能导出 ONNX，暂时仍使用 torch
+    if utility.config.get_inference_backend('fog') == 'onnx':
+        logging.warn('the fog detector does not support the onnx backend, fall back to torch')
+
 
 @torch.no_grad()
 def detect(imgs, conf_thres=0.5):  # conf_thres设置0.5还是0.3？
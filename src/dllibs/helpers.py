@@ -1,5 +1,8 @@
 import os
+from typing import List, Optional, Tuple
+import numpy as np
 import torch
+import torch.nn.functional as F
 
 
 def select_device(device='', batch_size=0, newline=True):
@@ -21,3 +24,22 @@ def select_device(device='', batch_size=0, newline=True):
             assert batch_size % n == 0, f'batch-size {batch_size} not multiple of GPU count {n}'
 
     return torch.device('cuda:0' if cuda else 'cpu')
+
+
+@torch.no_grad()
+def mask_statistics(logits: torch.Tensor, debug_size: Optional[int] = None) -> Tuple[List[int], Optional[List[np.ndarray]]]:
+    '''
+    the foreground pixel count of every (n, 1, h, w) segmentation output (sigmoid > 0.5),
+    reduced on its device, and the (debug_size, debug_size, 1) uint8 masks if debug_size
+    is given, so the full masks are not copied to the host
+    '''
+    masks = torch.sigmoid(logits) > 0.5
+    counts = masks.flatten(1).sum(1).cpu().tolist()
+
+    debug_masks = None
+    if debug_size is not None:
+        small = F.interpolate(masks.float(), size=(debug_size, debug_size), mode='area')
+        small = (small * 255).round_().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+        debug_masks = list(small)
+
+    return counts, debug_masks
@@ -0,0 +1,201 @@
+import copy
+import logging
+import os
+from typing import Dict, Optional, Tuple, Union
+import numpy as np
+import torch
+
+import utility.config
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+# 导出时与 ONNX Runtime 输出比较的容差
+EQUIVALENCE_TOLERANCE = 1e-3
+
+
+def _unwrap(model: torch.nn.Module) -> torch.nn.Module:
+    return model.module if isinstance(model, torch.nn.DataParallel) else model
+
+
+def _cpu_copy(model: torch.nn.Module) -> torch.nn.Module:
+    # 在副本上导出和比较，调用方正在使用的模型不会被移到 CPU 或改变 train/eval 状态
+    return copy.deepcopy(_unwrap(model)).cpu().eval()
+
+
+def onnx_file_of(weights: str) -> str:
+    '''
+    the ONNX artifact is saved next to the weights, e.g. weights/model_best.onnx
+    '''
+    name = os.path.basename(weights).split('.')[0]
+    return os.path.join(os.path.dirname(weights), f'{name}.onnx')
+
+
+class OnnxModel:
+    '''
+    runs an exported model by ONNX Runtime on CPU, called like the torch module
+    with a NCHW float tensor and returns a torch tensor on the same device
+    '''
+    def __init__(self, onnx_file: str) -> None:
+        intra_threads, inter_threads = utility.config.get_onnx_threads()
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = intra_threads
+        options.inter_op_num_threads = inter_threads
+
+        self.onnx_file = onnx_file
+        self.session = onnxruntime.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+        self._input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, imgs: torch.Tensor) -> torch.Tensor:
+        inputs = imgs.detach().cpu().numpy().astype(np.float32, copy=False)
+        output = self.session.run(None, {self._input_name: inputs})[0]
+        return torch.from_numpy(output).to(imgs.device)
+
+    def eval(self) -> 'OnnxModel':
+        return self
+
+
+def export(model: torch.nn.Module, onnx_file: str, input_shape: Tuple[int, int, int, int]) -> None:
+    '''
+    exports the model with a dynamic batch size, input_shape is (n, c, h, w)
+    '''
+    model = _cpu_copy(model)
+    dummy = torch.randn(*input_shape)
+
+    tmp_file = f'{onnx_file}.{os.getpid()}.tmp'
+    torch.onnx.export(model, dummy, tmp_file, opset_version=12, do_constant_folding=True,
+                      input_names=['images'], output_names=['output'],
+                      dynamic_axes={'images': {0: 'batch'}, 'output': {0: 'batch'}})
+    os.replace(tmp_file, onnx_file)
+
+
+@torch.no_grad()
+def check_equivalence(model: torch.nn.Module, onnx_model: OnnxModel, input_shape: Tuple[int, int, int, int],
+                      tolerance: float = EQUIVALENCE_TOLERANCE) -> Tuple[bool, float]:
+    '''
+    compares the outputs of the torch model and the ONNX model on a random batch,
+    returns (equivalent, max absolute difference)
+    '''
+    model = _cpu_copy(model)
+    dummy = torch.randn(*input_shape)
+
+    expected = model(dummy)
+    actual = onnx_model(dummy)
+
+    diff = (expected - actual).abs().max().item()
+    return diff <= tolerance, diff
+
+
+def _export_checked(model: torch.nn.Module, weights: str, input_shape: Tuple[int, int, int, int]) -> Optional[str]:
+    '''
+    exports the model to ONNX at the first time (or when the weights are newer than
+    the artifact), returns the artifact or None if it does not match the torch model
+    '''
+    onnx_file = onnx_file_of(weights)
+    if os.path.exists(onnx_file) and os.path.getmtime(onnx_file) >= os.path.getmtime(weights):
+        return onnx_file
+
+    export(model, onnx_file, input_shape)
+
+    # 每次导出后检查输出是否与 torch 一致
+    equivalent, diff = check_equivalence(model, OnnxModel(onnx_file), input_shape)
+    logging.info(f'{onnx_file}: max difference to torch {diff:.2e}')
+    if not equivalent:
+        logging.warn(f'{onnx_file} differs from the torch model ({diff:.2e}), fall back to torch')
+        os.remove(onnx_file)
+        return None
+
+    return onnx_file
+
+
+def load_onnx_model(model: torch.nn.Module, weights: str, input_shape: Tuple[int, int, int, int]) -> Optional[OnnxModel]:
+    '''
+    returns None if ONNX Runtime is not installed or the exported model does not
+    match the torch model, then the torch model should be used
+    '''
+    if onnxruntime is None:
+        logging.warn('onnxruntime is not installed, fall back to torch')
+        return None
+
+    onnx_file = _export_checked(model, weights, input_shape)
+    if onnx_file is None:
+        return None
+
+    return OnnxModel(onnx_file)
+
+
+def quantized_file_of(weights: str, mode: str) -> str:
+    '''
+    mode is 'dynamic' or 'static', e.g. weights/model_best.int8-static.onnx
+    '''
+    name = os.path.basename(weights).split('.')[0]
+    return os.path.join(os.path.dirname(weights), f'{name}.int8-{mode}.onnx')
+
+
+def load_quantized_model(model: torch.nn.Module, weights: str, input_shape: Tuple[int, int, int, int],
+                         mode: str) -> Optional[OnnxModel]:
+    '''
+    loads the INT8 model, the dynamic one is quantized from the ONNX artifact at the
+    first time, the static one must be calibrated beforehand by dllibs.quantize
+    '''
+    if onnxruntime is None:
+        logging.warn('onnxruntime is not installed, fall back to the fp32 model')
+        return None
+
+    quantized_file = quantized_file_of(weights, mode)
+    if not os.path.exists(quantized_file) or os.path.getmtime(quantized_file) < os.path.getmtime(weights):
+        if mode != 'dynamic':
+            logging.warn(f'{quantized_file} is not calibrated (see dllibs.quantize), fall back to the fp32 model')
+            return None
+
+        onnx_file = _export_checked(model, weights, input_shape)
+        if onnx_file is None:
+            return None
+
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp_file = f'{quantized_file}.{os.getpid()}.tmp'
+        quantize_dynamic(onnx_file, tmp_file, weight_type=QuantType.QInt8)
+        os.replace(tmp_file, quantized_file)
+
+    return OnnxModel(quantized_file)
+
+
+# 各模型的权重文件，供 dllibs.quantize 等离线工具使用
+weights_files: Dict[str, str] = {}
+
+
+def select_backend(model_name: str, model: torch.nn.Module, weights: str,
+                   input_shape: Tuple[int, int, int, int]) -> Union[torch.nn.Module, OnnxModel]:
+    '''
+    returns the model to run according to the config: the INT8 model if the
+    quantization of the model is not 'none', the ONNX model or the TorchScript
+    model if its inference backend is 'onnx' or 'torchscript', otherwise (or if
+    they are not available) the torch model
+    '''
+    weights_files[model_name] = weights
+
+    quantization = utility.config.get_quantization(model_name)
+    if quantization != 'none':
+        quantized_model = load_quantized_model(model, weights, input_shape, quantization)
+        if quantized_model is not None:
+            return quantized_model
+
+    backend = utility.config.get_inference_backend(model_name)
+    if backend == 'onnx':
+        onnx_model = load_onnx_model(model, weights, input_shape)
+        if onnx_model is not None:
+            return onnx_model
+    elif backend == 'torchscript':
+        from .torchscript_backend import load_or_compile
+
+        device = next(_unwrap(model).parameters()).device
+        return load_or_compile(model, weights, input_shape, device)
+
+    return model
@@ -0,0 +1,46 @@
+from typing import Dict, List, Optional, Sequence, Union
+import numpy as np
+import torch
+
+
+class Normalizer:
+    '''
+    converts a stacked uint8 NHWC BGR batch (e.g. from dip.letterbox_batch) to a
+    normalized float NCHW RGB tensor in one op, the same as ToTensor() and
+    Normalize(mean, std) on every image converted to PIL
+    '''
+    def __init__(self, mean: Sequence[float], std: Sequence[float]) -> None:
+        mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+
+        # (x / 255 - mean) / std = x * scale + bias
+        self._scale = 1 / (255 * std)
+        self._bias = -mean / std
+
+        # 每个设备上的 scale 与 bias
+        self._params: Dict[torch.device, tuple] = {}
+
+    def _params_on(self, device: torch.device) -> tuple:
+        if device not in self._params:
+            self._params[device] = (self._scale.to(device), self._bias.to(device))
+
+        return self._params[device]
+
+    def __call__(self, imgs: Union[np.ndarray, List[np.ndarray]], device: Optional[torch.device] = None) -> torch.Tensor:
+        '''
+        the uint8 batch is moved to device before the conversion, so only a quarter
+        of the float data is copied
+        '''
+        if not isinstance(imgs, np.ndarray):
+            imgs = np.stack(imgs)
+
+        batch = torch.from_numpy(np.ascontiguousarray(imgs))
+        if device is not None:
+            batch = batch.to(device, non_blocking=True)
+
+        # NHWC BGR -> NCHW RGB
+        batch = batch.permute(0, 3, 1, 2).flip(1).float()
+
+        scale, bias = self._params_on(batch.device)
+
+        return batch.mul_(scale).add_(bias)
@@ -0,0 +1,209 @@
+'''
+INT8 post-training quantization of the classifiers and segmenters, run from src/ as
+
+    python -m dllibs.quantize --model state --calibration a.mp4 b.mp4 --validation c.mp4
+
+the static model is calibrated on frames sampled from the recordings and saved next
+to the weights, then compared with the fp32 model on the validation recordings.
+set the quantization of the model in config.json to 'static' (or 'dynamic', which
+needs no calibration) to use it
+'''
+import argparse
+import importlib
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import torch
+
+import utility.config
+from utility import dip
+from utility.video import Video
+from utility.processer import Classifier
+from . import onnx_backend
+
+
+# 模型名 -> (模块, 输入大小, 缩放方式, 输入图像, 任务)
+MODELS = {
+    'state': ('dllibs.state_net.state_resnet', 224, 'linear', 'screen', 'classify'),
+    'valid': ('dllibs.broken_net.valid_resnet', 320, 'linear', 'screen', 'classify'),
+    'broken': ('dllibs.broken_net.broken_net', 512, 'cubic', 'frame', 'segment'),
+    'segment': ('dllibs.seg_net.seg_net', 256, 'cubic', 'screen', 'segment'),
+}
+
+
+def sample_frames(videos: List[str], count: int) -> List[np.ndarray]:
+    '''
+    count frames sampled evenly from the videos
+    '''
+    ret = []
+    per_video = max(1, count // len(videos))
+    for video_path in videos:
+        video = Video(video_path)
+        frame_count = video.frame_count()
+        for pos in np.linspace(0, frame_count - 1, per_video, dtype=int):
+            video.seek_to(int(pos))
+            frame = video.read()
+            if frame is not None:
+                ret.append(frame)
+
+    return ret
+
+
+def model_inputs(model_name: str, frames: List[np.ndarray], bs: int = 8) -> List[torch.Tensor]:
+    '''
+    the normalized batches of the model, prepared in the same way as the Classifier,
+    the frames without a detected screen are dropped for the screen models
+    '''
+    module_name, size, resample, kind, _ = MODELS[model_name]
+    module = importlib.import_module(module_name)
+
+    if kind == 'screen':
+        bboxes = dip.detect_screen_with_batch(frames, bs)
+        frames = [Classifier._crop_screen(frame, bbox) for frame, bbox in zip(frames, bboxes) if bbox is not None]
+
+    batches = []
+    for i in range(0, len(frames), bs):
+        _, imgs = dip.letterbox_batch(frames[i: i + bs], size, size, resample)
+        batches.append(module._normalize(imgs))
+
+    return batches
+
+
+class CalibrationReader:
+    '''
+    feeds the calibration batches to onnxruntime.quantization.quantize_static
+    '''
+    def __init__(self, batches: List[torch.Tensor]) -> None:
+        self._batches = iter(batches)
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        batch = next(self._batches, None)
+        return None if batch is None else {'images': batch.numpy()}
+
+
+def load_fp32_model(model_name: str) -> Tuple[torch.nn.Module, str]:
+    '''
+    the torch model and its weights file, ignoring the backend and quantization in the config
+    '''
+    module = importlib.import_module(MODELS[model_name][0])
+
+    utility.config.update_quantization(model_name, 'none')
+    utility.config.update_inference_backend(model_name, 'torch')
+    module.load_model()
+
+    return module.model, onnx_backend.weights_files[model_name]
+
+
+def quantize_static(model_name: str, calibration: List[torch.Tensor]) -> str:
+    '''
+    returns the calibrated INT8 model (QDQ, per-channel weights)
+    '''
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+
+    model, weights = load_fp32_model(model_name)
+    size = MODELS[model_name][1]
+
+    onnx_file = onnx_backend._export_checked(model, weights, (1, 3, size, size))
+    assert onnx_file is not None, f'failed to export {model_name} to ONNX'
+
+    quantized_file = onnx_backend.quantized_file_of(weights, 'static')
+    tmp_file = f'{quantized_file}.{os.getpid()}.tmp'
+    quantize_static(onnx_file, tmp_file, CalibrationReader(calibration),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method=CalibrationMethod.MinMax)
+    os.replace(tmp_file, quantized_file)
+
+    return quantized_file
+
+
+def _agreement(expected: torch.Tensor, actual: torch.Tensor) -> Tuple[float, float]:
+    '''
+    top-1 agreement and the mean absolute difference of the probabilities
+    '''
+    expected, actual = expected.softmax(1), actual.softmax(1)
+    agreement = (expected.argmax(1) == actual.argmax(1)).float().mean().item()
+    return agreement, (expected - actual).abs().mean().item()
+
+
+def _mask_iou(expected: torch.Tensor, actual: torch.Tensor) -> Tuple[float, float]:
+    '''
+    IoU of the masks (sigmoid > 0.5, the same as segment()) and the pixel agreement
+    '''
+    expected, actual = expected > 0, actual > 0
+    union = (expected | actual).sum().item()
+    iou = (expected & actual).sum().item() / union if union > 0 else 1.0
+    return iou, (expected == actual).float().mean().item()
+
+
+def _latency(model: Callable[[torch.Tensor], torch.Tensor], batch: torch.Tensor, repeat: int = 10) -> float:
+    '''
+    the median latency in milliseconds
+    '''
+    model(batch)
+
+    costs = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        model(batch)
+        costs.append(1000 * (time.perf_counter() - start_time))
+
+    return float(np.median(costs))
+
+
+@torch.no_grad()
+def evaluate(model_name: str, mode: str, validation: List[torch.Tensor]) -> Dict[str, float]:
+    '''
+    compares the INT8 model with the fp32 model on the validation batches
+    '''
+    model, weights = load_fp32_model(model_name)
+    model = onnx_backend._unwrap(model).cpu().eval()
+    size = MODELS[model_name][1]
+
+    quantized_model = onnx_backend.load_quantized_model(model, weights, (1, 3, size, size), mode)
+    assert quantized_model is not None, f'no {mode} INT8 model of {model_name}'
+
+    metric = _agreement if MODELS[model_name][4] == 'classify' else _mask_iou
+    scores = [metric(model(batch), quantized_model(batch)) for batch in validation]
+
+    batch = validation[0]
+    fp32_cost, int8_cost = _latency(model, batch), _latency(quantized_model, batch)
+
+    return {
+        'metric': float(np.mean([score[0] for score in scores])),
+        'secondary': float(np.mean([score[1] for score in scores])),
+        'fp32_ms': fp32_cost,
+        'int8_ms': int8_cost,
+        'fp32_fps': 1000 * len(batch) / fp32_cost,
+        'int8_fps': 1000 * len(batch) / int8_cost,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', choices=MODELS.keys(), required=True)
+    parser.add_argument('--mode', choices=['static', 'dynamic'], default='static')
+    parser.add_argument('--calibration', nargs='+', default=[], help='recordings to calibrate on')
+    parser.add_argument('--validation', nargs='+', required=True, help='recordings to compare on')
+    parser.add_argument('--frames', type=int, default=200, help='frames sampled for calibration and validation')
+    parser.add_argument('--batch-size', type=int, default=8)
+    args = parser.parse_args()
+
+    utility.config.load_config()
+
+    if args.mode == 'static':
+        assert args.calibration, 'static quantization needs calibration recordings'
+        calibration = model_inputs(args.model, sample_frames(args.calibration, args.frames), args.batch_size)
+        print(f'calibrated on {sum(len(batch) for batch in calibration)} images: '
+              f'{quantize_static(args.model, calibration)}')
+
+    validation = model_inputs(args.model, sample_frames(args.validation, args.frames), args.batch_size)
+    report = evaluate(args.model, args.mode, validation)
+
+    metric_names = ('top-1 agreement', 'mean prob diff') if MODELS[args.model][4] == 'classify' else ('mask IoU', 'pixel agreement')
+    print(f'{args.model} {args.mode} INT8 on {sum(len(batch) for batch in validation)} images')
+    print(f'  {metric_names[0]}: {report["metric"]:.4f}, {metric_names[1]}: {report["secondary"]:.4f}')
+    print(f'  latency (batch {len(validation[0])}): fp32 {report["fp32_ms"]:.2f}ms, int8 {report["int8_ms"]:.2f}ms '
+          f'({report["fp32_ms"] / report["int8_ms"]:.1f}x)')
+    print(f'  throughput: fp32 {report["fp32_fps"]:.1f} img/s, int8 {report["int8_fps"]:.1f} img/s')
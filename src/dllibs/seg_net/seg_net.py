@@ -6,16 +6,18 @@ import torch
 import torch.nn.functional as F
 from pathlib import Path
 import torch.backends.cudnn as cudnn
-import torchvision.transforms as transforms
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 import utility.config
-from utility.dip import OpenCV_to_PIL, tensor_to_OpenCV
+from utility.dip import tensor_to_OpenCV
 from .ce_net import CE_Net
-from ..helpers import select_device
+from ..helpers import select_device, mask_statistics
+from ..preprocess import Normalizer
+from ..onnx_backend import select_backend
+from ..torchscript_backend import load_compiled_model
 
 
 class SCREEN_STATE(enum.Enum):
@@ -30,11 +32,8 @@ half = None
 weight_name = ''
 
 
-_compose = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.transforms.Normalize(mean=[0.4235219742122354, 0.4236387289952207, 0.4216347693022993],
-                                    std=[0.140677661676244, 0.13928682011772153, 0.13288340206878646])
-])
+_normalize = Normalizer(mean=[0.4235219742122354, 0.4236387289952207, 0.4216347693022993],
+                        std=[0.140677661676244, 0.13928682011772153, 0.13288340206878646])
 
 
 @torch.no_grad()
@@ -49,6 +48,14 @@ def load_model():
     weights = str(ROOT / 'weights' / f'{weight_name}.pth')
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # 已编译的模型无需重建网络与加载权重
+    compiled_model = load_compiled_model('segment', weights, device)
+    if compiled_model is not None:
+        model = compiled_model
+        cudnn.benchmark = True
+        return
+
     checkpoint = torch.load(weights, map_location=device)
 
     model = CE_Net(pretrained=False)
@@ -62,14 +69,14 @@ def load_model():
 
     cudnn.benchmark = True
 
+    model = select_backend('segment', model, weights, (1, 3, 256, 256))
+
 
 @torch.no_grad()
 def segment(imgs):
     global model, device
 
-    imgs = torch.stack([_compose(OpenCV_to_PIL(img)) for img in imgs], dim=0)
-
-    imgs = imgs.to(device)
+    imgs = _normalize(imgs, device)
 
     pred = model(imgs)
 
@@ -81,3 +88,18 @@ def segment(imgs):
     ret = [sub_image for sub_image in ans]
 
     return ret
+
+
+@torch.no_grad()
+def segment_counts(imgs, debug_size=None):
+    '''
+    the foreground pixel counts of the masks (and the downsampled masks if debug_size
+    is given) instead of the full masks, see mask_statistics
+    '''
+    global model, device
+
+    imgs = _normalize(imgs, device)
+
+    pred = model(imgs)
+
+    return mask_statistics(pred, debug_size)
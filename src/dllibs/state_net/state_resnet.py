@@ -4,16 +4,17 @@ import torch
 import torch.nn.functional as F
 from pathlib import Path
 import torch.backends.cudnn as cudnn
-import torchvision.transforms as transforms
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 import utility.config
-from utility.dip import OpenCV_to_PIL
 from ..resnet import resnet
 from ..helpers import select_device
+from ..preprocess import Normalizer
+from ..onnx_backend import select_backend
+from ..torchscript_backend import load_compiled_model
 
 
 class SCREEN_STATE(enum.Enum):
@@ -34,11 +35,8 @@ weight_name = ''
 #                                     std=[0.13364828399314022, 0.1321730326816463, 0.13033218443040603])
 # ])
 
-_compose = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.transforms.Normalize(mean=[0.41198305504601485, 0.413795763806039, 0.40595997165677644],
-                                    std=[0.13453862306267259, 0.1324746457453744, 0.1263429144077591])
-])
+_normalize = Normalizer(mean=[0.41198305504601485, 0.413795763806039, 0.40595997165677644],
+                        std=[0.13453862306267259, 0.1324746457453744, 0.1263429144077591])
 
 
 @torch.no_grad()
@@ -53,6 +51,14 @@ def load_model():
     weights = str(ROOT / 'weights' / f'{weight_name}.pth.tar')
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # 已编译的模型无需重建网络与加载权重
+    compiled_model = load_compiled_model('state', weights, device)
+    if compiled_model is not None:
+        model = compiled_model
+        cudnn.benchmark = True
+        return
+
     checkpoint = torch.load(weights, map_location=device)
 
     model = resnet.resnet([3, 4, 6, 3], num_classes=2, arch='senet', drop_layer=True, wider=False, leaky_relu=False)
@@ -65,12 +71,14 @@ def load_model():
 
     cudnn.benchmark = True
 
+    model = select_backend('state', model, weights, (1, 3, 224, 224))
+
 
 @torch.no_grad()
 def classify(imgs):
     global model, device
 
-    imgs = torch.stack([_compose(OpenCV_to_PIL(img)) for img in imgs], dim=0)
+    imgs = _normalize(imgs, device)
 
     pred = model(imgs)
 
@@ -0,0 +1,168 @@
+'''
+the 'torchscript' inference backend: the model is traced, frozen (conv-bn folded)
+and saved next to the weights, keyed by the hash of the weights, so the later
+startups load it without building the module graph. to compare it with the eager
+model, run from src/ as
+
+    python -m dllibs.torchscript_backend --model state
+'''
+import argparse
+import hashlib
+import importlib
+import logging
+import os
+import time
+from typing import Optional, Tuple
+import torch
+
+import utility.config
+
+# 权重文件 -> (mtime, size, hash)，避免同一进程内重复计算
+_digests = {}
+
+
+def weights_digest(weights: str) -> str:
+    stat = os.stat(weights)
+    cached = _digests.get(weights)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+
+    sha1 = hashlib.sha1()
+    with open(weights, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+
+    digest = sha1.hexdigest()[:16]
+    _digests[weights] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+
+def compiled_file_of(weights: str, device: torch.device) -> str:
+    '''
+    e.g. weights/model_best.3f2a9c1e0b7d4a55.cuda.ts, traced graphs are device specific
+    '''
+    name = os.path.basename(weights).split('.')[0]
+    return os.path.join(os.path.dirname(weights), f'{name}.{weights_digest(weights)}.{device.type}.ts')
+
+
+def compile_model(model: torch.nn.Module, compiled_file: str, input_shape: Tuple[int, int, int, int],
+                  device: torch.device) -> torch.jit.ScriptModule:
+    '''
+    traces the model on device with a dynamic batch size, freezing folds the
+    batch norms into the convolutions and inlines the weights as constants
+    '''
+    model = model.module if isinstance(model, torch.nn.DataParallel) else model
+    model = model.to(device).eval()
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.randn(*input_shape, device=device))
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    tmp_file = f'{compiled_file}.{os.getpid()}.tmp'
+    torch.jit.save(frozen, tmp_file)
+    os.replace(tmp_file, compiled_file)
+
+    return frozen
+
+
+def load_compiled_model(model_name: str, weights: str, device: torch.device) -> Optional[torch.jit.ScriptModule]:
+    '''
+    returns the compiled model if the inference backend of the model is 'torchscript'
+    (and it is not quantized) and the weights have been compiled, so load_model()
+    can skip building the model
+    '''
+    if utility.config.get_inference_backend(model_name) != 'torchscript' or \
+            utility.config.get_quantization(model_name) != 'none':
+        return None
+
+    compiled_file = compiled_file_of(weights, device)
+    if not os.path.exists(compiled_file):
+        return None
+
+    try:
+        return torch.jit.load(compiled_file, map_location=device).eval()
+    except RuntimeError as e:
+        logging.warn(f'failed to load {compiled_file} ({e}), rebuild it')
+        os.remove(compiled_file)
+        return None
+
+
+def load_or_compile(model: torch.nn.Module, weights: str, input_shape: Tuple[int, int, int, int],
+                    device: torch.device) -> torch.nn.Module:
+    '''
+    compiles the model at the first time, returns the eager model if tracing fails
+    '''
+    compiled_file = compiled_file_of(weights, device)
+    if os.path.exists(compiled_file):
+        return torch.jit.load(compiled_file, map_location=device).eval()
+
+    try:
+        return compile_model(model, compiled_file, input_shape, device)
+    except Exception as e:
+        logging.warn(f'failed to compile {weights} ({e}), fall back to the eager model')
+        return model
+
+
+@torch.no_grad()
+def _latency(model: torch.nn.Module, batch: torch.Tensor, repeat: int = 20) -> float:
+    '''
+    the median latency in milliseconds, synchronized on cuda
+    '''
+    costs = []
+    for i in range(repeat + 3):
+        start_time = time.perf_counter()
+        model(batch)
+        if batch.is_cuda:
+            torch.cuda.synchronize()
+        # 前几次用于预热（TorchScript 的 profiling executor 会在前两次优化图）
+        if i >= 3:
+            costs.append(1000 * (time.perf_counter() - start_time))
+
+    costs.sort()
+    return costs[len(costs) // 2]
+
+
+def _startup(module, model_name: str, backend: str) -> float:
+    '''
+    the time of load_model() in milliseconds
+    '''
+    utility.config.update_inference_backend(model_name, backend)
+    module.weight_name = ''
+
+    start_time = time.perf_counter()
+    module.load_model()
+    return 1000 * (time.perf_counter() - start_time)
+
+
+if __name__ == '__main__':
+    from .quantize import MODELS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', choices=MODELS.keys(), required=True)
+    parser.add_argument('--batch-size', type=int, default=8)
+    args = parser.parse_args()
+
+    utility.config.load_config()
+    utility.config.update_quantization(args.model, 'none')
+
+    module = importlib.import_module(MODELS[args.model][0])
+    size = MODELS[args.model][1]
+
+    eager_startup = _startup(module, args.model, 'torch')
+    eager_model = module.model
+    batch = torch.randn(args.batch_size, 3, size, size, device=module.device)
+
+    # 第一次启动时编译并保存
+    compile_startup = _startup(module, args.model, 'torchscript')
+    compiled_startup = _startup(module, args.model, 'torchscript')
+    compiled_model = module.model
+
+    with torch.no_grad():
+        diff = (eager_model(batch) - compiled_model(batch)).abs().max().item()
+
+    eager_cost, compiled_cost = _latency(eager_model, batch), _latency(compiled_model, batch)
+
+    print(f'{args.model} on {module.device}, max difference {diff:.2e}')
+    print(f'  startup: eager {eager_startup:.0f}ms, compile {compile_startup:.0f}ms, compiled {compiled_startup:.0f}ms')
+    print(f'  latency (batch {args.batch_size}): eager {eager_cost:.2f}ms, compiled {compiled_cost:.2f}ms '
+          f'({eager_cost / compiled_cost:.2f}x)')
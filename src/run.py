@@ -12,7 +12,7 @@ app = Flask(__name__)
 cors = CORS(app)
 
 # 导入实现算法需要用到的模块
-from controller_backend import MainController
+from controller_backend import MainController, result_dirs
 from viewmodel_backend import VideoHandler, ViewModel
 from utility import config
 import argparse
@@ -49,6 +49,37 @@ def on_examine_one_video(dest_dir, idx, controller, video_type) -> bool:
     return False
 
 
+def _wait_for_summaries(video_paths, video_type) -> bool:
+    # tv+fog 的视频有 tv 与 fog 两份结果
+    summary_paths = [result_dir / 'summary.json' for video_path in video_paths
+                     for result_dir in result_dirs(dest_dir, video_path, video_type).values()]
+
+    wait_time = 10
+    while wait_time > 0:
+        if all(os.path.isfile(summary_path) for summary_path in summary_paths):
+            return True
+        else:
+            wait_time -= 1
+            print('未检测到结果文件,继续检测{:d}次'.format(wait_time))
+            time.sleep(10)
+
+    return False
+
+
+def _result_dir(name, sub_type=None) -> Path:
+    # tv+fog 的结果保存在 tv 与 fog 子目录中，未指定 type 时依次查找
+    if sub_type in ('tv', 'fog'):
+        candidates = [Path(dest_dir) / sub_type / name, Path(dest_dir) / name]
+    else:
+        candidates = [Path(dest_dir) / name, Path(dest_dir) / 'tv' / name, Path(dest_dir) / 'fog' / name]
+
+    for candidate in candidates:
+        if candidate.is_dir():
+            return candidate
+
+    return candidates[0]
+
+
 def _examine_all_videos(dest_dir, indexes, controller, video_type) -> bool:
     if dest_dir:
         for idx in indexes:
@@ -101,18 +132,8 @@ async def detectOne():
         print('是否检测完成：', has_examined_video)
 
         if has_examined_video:
-            summary_path = os.path.join(os.path.join(dest_dir, Path(maincontroller.viewmodel.get(idx).video_path()).stem), 'summary.json')
-            # print(summary_path)
-            wait_time = 10
-            while wait_time > 0:
-                if os.path.isfile(summary_path):
-                    return Response('success')
-                else:
-                    wait_time -= 1
-                    print('未检测到结果文件,继续检测{:d}次'.format(wait_time))
-                    time.sleep(10)
-
-            return Response('error')
+            video_path = maincontroller.viewmodel.get(idx).video_path()
+            return Response('success' if _wait_for_summaries([video_path], video_type) else 'error')
 
 
 @app.route('/video/detectAll', methods=['post'])
@@ -143,18 +164,8 @@ async def detectMul():
     print('是否检测完成：', has_examined_video)
 
     if has_examined_video:
-        summary_path = os.path.join(os.path.join(dest_dir, Path(maincontroller.viewmodel.get(indexes[0]).video_path()).stem), 'summary.json')
-        # print(summary_path)
-        wait_time = 10
-        while wait_time > 0:
-            if os.path.isfile(summary_path):
-                return Response('success')
-            else:
-                wait_time -= 1
-                print('未检测到结果文件,继续检测{:d}次'.format(wait_time))
-                time.sleep(10)
-
-        return Response('error')
+        video_paths = [maincontroller.viewmodel.get(idx).video_path() for idx in indexes]
+        return Response('success' if _wait_for_summaries(video_paths, video_type) else 'error')
 
 
 @app.route('/video/add', methods=['post'])
@@ -167,6 +178,32 @@ def add():
     return '已经将{}加入视频列表'.format(file.filename)
 
 
+# 检测正在录制的视频：直播流地址或录像片段所在的文件夹，每完成一道工序即更新结果
+# 直播在单独的检测进程中进行，同时检测的直播数由配置 live_streams 限制（默认 1），超出时返回 503
+@app.route('/video/live', methods=['post'])
+def addLive():
+    source = request.form.get('source')
+    video_type = request.form.get('type')
+    audit = request.form.getlist('audit[]')
+
+    if not source:
+        return Response('缺少直播地址 source', status=400)
+
+    if video_type not in ('tv', 'fog', 'tv+fog'):
+        return Response('未知的检测类型 type', status=400)
+
+    if not dest_dir:
+        return Response('error')
+
+    if len(audit) < 4:
+        audit = ['', '', datetime.now().strftime('%a %b %d %Y %H:%M:%S'), '']
+
+    if not maincontroller.examine_stream(source, dest_dir, video_type, audit):
+        return Response('直播检测名额已满', status=503)
+    print('开始检测直播视频{}'.format(source))
+    return Response(Path(source.rstrip('/\\')).stem)
+
+
 def addVideo(file, video_type):
     buffer_video = file.read()
 
@@ -226,7 +263,7 @@ def getResultsList():
 def getResults():
     data = request.get_json(silent=True)
     name = data['name']
-    json_path = dest_dir + '/' + name + '/summary.json'
+    json_path = str(_result_dir(name, data.get('type')) / 'summary.json')
     print('json文件路径:' + json_path)
 
     res_map = {
@@ -277,7 +314,7 @@ def getImage():
     data = request.get_json(silent=True)
     name = data['name']
     idx = data['idx']
-    img_path = dest_dir + '/' + name + '/images/' + f'{idx:03}.jpg'
+    img_path = str(_result_dir(name, data.get('type')) / 'images' / f'{idx:03}.jpg')
     print('img文件路径:' + img_path)
     # imgs = [f for f in os.listdir(img_path) if os.path.isfile(f)]
 
@@ -304,7 +341,7 @@ def getImage():
 def getExcel():
     data = request.get_json(silent=True)
     name = data['name']
-    excel_path = dest_dir + '/' + name + '/__src/' + name + '.xls'
+    excel_path = str(_result_dir(name, data.get('type')) / '__src' / (name + '.xls'))
     print('excel文件路径:' + excel_path)
 
     wait_time = 3
@@ -317,12 +354,19 @@ def getExcel():
             time.sleep(2)
     return Response('error')
 
+# 检测进程是否已加载并预热模型，未就绪时提交的视频会在预热完成后开始检测
+@app.route('/ready', methods=['get'])
+def getReady():
+    return jsonify({'ready': maincontroller.is_ready()})
+
+
 # TODO:实现进度条的实时检测
 @app.route('/progress', methods=['post'])
 def getProgress():
-    i, amount = maincontroller.progress_queue.get()
-    ratio = round(min(100 * i / amount, 100.0), 2)
-    return jsonify({'ratio': ratio})
+    # 多个视频同时检测时，ratio 为正在检测的各视频进度的平均值，结果已保存的视频不计入
+    progress = maincontroller.get_progress()
+    ratio = round(sum(progress.values()) / len(progress), 2) if progress else 0.0
+    return jsonify({'ratio': ratio, 'videos': {Path(video_path).name: r for video_path, r in progress.items()}})
 
 
 parser = argparse.ArgumentParser()
@@ -4,6 +4,7 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 
 from datetime import datetime
+from typing import Callable, Optional
 
 import utility.config
 from utility.video import Video, VideoWriter
@@ -49,8 +50,12 @@ class ClassifierDetector:
 
         self.frames_info = []
 
-    def __call__(self, frame_no, frame, bbox, phosphor_ans, cone_ans):
-        self.frames_info.append((frame_no, frame, bbox, phosphor_ans, cone_ans))
+    def __call__(self, frame_no, frame, bbox, phosphor_ans, broken_ans, cone_ans):
+        '''
+        broken_ans and cone_ans are (mask, count) or None, the mask is downsampled for
+        visualisation and count is the foreground pixel count of the full mask
+        '''
+        self.frames_info.append((frame_no, frame, bbox, phosphor_ans, broken_ans, cone_ans))
 
     def save_result(self):
         draw_dir = self.dest_dir / 'frames'
@@ -61,18 +66,24 @@ class ClassifierDetector:
 
         broken_results, phosphor_results, cone_results = [], [], []
 
-        for frame_no, frame, bbox, phosphor_ans, cone_ans in self.frames_info:
-            # broken_results.append((frame_no, broken_ans))
+        for frame_no, frame, bbox, phosphor_ans, broken_ans, cone_ans in self.frames_info:
+            # 曲线和 results.txt 使用完整掩膜的像素数
+            broken_results.append((frame_no, None if broken_ans is None else broken_ans[1]))
             phosphor_results.append((frame_no, phosphor_ans))
-            cone_results.append((frame_no, cone_ans))
+            cone_results.append((frame_no, None if cone_ans is None else cone_ans[1]))
 
             if bbox is not None:
                 drawfile = draw_dir / f'{frame_no:05}.jpg'
+                if phosphor_ans is not None:
+                    phosphor_text = f"{'FAIL' if phosphor_ans > 0.5 else 'PASS'} ({phosphor_ans:.2})"
+                else:
+                    # 确认碎屏后跳过了荧光粉检测
+                    phosphor_text = 'SKIPPED'
                 contents = [
                     ([
                          # f"{'NOT_VALID' if broken_ans > 0.5 else 'VALID'} ({broken_ans:.2})",
                          # TODO:
-                         f"{'FAIL' if phosphor_ans > 0.5 else 'PASS'} ({phosphor_ans:.2})",
+                         phosphor_text,
                      ], 'lt0')
                 ]
                 drawed = dip.rectangle_and_text(frame, bbox[:4], contents, font_size=15, bgcolor=(108, 210, 101))
@@ -81,7 +92,7 @@ class ClassifierDetector:
 
                 if cone_ans is not None:
                     segment_file = segment_dir / f'{frame_no:05}.jpg'
-                    cv2.imwrite(str(segment_file), cone_ans)
+                    cv2.imwrite(str(segment_file), cone_ans[0])
 
         plot_dir = self.dest_dir / 'pt'
         plot_dir.mkdir(exist_ok=True)
@@ -97,8 +108,19 @@ class ClassifierDetector:
 
         plt.clf()
 
+        x = [frame_no for frame_no, _ in broken_results]
+        y = [-100 if ans is None else ans for _, ans in broken_results]
+        none_y = [-100 for _ in broken_results]
+
+        plt.plot(x, y)
+        plt.plot(x, none_y)
+        plt.title('broken detection')
+        plt.savefig(str(plot_dir / 'broken.jpg'))
+
+        plt.clf()
+
         x = [frame_no for frame_no, _ in cone_results]
-        y = [-100 if ans is None else np.sum(ans) // 255 for _, ans in cone_results]
+        y = [-100 if ans is None else ans for _, ans in cone_results]
         none_y = [-100 for _ in cone_results]
 
         plt.plot(x, y)
@@ -110,137 +132,264 @@ class ClassifierDetector:
 
         with open(str(plot_dir / 'results.txt'), 'w', encoding='utf-8') as f:
             f.write('frame numbers\n')
-            f.write(', '.join(str(frame_no) for frame_no, ans in broken_results))
+            f.write(', '.join(str(frame_no) for frame_no, ans in phosphor_results))
             f.write('\n')
 
             f.write('phosphor\n')
             f.write(', '.join(str(ans) for frame_no, ans in phosphor_results))
             f.write('\n')
 
+            f.write('broken\n')
+            f.write(', '.join(str(ans if ans is not None else -1) for frame_no, ans in broken_results))
+            f.write('\n')
+
             f.write('cone\n')
-            f.write(', '.join(str(np.sum(ans) if ans is not None else -1) for frame_no, ans in cone_results))
+            f.write(', '.join(str(ans if ans is not None else -1) for frame_no, ans in cone_results))
             f.write('\n')
 
 
-class Arbiter:
+class ScreenPipeline:
     '''
-        检测视频并保存结果
+        将电视机视频帧划分为工序并对每道工序分类
     '''
 
-    def __init__(self, detection_conf, save_dir=None, use_detectors: bool = False) -> None:
-        self.detection_conf = detection_conf  # yolo模型置信度
+    def __init__(self, detection_conf, save_dir=None, use_detectors: bool = False, verbose=False,
+                 key_frame_loader: Optional[KeyFrameLoader] = None,
+                 feedback: Optional[SamplerFeedback] = None, motion_gate: Optional[MotionGate] = None,
+                 on_section: Optional[Callable[[list], None]] = None) -> None:
+        '''
+        on_section(section_results) is called every time a section is closed
+        '''
         self.save_dir = save_dir
         self.use_detectors = use_detectors
+        self.verbose = verbose
+        self.key_frame_loader = key_frame_loader
+        self.on_section = on_section
 
-    def arbitrate(self, video_path: str, verbose=False, progress_queue=None, video_type='tv'):
-        print(f'start: {datetime.now().strftime("%H-%M-%S")}')
-        print('detect video type:{}'.format(video_type))
         sectionalizer_detector = SectionalizerDetector(self.save_dir) if self.use_detectors else None
+        self.sectionalizer = Sectionalizer(detection_conf, sectionalizer_detector, feedback,
+                                           motion_gate)  # 保存序列化帧(按间隔划分)
 
-        frame_filter = FrameFilter(video_path, set_end_flag=True, video_type='tv')  # 获取视频帧
-        fog_frame_filter = FrameFilter(video_path, set_end_flag=True, video_type='fog')  # 获取视频帧
-        sectionalizer = Sectionalizer(self.detection_conf, sectionalizer_detector)  # 保存序列化帧(按间隔划分)
-        # fps = frame_filter.computed_fps
+        self.section_results = []  # 保存序列化检测结果
+        self.section_idx = 0
 
-        section_results = []  # 保存序列化检测结果
-        fog_section_results = []  # 保存序列化检测结果
+        self._new_classifier()
 
-        section_idx = 0
+    def _new_classifier(self) -> None:
+        self.classifier_detector = ClassifierDetector(
+            path.join(self.save_dir, f'{self.section_idx:02}')) if self.use_detectors else None
+        # 创建分类器，用于视频帧图像的状态分类
+        self.classifier = Classifier(self.classifier_detector)
 
-        _enum = tqdm.tqdm(frame_filter) if verbose else frame_filter
-        fog_enum = tqdm.tqdm(fog_frame_filter) if verbose else fog_frame_filter
+    def push(self, tag, frame_idx, msec, frame) -> None:
+        # 将当前帧添加到序列中，使用yolo模型检测屏面玻璃位置并保存到frame中
+        self.sectionalizer.add_frame(tag, frame_idx, msec, frame)
 
-        classifier_detector = ClassifierDetector(
-            path.join(self.save_dir, f'{section_idx:02}')) if self.use_detectors else None
-        # 创建分类器，用于视频帧图像的状态分类
-        classifier = Classifier(classifier_detector)
-        fogDetetor = FogDetector()
+        if not self.sectionalizer.is_ready():
+            return
 
-        # 遍历视频并批量获取帧
-        if video_type == 'tv':
-            for i, (tag, frame_idx, msec, frame) in enumerate(_enum):
-                if progress_queue is not None:
-                    progress_queue.put((i, len(frame_filter)))
+        # 从序列中获取帧
+        is_over, psection = self.sectionalizer.retrieve_section()
 
-                # 将当前帧添加到序列中，使用yolo模型检测屏面玻璃位置并保存到frame中
-                sectionalizer.add_frame(tag, frame_idx, msec, frame)
+        if psection is None:
+            return
 
-                if sectionalizer.is_ready():
-                    # 从序列中获取帧
-                    is_over, psection = sectionalizer.retrieve_section()
+        # 将当前批次帧送入检测器进行检测
+        self.classifier.push_partial_section(is_over, psection)
 
-                    if psection is None:
-                        continue
+        # 如果当前视频到达末尾
+        if is_over:
+            # 根据之前检测缓存的结果，调用classify函数判断输出最近检测结果
+            start_frame_no, end_frame_no, start_msec, end_msec, section_cat, percentage, key_frame, frame_no, frame_msec = self.classifier.classify()
 
-                    # 将当前批次帧送入检测器进行检测
-                    classifier.push_partial_section(is_over, psection)
+            # 检测使用的是缩小后的帧，关键帧从原视频中重新读取
+            if self.key_frame_loader is not None and key_frame is not None:
+                key_frame = self.key_frame_loader.load(frame_no)
 
-                    # 如果当前视频到达末尾
-                    if is_over:
-                        # 根据之前检测缓存的结果，调用classify函数判断输出最近检测结果
-                        start_frame_no, end_frame_no, start_msec, end_msec, section_cat, percentage, key_frame, frame_no, frame_msec = classifier.classify()
+            if self.classifier_detector is not None:
+                self.classifier_detector.save_result()
 
-                        if classifier_detector is not None:
-                            classifier_detector.save_result()
+            self.section_results.append((
+                start_frame_no, end_frame_no, start_msec, end_msec, section_cat, percentage, key_frame,
+                frame_no, frame_msec
+            ))
 
-                        section_results.append((
-                            start_frame_no, end_frame_no, start_msec, end_msec, section_cat, percentage, key_frame,
-                            frame_no, frame_msec
-                        ))
+            if self.verbose:
+                print(f'{self.section_idx:02}:', self.section_results[-1])
+                print(self.classifier.image_cache.report())
+                print(self.classifier.report())
 
-                        if verbose:
-                            print(f'{section_idx:02}:', section_results[-1])
+            if self.on_section is not None:
+                self.on_section(self.section_results)
 
-                        section_idx += 1
+            self.section_idx += 1
 
-                        # 更新分类器
-                        classifier_detector = ClassifierDetector(
-                            path.join(self.save_dir, f'{section_idx:02}')) if self.use_detectors else None
-                        classifier = Classifier(classifier_detector)
+            # 更新分类器
+            self._new_classifier()
 
-                        # if section_idx == 2:
-                        #     break
-        else:
-            for i, (tag, frame_idx, msec, frame) in enumerate(fog_enum):
-                if progress_queue is not None:
-                    progress_queue.put((i, len(fog_frame_filter)))
 
-                # 将当前帧添加到序列中，使用yolo模型检测屏面玻璃位置并保存到frame中
-                sectionalizer.add_frame_fog(tag, frame_idx, msec, frame)
+class FogPipeline:
+    '''
+        将漏氟视频帧划分为工序并判断每道工序
+    '''
+
+    def __init__(self, detection_conf, save_dir=None, use_detectors: bool = False, verbose=False,
+                 key_frame_loader: Optional[KeyFrameLoader] = None,
+                 feedback: Optional[SamplerFeedback] = None, motion_gate: Optional[MotionGate] = None,
+                 on_section: Optional[Callable[[list], None]] = None) -> None:
+        '''
+        on_section(section_results) is called every time a section is closed
+        '''
+        self.verbose = verbose
+        self.key_frame_loader = key_frame_loader
+        self.on_section = on_section
 
-                if sectionalizer.is_ready():
-                    # 从序列中获取帧
-                    is_over, psection = sectionalizer.retrieve_section()
+        sectionalizer_detector = SectionalizerDetector(save_dir) if use_detectors else None
+        self.sectionalizer = Sectionalizer(detection_conf, sectionalizer_detector, feedback, motion_gate,
+                                           FOG_SECTION_PROFILE)
 
-                    if psection is None:
-                        continue
+        self.section_results = []  # 保存序列化检测结果
+        self.section_idx = 0
 
-                    # 将当前批次帧送入检测器进行检测
-                    fogDetetor.push_partial_section(is_over, psection)
+        self.fog_detector = FogDetector()
 
-                    # 如果当前视频到达末尾
-                    if is_over:
-                        start_frame_no, end_frame_no, start_msec, end_msec, section_cat, percentage, key_frame, frame_no, frame_msec = fogDetetor.get_results()
+    def push(self, tag, frame_idx, msec, frame) -> None:
+        # 将当前帧添加到序列中，使用yolo模型检测屏面玻璃位置并保存到frame中
+        self.sectionalizer.add_frame(tag, frame_idx, msec, frame)
+
+        if not self.sectionalizer.is_ready():
+            return
+
+        # 从序列中获取帧
+        is_over, psection = self.sectionalizer.retrieve_section()
+
+        if psection is None:
+            return
 
-                        fog_section_results.append((
-                            start_frame_no, end_frame_no, start_msec, end_msec, section_cat, percentage, key_frame,
-                            frame_no, frame_msec
-                        ))
+        # 将当前批次帧送入检测器进行检测
+        self.fog_detector.push_partial_section(is_over, psection)
 
-                        if verbose:
-                            print(f'{section_idx:02}:', fog_section_results[-1])
+        # 如果当前视频到达末尾
+        if is_over:
+            start_frame_no, end_frame_no, start_msec, end_msec, section_cat, percentage, key_frame, frame_no, frame_msec = self.fog_detector.get_results()
 
-                        section_idx += 1
+            # 检测使用的是缩小后的帧，关键帧从原视频中重新读取
+            if self.key_frame_loader is not None and key_frame is not None:
+                key_frame = self.key_frame_loader.load(frame_no)
 
-                        # 更新分类器
-                        fogDetetor = FogDetector()
+            self.section_results.append((
+                start_frame_no, end_frame_no, start_msec, end_msec, section_cat, percentage, key_frame,
+                frame_no, frame_msec
+            ))
 
-                        # if section_idx == 2:
-                        #     break
+            if self.verbose:
+                print(f'{self.section_idx:02}:', self.section_results[-1])
+
+            if self.on_section is not None:
+                self.on_section(self.section_results)
+
+            self.section_idx += 1
+
+            # 更新分类器
+            self.fog_detector = FogDetector()
+
+
+class Arbiter:
+    '''
+        检测视频并保存结果
+    '''
+
+    def __init__(self, detection_conf, save_dir=None, use_detectors: bool = False) -> None:
+        '''
+        save_dir is where the detectors save, a dict from the sub type ('tv' or 'fog')
+        to its own directory when both pipelines run on the same video
+        '''
+        self.detection_conf = detection_conf  # yolo模型置信度
+        self.save_dir = save_dir
+        self.use_detectors = use_detectors
+
+    def _pipeline(self, video_type: str, verbose=False, key_frame_loader=None, feedback=None, motion_gate=None,
+                  on_section=None):
+        save_dir = self.save_dir[video_type] if isinstance(self.save_dir, dict) else self.save_dir
+        if video_type == 'tv':
+            return ScreenPipeline(self.detection_conf, save_dir, self.use_detectors, verbose, key_frame_loader,
+                                  feedback, motion_gate, on_section)
+        else:
+            return FogPipeline(self.detection_conf, save_dir, self.use_detectors, verbose, key_frame_loader,
+                               feedback, motion_gate, on_section)
+
+    def arbitrate(self, video_path: str, verbose=False, progress_queue=None, video_type='tv', live=False,
+                  on_section: Optional[Callable[[str, list], None]] = None):
+        '''
+        video_type is 'tv', 'fog' or 'tv+fog', the last one decodes the video once for
+        both pipelines and returns (tv results, fog results). if live is True, video_path
+        is a stream or a directory of recorded segments (see LiveVideo). on_section(sub_type,
+        section_results) is called every time a section is closed, so the results of a
+        live video are available before the recording ends
+        '''
+        print(f'start: {datetime.now().strftime("%H-%M-%S")}')
+        print('detect video type:{}'.format(video_type))
+
+        video_types = video_type.split('+')
+
+        # 所有流水线共享一次解码，被忽略的帧只跳过不解码，并按配置缩小解码
+        adaptive = utility.config.get_adaptive_sampling()
+        frame_source = SharedFrameSource(video_path, video_types, set_end_flag=True, skip_decode=True,
+                                         working_width=utility.config.get_working_width(),
+                                         adaptive=adaptive, live=live)  # 获取视频帧
+        key_frame_loader = KeyFrameLoader(video_path) if frame_source.working_scale < 1 else None
+
+        # 自适应采样时，每条流水线根据工序状态控制各自的采样器
+        feedbacks = [frame_source.feedback(i) if adaptive else None for i in range(len(video_types))]
+        # 画面静止时复用上一次的检测结果
+        use_motion_gate = utility.config.get_motion_gate_threshold() > 0
+        motion_gates = [MotionGate() if use_motion_gate else None for _ in video_types]
+        section_callbacks = [
+            None if on_section is None else (lambda results, sub_type=sub_type: on_section(sub_type, results))
+            for sub_type in video_types
+        ]
+        pipelines = [self._pipeline(sub_type, verbose, key_frame_loader, feedback, motion_gate, section_callback)
+                     for sub_type, feedback, motion_gate, section_callback in
+                     zip(video_types, feedbacks, motion_gates, section_callbacks)]
+        # 在后台线程中提前解码，使解码与模型推理并行
+        prefetcher = FramePrefetcher(frame_source) if utility.config.get_prefetch_depth() > 0 else None
+        frames = prefetcher if prefetcher is not None else frame_source
+
+        _enum = tqdm.tqdm(frames) if verbose else frames
+
+        # 进度按解码位置计算，自适应采样跳过或补帧的帧也计入
+        frame_count = 0 if live else frame_source.frame_count()
+
+        # 遍历视频并批量获取帧
+        for tags, frame_idx, msec, frame in _enum:
+            # 直播没有总帧数
+            if progress_queue is not None and not live and tags is not None:
+                progress_queue.put((frame_idx + 1, frame_count))
+
+            for pipeline_idx, pipeline in enumerate(pipelines):
+                if tags is None:
+                    pipeline.push(None, frame_idx, msec, frame)
+                elif tags[pipeline_idx] != FRAME_TAG.IGNORED:
+                    pipeline.push(tags[pipeline_idx], frame_idx, msec, frame)
+
+        frame_source.close()
+        if key_frame_loader is not None:
+            key_frame_loader.close()
 
         print(f'end: {datetime.now().strftime("%H-%M-%S")}')
+        print(frame_source.decode_report())
+        if prefetcher is not None:
+            print(prefetcher.report())
+        for sub_type, feedback, motion_gate in zip(video_types, feedbacks, motion_gates):
+            if feedback is not None:
+                print(f'{sub_type} {feedback.report()}')
+            if motion_gate is not None:
+                print(f'{sub_type} {motion_gate.report()}')
 
         if progress_queue is not None:
             progress_queue.put((-1, -1))
 
-        return section_results if video_type == 'tv' else fog_section_results
+        if len(pipelines) == 1:
+            return pipelines[0].section_results
+        else:
+            return tuple(pipeline.section_results for pipeline in pipelines)
@@ -0,0 +1,240 @@
+'''
+micro-benchmarks of the hot paths, run from src/ as
+
+    python -m utility.bench
+
+or tunes the batch sizes of the models for this host and saves them to config.json
+
+    python -m utility.bench --tune-batch-sizes
+
+or checks that the models decide the same with the letterbox_batch() inputs as with
+the per-image PIL resize() inputs on frames sampled from recordings
+
+    python -m utility.bench --agreement a.mp4 b.mp4
+'''
+import argparse
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import cv2
+import numpy as np
+
+import utility.config
+from utility import dip
+from utility.model_registry import MODELS as BATCH_MODELS
+
+BATCH_SIZE_CANDIDATES = (1, 2, 4, 8, 16, 32, 64)
+
+# 吞吐量与最优值相差不超过该比例时选择更小的批大小（更低的延迟与内存占用）
+BATCH_SIZE_TOLERANCE = 0.05
+
+
+def _timeit(fn: Callable[[], object], repeat: int) -> float:
+    '''
+    the median time of fn in milliseconds, the first call is used as a warm-up
+    '''
+    fn()
+
+    costs = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        costs.append(1000 * (time.perf_counter() - start_time))
+
+    return float(np.median(costs))
+
+
+def _smooth_frames(frame_size: Tuple[int, int], count: int) -> List[np.ndarray]:
+    '''
+    smooth random images, so the interpolation differences are not amplified by noise
+    '''
+    width, height = frame_size
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+    return [cv2.resize(np.roll(small, i, axis=1), (width, height)) for i in range(count)]
+
+
+def bench_letterbox(frame_size: Tuple[int, int] = (1920, 1080), batch_size: int = 8,
+                    sizes: Tuple[int, ...] = (640, 512, 256, 224),
+                    repeat: int = 10) -> List[Tuple[int, float, float, float, int]]:
+    '''
+    compares the per-image resize() + stack_images() with letterbox_batch(), returns
+    (size, old ms, new ms, mean and max absolute difference of the pixels)
+    '''
+    frames = _smooth_frames(frame_size, batch_size)
+
+    ret = []
+    for size in sizes:
+        buffer = dip.letterbox_buffer(batch_size, size, size)
+
+        old = dip.stack_images([dip.resize(frame, size, size)[1] for frame in frames])
+        _, new = dip.letterbox_batch(frames, size, size, out=buffer)
+        diff = np.abs(old.astype(np.int16) - new.astype(np.int16))
+
+        old_cost = _timeit(lambda: dip.stack_images([dip.resize(frame, size, size)[1] for frame in frames]), repeat)
+        new_cost = _timeit(lambda: dip.letterbox_batch(frames, size, size, out=buffer), repeat)
+
+        ret.append((size, old_cost, new_cost, float(diff.mean()), int(diff.max())))
+
+    return ret
+
+
+def _resize_letterbox_batch(images: List[np.ndarray], height: int, width: int, resample='cubic',
+                            out: Optional[np.ndarray] = None) -> Tuple[List[float], np.ndarray]:
+    '''
+    letterbox_batch() by the per-image PIL resize(), i.e. the inputs before letterbox_batch()
+    '''
+    results = [dip.resize(image, height, width) for image in images]
+    return [scale for scale, _ in results], dip.stack_images([image for _, image in results])
+
+
+# 各模型的判定：是否检测到目标、是否为正类、分割的前景是否多于 1 个像素（与 Classifier 一致）
+_DECISIONS = {
+    'detection': (lambda ans: ans is not None, {}),
+    'fog_detection': (lambda ans: ans is not None, {}),
+    'state_test': (lambda ans: ans >= 0.5, {}),
+    'broken_test': (lambda ans: ans[0] > 1, {'counts_only': True}),
+    'segmentation': (lambda ans: ans[0] > 1, {'counts_only': True}),
+}
+
+
+def bench_agreement(frames: List[np.ndarray], bs: int = 8,
+                    model_cats: Optional[List[str]] = None) -> Dict[str, float]:
+    '''
+    the ratio of the frames on which every model decides the same with the inputs of
+    letterbox_batch() and of resize(), the screen models get the center squares
+    '''
+    screens = []
+    for frame in frames:
+        h, w = frame.shape[:2]
+        screens.append(dip.crop_square(frame, (0, 0, w, h), min(h, w)))
+
+    ret = {}
+    for model_cat in model_cats or BATCH_MODELS.keys():
+        fn, (width, height) = BATCH_MODELS[model_cat]
+        decide, kwargs = _DECISIONS[model_cat]
+        images = screens if width == height else frames
+
+        new = fn(images, bs, **kwargs)
+
+        letterbox_batch = dip.letterbox_batch
+        dip.letterbox_batch = _resize_letterbox_batch
+        try:
+            old = fn(images, bs, **kwargs)
+        finally:
+            dip.letterbox_batch = letterbox_batch
+
+        ret[model_cat] = float(np.mean([decide(a) == decide(b) for a, b in zip(old, new)]))
+
+    return ret
+
+
+def _sample_frames(videos: List[str], count: int) -> List[np.ndarray]:
+    from utility.video import Video
+
+    ret = []
+    for video_path in videos:
+        with Video(video_path) as video:
+            for pos in np.linspace(0, video.frame_count() - 1, max(1, count // len(videos)), dtype=int):
+                video.seek_to(int(pos))
+                frame = video.read()
+                if frame is not None:
+                    ret.append(frame)
+
+    return ret
+
+
+def _is_out_of_memory(e: Exception) -> bool:
+    return isinstance(e, MemoryError) or 'out of memory' in str(e)
+
+
+def bench_batch_sizes(model_cat: str, frames: Optional[List[np.ndarray]] = None,
+                      candidates: Tuple[int, ...] = BATCH_SIZE_CANDIDATES, batches: int = 4,
+                      repeat: int = 3) -> List[Tuple[int, float, float]]:
+    '''
+    the throughput curve of a model in batch_info, returns (bs, images per second, ms
+    per batch) of the candidates until the host runs out of memory. every candidate
+    runs `batches` batches, the frames (e.g. from a recording) are reused if there are
+    not enough of them
+    '''
+    fn, frame_size = BATCH_MODELS[model_cat]
+    if frames is None:
+        frames = _smooth_frames(frame_size, 8)
+
+    ret = []
+    for bs in candidates:
+        images = [frames[i % len(frames)] for i in range(bs * batches)]
+        try:
+            cost = _timeit(lambda: fn(images, bs), repeat)
+        except (RuntimeError, MemoryError) as e:
+            if not _is_out_of_memory(e):
+                raise
+            print(f'{model_cat}: out of memory at batch size {bs}')
+            break
+
+        ret.append((bs, 1000 * len(images) / cost, cost / batches))
+
+    return ret
+
+
+def best_batch_size(curve: List[Tuple[int, float, float]], tolerance: float = BATCH_SIZE_TOLERANCE) -> int:
+    '''
+    the smallest batch size whose throughput is within tolerance of the best one
+    '''
+    best_throughput = max(throughput for _, throughput, _ in curve)
+    return min(bs for bs, throughput, _ in curve if throughput >= (1 - tolerance) * best_throughput)
+
+
+def tune_batch_sizes(model_cats: Optional[List[str]] = None,
+                     frames: Optional[List[np.ndarray]] = None) -> Dict[str, List[Tuple[int, float, float]]]:
+    '''
+    benchmarks the models, saves the best batch sizes to config.json and returns the curves
+    '''
+    curves = {}
+    for model_cat in model_cats or BATCH_MODELS.keys():
+        curve = bench_batch_sizes(model_cat, frames)
+        if not curve:
+            continue
+
+        curves[model_cat] = curve
+        utility.config.update_batch_info(model_cat, best_batch_size(curve))
+
+    utility.config.save_config()
+
+    return curves
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--tune-batch-sizes', action='store_true')
+    parser.add_argument('--models', nargs='+', choices=BATCH_MODELS.keys(), help='models to tune, all by default')
+    parser.add_argument('--agreement', nargs='+', metavar='VIDEO', help='recordings to sample frames from')
+    parser.add_argument('--frames', type=int, default=200, help='frames sampled for --agreement')
+    args = parser.parse_args()
+
+    if args.tune_batch_sizes:
+        import os
+        import torch
+
+        device = f'cuda ({torch.cuda.get_device_name()})' if torch.cuda.is_available() else 'cpu'
+        print(f'tuning batch sizes on {device}, {torch.get_num_threads()} threads, {os.cpu_count()} cores')
+
+        for model_cat, curve in tune_batch_sizes(args.models).items():
+            best = utility.config.get_batch_info()[model_cat]
+            print(f'{model_cat}: batch size {best}')
+            for bs, throughput, cost in curve:
+                print(f'  {bs:3}: {throughput:8.1f} img/s, {cost:8.2f}ms/batch{"  *" if bs == best else ""}')
+    elif args.agreement:
+        frames = _sample_frames(args.agreement, args.frames)
+        print(f'decision agreement of letterbox_batch() with resize() on {len(frames)} frames')
+        for model_cat, agreement in bench_agreement(frames, args.batch_size, args.models).items():
+            print(f'{model_cat}: {100 * agreement:.2f}%')
+    else:
+        print(f'letterbox {args.batch_size} frames of {args.width}x{args.height}')
+        for size, old_cost, new_cost, diff, max_diff in bench_letterbox((args.width, args.height), args.batch_size,
+                                                                         repeat=args.repeat):
+            print(f'{size:4}: resize {old_cost:8.2f}ms, letterbox_batch {new_cost:8.2f}ms '
+                  f'({old_cost / new_cost:.1f}x), abs diff mean {diff:.2f} max {max_diff}')
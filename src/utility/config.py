@@ -1,7 +1,7 @@
 import os
 from pathlib import Path
 import json
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 # 获取config文件中的内容
 
@@ -201,24 +201,343 @@ def update_fog_weight(weight: str) -> None:
 
 
 def get_batch_info() -> dict:
+    '''
+    the batch sizes of the models ('detection' is the screen detection), can be tuned
+    for the host by python -m utility.bench --tune-batch-sizes
+    '''
     global loaded_config
 
-    if 'batch_info' in loaded_config:
-        return loaded_config['batch_info']
-    else:
-        loaded_config['batch_info'] = {
-            'detection': 2,
-            'state_test': 32,
-            'broken_test': 32,
-            'segmentation': 1
-        }
-        return loaded_config['batch_info']
+    batch_info = loaded_config.setdefault('batch_info', {})
+    # 旧的配置文件中没有 fog_detection，与屏幕检测一致
+    for model_cat, bs in (('detection', 2), ('fog_detection', batch_info.get('detection', 2)),
+                          ('state_test', 32), ('broken_test', 32), ('segmentation', 1)):
+        batch_info.setdefault(model_cat, bs)
+
+    return batch_info
 
 
 def update_batch_info(model_cat, bs) -> None:
+    get_batch_info()[model_cat] = bs
+
+
+def get_prefetch_depth() -> int:
+    global loaded_config
+
+    if 'prefetch_depth' in loaded_config:
+        return loaded_config['prefetch_depth']
+    else:
+        return 16
+
+
+def update_prefetch_depth(depth: int) -> None:
+    global loaded_config
+
+    loaded_config['prefetch_depth'] = depth
+
+
+def get_decode_backend() -> str:
+    global loaded_config
+
+    if 'decode_backend' in loaded_config:
+        return loaded_config['decode_backend']
+    else:
+        return 'opencv'
+
+
+def update_decode_backend(backend: str) -> None:
+    global loaded_config
+
+    loaded_config['decode_backend'] = backend
+
+
+def get_decode_threads() -> int:
+    global loaded_config
+
+    if 'decode_threads' in loaded_config:
+        return loaded_config['decode_threads']
+    else:
+        return 0
+
+
+def get_working_width() -> int:
+    global loaded_config
+
+    if 'working_width' in loaded_config:
+        return loaded_config['working_width']
+    else:
+        return 0
+
+
+def update_working_width(width: int) -> None:
+    global loaded_config
+
+    loaded_config['working_width'] = width
+
+
+def get_adaptive_sampling() -> bool:
+    global loaded_config
+
+    if 'adaptive_sampling' in loaded_config:
+        return loaded_config['adaptive_sampling']
+    else:
+        return False
+
+
+def update_adaptive_sampling(adaptive: bool) -> None:
+    global loaded_config
+
+    loaded_config['adaptive_sampling'] = adaptive
+
+
+def get_motion_gate_threshold() -> float:
+    global loaded_config
+
+    if 'motion_gate_threshold' in loaded_config:
+        return loaded_config['motion_gate_threshold']
+    else:
+        return 0.0
+
+
+def update_motion_gate_threshold(threshold: float) -> None:
+    global loaded_config
+
+    loaded_config['motion_gate_threshold'] = threshold
+
+
+def get_motion_gate_max_stale() -> int:
+    global loaded_config
+
+    if 'motion_gate_max_stale' in loaded_config:
+        return loaded_config['motion_gate_max_stale']
+    else:
+        return 9
+
+
+def update_motion_gate_max_stale(max_stale: int) -> None:
+    global loaded_config
+
+    loaded_config['motion_gate_max_stale'] = max_stale
+
+
+def get_live_idle_timeout() -> float:
+    global loaded_config
+
+    if 'live_idle_timeout' in loaded_config:
+        return loaded_config['live_idle_timeout']
+    else:
+        return 60.0
+
+
+def update_live_idle_timeout(timeout: float) -> None:
+    global loaded_config
+
+    loaded_config['live_idle_timeout'] = timeout
+
+
+def get_live_streams() -> int:
+    '''
+    the number of live streams examined at the same time. they run in their own
+    examine process (with its own models), so a stream that never ends does not hold
+    the slots of the recorded videos, more streams are refused. 0 disables them
+    '''
+    global loaded_config
+
+    if 'live_streams' in loaded_config:
+        return loaded_config['live_streams']
+    else:
+        return 1
+
+
+def update_live_streams(count: int) -> None:
+    global loaded_config
+
+    loaded_config['live_streams'] = count
+
+
+def get_examine_workers() -> int:
+    '''
+    the number of examine processes, every process keeps its own models
+    '''
+    global loaded_config
+
+    if 'examine_workers' in loaded_config:
+        return loaded_config['examine_workers']
+    else:
+        return 1
+
+
+def update_examine_workers(count: int) -> None:
+    global loaded_config
+
+    loaded_config['examine_workers'] = count
+
+
+def get_examine_threads() -> int:
+    '''
+    torch and OpenCV threads of every examine process, 0 splits the cores evenly
+    among the processes (or keeps the library defaults with a single process)
+    '''
+    global loaded_config
+
+    if 'examine_threads' in loaded_config:
+        return loaded_config['examine_threads']
+    else:
+        return 0
+
+
+def update_examine_threads(count: int) -> None:
+    global loaded_config
+
+    loaded_config['examine_threads'] = count
+
+
+def get_warmup_video_types() -> List[str]:
+    '''
+    the models of these video types are loaded and warmed up when an examine process starts
+    '''
     global loaded_config
 
-    loaded_config['batch_info'][model_cat] = bs
+    if 'warmup_video_types' in loaded_config:
+        return loaded_config['warmup_video_types']
+    else:
+        return ['tv', 'fog']
+
+
+def update_warmup_video_types(video_types: List[str]) -> None:
+    global loaded_config
+
+    loaded_config['warmup_video_types'] = video_types
+
+
+def get_parallel_videos() -> int:
+    '''
+    the number of videos examined at the same time by the examine process, their
+    model calls are batched together by the inference server if it is greater than 1
+    '''
+    global loaded_config
+
+    if 'parallel_videos' in loaded_config:
+        return loaded_config['parallel_videos']
+    else:
+        return 1
+
+
+def update_parallel_videos(count: int) -> None:
+    global loaded_config
+
+    loaded_config['parallel_videos'] = count
+
+
+def get_inference_max_batch() -> int:
+    global loaded_config
+
+    if 'inference_max_batch' in loaded_config:
+        return loaded_config['inference_max_batch']
+    else:
+        return 16
+
+
+def update_inference_max_batch(bs: int) -> None:
+    global loaded_config
+
+    loaded_config['inference_max_batch'] = bs
+
+
+def get_inference_max_delay() -> float:
+    '''
+    how long (in seconds) a model request waits for others to join its batch
+    '''
+    global loaded_config
+
+    if 'inference_max_delay' in loaded_config:
+        return loaded_config['inference_max_delay']
+    else:
+        return 0.01
+
+
+def update_inference_max_delay(delay: float) -> None:
+    global loaded_config
+
+    loaded_config['inference_max_delay'] = delay
+
+
+def get_derived_image_cache_mb() -> int:
+    global loaded_config
+
+    if 'derived_image_cache_mb' in loaded_config:
+        return loaded_config['derived_image_cache_mb']
+    else:
+        return 64
+
+
+def update_derived_image_cache_mb(size: int) -> None:
+    global loaded_config
+
+    loaded_config['derived_image_cache_mb'] = size
+
+
+def get_inference_backend(model_name: str) -> str:
+    '''
+    'torch', 'onnx' or 'torchscript', model_name is one of 'state', 'valid', 'broken', 'segment' and 'fog'
+    '''
+    global loaded_config
+
+    if 'inference_backends' in loaded_config and model_name in loaded_config['inference_backends']:
+        return loaded_config['inference_backends'][model_name]
+    else:
+        return 'torch'
+
+
+def update_inference_backend(model_name: str, backend: str) -> None:
+    global loaded_config
+
+    loaded_config.setdefault('inference_backends', {})[model_name] = backend
+
+
+def get_quantization(model_name: str) -> str:
+    '''
+    'none', 'dynamic' or 'static' (INT8 by ONNX Runtime), model_name is one of
+    'state', 'valid', 'broken' and 'segment'
+    '''
+    global loaded_config
+
+    if 'quantization' in loaded_config and model_name in loaded_config['quantization']:
+        return loaded_config['quantization'][model_name]
+    else:
+        return 'none'
+
+
+def update_quantization(model_name: str, mode: str) -> None:
+    global loaded_config
+
+    loaded_config.setdefault('quantization', {})[model_name] = mode
+
+
+def get_onnx_threads() -> Tuple[int, int]:
+    '''
+    (intra-op threads, inter-op threads) of ONNX Runtime, 0 means the default of
+    ONNX Runtime (the number of physical cores)
+    '''
+    global loaded_config
+
+    return loaded_config.get('onnx_intra_threads', 0), loaded_config.get('onnx_inter_threads', 1)
+
+
+def update_onnx_threads(intra_threads: int, inter_threads: int) -> None:
+    global loaded_config
+
+    loaded_config['onnx_intra_threads'] = intra_threads
+    loaded_config['onnx_inter_threads'] = inter_threads
+
+
+def get_video_meta_file() -> str:
+    return str(__data_dir / 'video_meta.json')
+
+
+def get_video_index_dir() -> str:
+    index_dir = __data_dir / 'video_index'
+    index_dir.mkdir(exist_ok=True)
+    return str(index_dir)
 
 
 def get_html_template_file() -> str:
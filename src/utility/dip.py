@@ -3,6 +3,8 @@ import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import cv2
 import math
+import functools
+import threading
 import torch
 import torchvision
 import torchvision.transforms as transforms
@@ -93,6 +95,62 @@ def resize(image: Union[Image.Image, np.ndarray], height: int, width: int, resam
     return _resize_Image(image, height, width)
 
 
+# 与 resize() 一致，放大时使用双三次插值；缩小时使用 INTER_AREA，它与 PIL 带抗锯齿的双三次缩小
+# 最接近（python -m utility.bench 给出像素差异与各模型判定的一致率）
+_CV2_UPSCALE_INTERPOLATION = cv2.INTER_CUBIC
+_CV2_DOWNSCALE_INTERPOLATION = cv2.INTER_AREA
+
+# letterbox_batch 复用的输出缓冲区，按线程与 (height, width) 区分
+_letterbox_buffers = threading.local()
+
+
+def letterbox_buffer(n: int, height: int, width: int) -> np.ndarray:
+    '''
+    a uint8 buffer of shape (n, height, width, 3) which is reused by the next call,
+    the contents must be consumed before that
+    '''
+    buffers = _letterbox_buffers.__dict__
+    buffer = buffers.get((height, width))
+    if buffer is None or buffer.shape[0] < n:
+        buffer = np.empty((n, height, width, 3), dtype=np.uint8)
+        buffers[(height, width)] = buffer
+
+    return buffer[:n]
+
+
+def letterbox_batch(images: List[np.ndarray], height: int, width: int, resample='cubic',
+                    out: Optional[np.ndarray] = None) -> Tuple[List[float], np.ndarray]:
+    '''
+    the batched resize() for BGR images: every image is scaled to fit (height, width)
+    and written to the top-left corner of out[i], the rest is zero. returns the scales
+    and the (n, height, width, 3) batch, out is allocated if it is None. like resize(),
+    resample is not used, the models always got bicubic inputs
+    '''
+    if out is None:
+        out = np.empty((len(images), height, width, 3), dtype=np.uint8)
+
+    scales = []
+    for image, dest in zip(images, out):
+        h, w = image.shape[:2]
+        scale = min(height / h, width / w)
+        dest_height, dest_width = min(_int(h * scale), height), min(_int(w * scale), width)
+
+        interpolation = _CV2_DOWNSCALE_INTERPOLATION if scale < 1 else _CV2_UPSCALE_INTERPOLATION
+        cv2.resize(image, (dest_width, dest_height), dst=dest[:dest_height, :dest_width], interpolation=interpolation)
+
+        dest[dest_height:] = 0
+        dest[:dest_height, dest_width:] = 0
+
+        scales.append(scale)
+
+    return scales, out
+
+
+def letterbox(image: np.ndarray, height: int, width: int, resample='cubic') -> Tuple[float, np.ndarray]:
+    scales, out = letterbox_batch([image], height, width, resample)
+    return scales[0], out[0]
+
+
 def rectangle(image: np.ndarray, points, color=(255, 255, 255), thickness=1) -> np.ndarray:
     l, t, r, b = [int(round(i)) for i in points]
     # l, t, r, b = round(l), round(t), round(r), round(b)
@@ -205,6 +263,39 @@ def stack_images(images: List[np.ndarray]) -> np.ndarray:
     return np.stack(images)
 
 
+# 多个视频并行检测时合并各模型请求的推理服务（见 utility.inference_server）
+_inference_server = None
+
+
+def set_inference_server(server) -> None:
+    global _inference_server
+
+    _inference_server = server
+
+
+def _served(model_name: str):
+    '''
+    routes the calls of a *_with_batch function to the inference server if it is set,
+    the server thread runs the function itself
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(images, bs, *args, **kwargs):
+            server = _inference_server
+            if server is None or server.is_serving_thread():
+                return fn(images, bs, *args, **kwargs)
+
+            images = list(images)
+            if len(images) == 0:
+                return []
+
+            return server.run(model_name, fn, images, bs, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 def detect_screen(image: np.ndarray) -> Optional[Tuple[float, float, float, float, float, float]]:
     # from dllibs.yolov5 import yolov5
 
@@ -228,24 +319,21 @@ def detect_screen(image: np.ndarray) -> Optional[Tuple[float, float, float, floa
 
 
 # 使用yolov5模型检测电视机屏幕位置，返回预测的电视机位置坐标
+@_served('screen')
 def detect_screen_with_batch(images: List[np.ndarray], bs: int, conf_thres=0.5) -> List[Optional[Tuple[float, float, float, float, float, float]]]:
     from dllibs.yolov5 import yolov5
 
     yolov5.load_model()
 
-    scales, resized_images = [], []
-    for image in images:
-        scale, resized = resize(image, 640, 640)
-        scales.append(scale)
-        resized_images.append(resized)
+    images = list(images)
+    scales, resized_images = letterbox_batch(images, 640, 640, out=letterbox_buffer(len(images), 640, 640))
 
     ret = []
 
     for i in range(0, len(scales), bs):
         bi, bj = i, i + bs
-        bscales, bimages = scales[bi:bj], resized_images[bi:bj]
+        bscales, arrays = scales[bi:bj], resized_images[bi:bj]
 
-        arrays = stack_images(bimages)
         preds = yolov5.detect(arrays, conf_thres)
         for j, pred in enumerate(preds):
             if pred.shape[0] == 0:
@@ -267,20 +355,20 @@ def detect_screen_with_batch(images: List[np.ndarray], bs: int, conf_thres=0.5)
 
 
 # 使用resnet模型划分屏幕状态：荧光粉
+@_served('state')
 def classify_state_with_batch(images: List[np.ndarray], bs: int):
     from dllibs.state_net import state_resnet
 
     state_resnet.load_model()
 
-    resized_images = [resize(image, 224, 224, 'linear')[1] for image in images]
+    images = list(images)
+    _, resized_images = letterbox_batch(images, 224, 224, 'linear', letterbox_buffer(len(images), 224, 224))
 
     ret = []
 
     for i in range(0, len(resized_images), bs):
         bi, bj = i, i + bs
-        bimages = resized_images[bi:bj]
-
-        arrays = stack_images(bimages)
+        arrays = resized_images[bi:bj]
         preds = state_resnet.classify(arrays)
 
         ret.extend(preds)
@@ -289,6 +377,7 @@ def classify_state_with_batch(images: List[np.ndarray], bs: int):
 
 
 # 利用碎屏检测模型判断是否碎屏
+@_served('valid')
 def classify_broken_with_batch(images: List[np.ndarray], bs: int):
     from dllibs.broken_net import valid_resnet
 
@@ -296,13 +385,12 @@ def classify_broken_with_batch(images: List[np.ndarray], bs: int):
 
     ret = []
 
-    resized_images = [resize(image, 320, 320, 'linear')[1] for image in images]
+    images = list(images)
+    _, resized_images = letterbox_batch(images, 320, 320, 'linear', letterbox_buffer(len(images), 320, 320))
 
     for i in range(0, len(resized_images), bs):
         bi, bj = i, i + bs
-        bimages = resized_images[bi:bj]
-
-        arrays = stack_images(bimages)
+        arrays = resized_images[bi:bj]
         preds = valid_resnet.classify(arrays)
 
         ret.extend(preds)
@@ -310,21 +398,29 @@ def classify_broken_with_batch(images: List[np.ndarray], bs: int):
     return ret
 
 
-def segment_broken_with_batch(images: List[np.ndarray], bs: int):
+@_served('broken')
+def segment_broken_with_batch(images: List[np.ndarray], bs: int, counts_only=False, debug_size: Optional[int] = None):
+    '''
+    the masks, or (foreground pixel count, debug mask or None) of every image if counts_only
+    is True, the counts are reduced on the inference device (see broken_net.segment_counts)
+    '''
     from dllibs.broken_net import broken_net
 
     broken_net.load_model()
 
     ret = []
 
-    resized_images = [resize(image, 512, 512, 'cubic')[1] for image in images]
+    images = list(images)
+    _, resized_images = letterbox_batch(images, 512, 512, 'cubic', letterbox_buffer(len(images), 512, 512))
 
     for i in range(0, len(resized_images), bs):
         bi, bj = i, i + bs
-        bimages = resized_images[bi:bj]
-
-        arrays = stack_images(bimages)
-        preds = broken_net.segment(arrays)
+        arrays = resized_images[bi:bj]
+        if counts_only:
+            counts, debug_masks = broken_net.segment_counts(arrays, debug_size)
+            preds = zip(counts, debug_masks if debug_masks is not None else [None] * len(counts))
+        else:
+            preds = broken_net.segment(arrays)
         # printpreds = preds, np.sum(preds) // 255
         # print(printpreds)
 
@@ -334,21 +430,29 @@ def segment_broken_with_batch(images: List[np.ndarray], bs: int):
 
 
 # 判断是否存在锥屏分离现象
-def segment_cone_with_batch(images: List[np.ndarray], bs: int):
+@_served('segment')
+def segment_cone_with_batch(images: List[np.ndarray], bs: int, counts_only=False, debug_size: Optional[int] = None):
+    '''
+    the masks, or (foreground pixel count, debug mask or None) of every image if counts_only
+    is True, the counts are reduced on the inference device (see seg_net.segment_counts)
+    '''
     from dllibs.seg_net import seg_net
 
     seg_net.load_model()
 
     ret = []
 
-    resized_images = [resize(image, 256, 256, 'cubic')[1] for image in images]
+    images = list(images)
+    _, resized_images = letterbox_batch(images, 256, 256, 'cubic', letterbox_buffer(len(images), 256, 256))
 
     for i in range(0, len(resized_images), bs):
         bi, bj = i, i + bs
-        bimages = resized_images[bi:bj]
-
-        arrays = stack_images(bimages)
-        preds = seg_net.segment(arrays)
+        arrays = resized_images[bi:bj]
+        if counts_only:
+            counts, debug_masks = seg_net.segment_counts(arrays, debug_size)
+            preds = zip(counts, debug_masks if debug_masks is not None else [None] * len(counts))
+        else:
+            preds = seg_net.segment(arrays)
 
         ret.extend(preds)
 
@@ -356,6 +460,7 @@ def segment_cone_with_batch(images: List[np.ndarray], bs: int):
 
 
 # 判断是否存在漏氟
+@_served('fog')
 def detect_fog_with_batch(images: List[np.ndarray], bs: int, conf_thres=0.3) -> List[Optional[Tuple[float, float, float, float, float, float]]]:
     from dllibs.fog_net import fog_net
 
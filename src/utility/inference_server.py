@@ -0,0 +1,146 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class InferenceServer:
+    '''
+    coalesces the requests of the concurrent video pipelines into larger batches. every
+    model has its own thread, a request waits at most max_delay seconds for others to
+    join its batch, and a batch holds at most max_batch images (a single larger request
+    is not split). the requests of a model are run one by one, so the model functions
+    need not be thread safe
+    '''
+    class Request:
+        def __init__(self, fn: Callable, images: list, bs: int, args: tuple, kwargs: dict) -> None:
+            self.fn = fn
+            self.images = images
+            self.bs = bs
+            # 只有参数相同的请求才能合并
+            self.key = (fn, args, tuple(sorted(kwargs.items())))
+            self.args = args
+            self.kwargs = kwargs
+            self.arrival = time.perf_counter()
+            self.future = Future()
+
+    def __init__(self, max_batch: int = 16, max_delay: float = 0.01) -> None:
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        self._queues: Dict[str, List['InferenceServer.Request']] = {}
+        self._threads: Dict[str, threading.Thread] = {}
+        self._closed = False
+
+        self._serving = threading.local()
+
+        # 模型名 -> [请求数, 批次数, 图像数]
+        self._stats: Dict[str, List[int]] = {}
+
+    def is_serving_thread(self) -> bool:
+        return getattr(self._serving, 'model_name', None) is not None
+
+    def submit(self, model_name: str, fn: Callable, images: list, bs: int, *args, **kwargs) -> Future:
+        '''
+        fn(images, bs, *args, **kwargs) returns one result per image, the future holds
+        the results of images
+        '''
+        request = InferenceServer.Request(fn, list(images), bs, args, kwargs)
+
+        with self._cond:
+            assert not self._closed, 'the inference server is closed'
+
+            self._queues.setdefault(model_name, []).append(request)
+            if model_name not in self._threads:
+                thread = threading.Thread(target=self._serve, args=(model_name,), daemon=True)
+                self._threads[model_name] = thread
+                thread.start()
+
+            self._cond.notify_all()
+
+        return request.future
+
+    def run(self, model_name: str, fn: Callable, images: list, bs: int, *args, **kwargs) -> list:
+        return self.submit(model_name, fn, images, bs, *args, **kwargs).result()
+
+    def _take_batch(self, model_name: str) -> Optional[List['InferenceServer.Request']]:
+        '''
+        waits for the first request, then for more requests with the same arguments
+        until the batch is full or the deadline of the first one passes
+        '''
+        queue = self._queues[model_name]
+
+        with self._cond:
+            while not queue and not self._closed:
+                self._cond.wait()
+
+            if not queue:
+                return None
+
+            first = queue[0]
+            deadline = first.arrival + self.max_delay
+
+            while True:
+                batch = [request for request in queue if request.key == first.key]
+                size = sum(len(request.images) for request in batch)
+                remaining = deadline - time.perf_counter()
+                if size >= self.max_batch or remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+
+            taken, size = [], 0
+            for request in batch:
+                if taken and size + len(request.images) > self.max_batch:
+                    break
+                taken.append(request)
+                size += len(request.images)
+
+            for request in taken:
+                queue.remove(request)
+
+            return taken
+
+    def _serve(self, model_name: str) -> None:
+        self._serving.model_name = model_name
+        stats = self._stats.setdefault(model_name, [0, 0, 0])
+
+        while True:
+            batch = self._take_batch(model_name)
+            if batch is None:
+                break
+
+            first = batch[0]
+            images = [image for request in batch for image in request.images]
+            # 合并后的批次一次前向，但不小于请求本身的批大小
+            bs = max(max(request.bs for request in batch), min(len(images), self.max_batch))
+
+            try:
+                results = first.fn(images, bs, *first.args, **first.kwargs)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            i = 0
+            for request in batch:
+                request.future.set_result(results[i: i + len(request.images)])
+                i += len(request.images)
+
+            stats[0] += len(batch)
+            stats[1] += 1
+            stats[2] += len(images)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        for thread in list(self._threads.values()):
+            thread.join()
+
+    def report(self) -> str:
+        return ', '.join(
+            f'{model_name}: {requests} requests in {batches} batches ({images / max(batches, 1):.1f} images/batch)'
+            for model_name, (requests, batches, images) in self._stats.items()
+        )
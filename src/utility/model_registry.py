@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+
+import utility.config
+from utility import dip
+
+# batch_info 中的模型 -> (批量推理函数, 输入图像的大小)，屏幕类模型的输入是裁剪出的屏幕
+MODELS = {
+    'detection': (dip.detect_screen_with_batch, (1920, 1080)),
+    'fog_detection': (dip.detect_fog_with_batch, (1920, 1080)),
+    'state_test': (dip.classify_state_with_batch, (600, 600)),
+    'broken_test': (dip.segment_broken_with_batch, (1920, 1080)),
+    'segmentation': (dip.segment_cone_with_batch, (600, 600)),
+}
+
+# 各检测类型用到的模型
+MODELS_OF_VIDEO_TYPE = {
+    'tv': ('detection', 'state_test', 'broken_test', 'segmentation'),
+    'fog': ('fog_detection',),
+    'tv+fog': ('detection', 'state_test', 'broken_test', 'segmentation', 'fog_detection'),
+}
+
+COLD = 'cold'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class ModelRegistry:
+    '''
+    loads the models concurrently and runs a dummy batch through each of them (which
+    also initializes cudnn and the allocators), so the first video does not pay for
+    the cold start. the state of every model is 'cold', 'loading', 'ready' or 'failed'
+    '''
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._states: Dict[str, str] = {model_cat: COLD for model_cat in MODELS}
+        self._threads: Dict[str, threading.Thread] = {}
+        # 加载与预热的耗时（秒）
+        self._costs: Dict[str, float] = {}
+
+    def _warm_up_one(self, model_cat: str) -> None:
+        fn, (width, height) = MODELS[model_cat]
+        bs = utility.config.get_batch_info()[model_cat]
+
+        start_time = time.perf_counter()
+        try:
+            fn([np.zeros((height, width, 3), dtype=np.uint8)] * bs, bs)
+        except Exception as e:
+            print(f'failed to warm up {model_cat}: {e}')
+            state = FAILED
+        else:
+            state = READY
+
+        with self._lock:
+            self._states[model_cat] = state
+            self._costs[model_cat] = time.perf_counter() - start_time
+
+    def warm_up(self, model_cats: Iterable[str] = MODELS.keys(), wait: bool = True) -> None:
+        '''
+        starts warming up the cold models, waits for them if wait is True
+        '''
+        model_cats = list(model_cats)
+
+        with self._lock:
+            for model_cat in model_cats:
+                if self._states[model_cat] != COLD:
+                    continue
+
+                self._states[model_cat] = LOADING
+                thread = threading.Thread(target=self._warm_up_one, args=(model_cat,), daemon=True)
+                self._threads[model_cat] = thread
+                thread.start()
+
+        if wait:
+            self.wait(model_cats)
+
+    def wait(self, model_cats: Iterable[str] = MODELS.keys(), timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for model_cat in model_cats:
+            thread = self._threads.get(model_cat)
+            if thread is not None:
+                thread.join(None if deadline is None else max(0.0, deadline - time.perf_counter()))
+
+        return self.is_ready(model_cats)
+
+    def is_ready(self, model_cats: Iterable[str] = MODELS.keys()) -> bool:
+        with self._lock:
+            return all(self._states[model_cat] == READY for model_cat in model_cats)
+
+    def states(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._states)
+
+    def report(self) -> str:
+        with self._lock:
+            return ', '.join(
+                f'{model_cat} {state}' + (f' in {self._costs[model_cat]:.1f}s' if model_cat in self._costs else '')
+                for model_cat, state in self._states.items()
+            )
+
+
+def models_of(video_types: Iterable[str]) -> List[str]:
+    '''
+    the models used by the video types, e.g. ['tv', 'fog']
+    '''
+    ret = []
+    for video_type in video_types:
+        for model_cat in MODELS_OF_VIDEO_TYPE[video_type]:
+            if model_cat not in ret:
+                ret.append(model_cat)
+
+    return ret
+
+
+# 进程内唯一的模型注册表
+registry = ModelRegistry()
@@ -1,6 +1,12 @@
 from datetime import datetime
 import enum
-from typing import Callable, List, Optional, Tuple, Any
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, Any
+import cv2
 import numpy as np
 
 from .tools import index_of_first, index_of_last, max_seq_len, max_seq_len_with_torlenance
@@ -14,8 +20,14 @@ from .dip import (
     detect_fog_with_batch
 )
 
-from .video import Video
-from .config import get_batch_info
+from .video import Video, LiveVideo
+from .config import (
+    get_batch_info,
+    get_prefetch_depth,
+    get_motion_gate_threshold,
+    get_motion_gate_max_stale,
+    get_derived_image_cache_mb
+)
 
 # 每秒优先检测帧数
 SCREEN_DETECTION_FREQUENCY = 3
@@ -28,6 +40,10 @@ FOG_DETECTION_TAIL_TIME = 6
 # 关键工序最短时长
 SCREEN_DETECTION_MINIMUM_DURATION = 6
 FOG_DETECTION_MINIMUM_DURATION = 2
+# 自适应采样时，工序之外每秒检测帧数
+IDLE_DETECTION_FREQUENCY = 0.5
+# 运动门限比较帧差时使用的缩略图宽度
+MOTION_GATE_THUMBNAIL_WIDTH = 64
 # Section 临界帧数量，超过该帧数则先返回部分 Section
 SCREEN_DETECTION_CACHE_MAXIMUM = 30 * SCREEN_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO
 FOG_DETECTION_CACHE_MAXIMUM = 30 * FOG_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO
@@ -39,7 +55,12 @@ SCREEN_DETECTION_BATCH_SIZE = get_batch_info()['detection']
 PHOSPHOR_DETECTION_BATCH_SIZE = get_batch_info()['state_test']
 BROKEN_DETECTION_BATCH_SIZE = get_batch_info()['broken_test']
 CONE_DETECTION_BATCH_SIZE = get_batch_info()['segmentation']
-FOG_DETECTION_BATCH_SIZE = get_batch_info()['detection']
+FOG_DETECTION_BATCH_SIZE = get_batch_info()['fog_detection']
+
+# 分割模型只返回前景像素数，调试时附带缩小后的掩膜
+SEGMENTATION_DEBUG_MASK_SIZE = 128
+# 工序末尾连续碎屏帧数达到该值即判定为碎屏
+BROKEN_THRESHOLD = 9
 
 
 class FRAME_TAG(enum.Enum):
@@ -48,77 +69,550 @@ class FRAME_TAG(enum.Enum):
     DETECT_LATER = 2
 
 
-# 获取视频帧并返回
-class FrameFilter:
-    def __init__(self, video_path: str, set_end_flag: bool = False, video_type='tv',
-                 detector: Callable[[FRAME_TAG, int, np.ndarray, float], None] = None) -> None:
+# 按检测频率为每一帧打标签
+class FrameSampler:
+    def __init__(self, computed_fps: float, video_type='tv', adaptive: bool = False) -> None:
+        '''
+        if adaptive is True, the sampler starts idle, an idle sampler only tags the
+        frames at IDLE_DETECTION_FREQUENCY, see set_idle()
+        '''
+        frequency = SCREEN_DETECTION_FREQUENCY if video_type == 'tv' else FOG_DETECTION_FREQUENCY
+        self.detect_gap_frames = round(computed_fps / frequency)
+        self.undetect_gap_frames = round(self.detect_gap_frames / DIAGNOSIS_MAGNIFICATION_RATIO)
+
+        # 空闲检测间隔取全速检测间隔的整数倍，使空闲时检测的帧也是全速检测的帧
+        self.idle_gap_frames = self.detect_gap_frames * max(int(round(frequency / IDLE_DETECTION_FREQUENCY)), 1)
+
+        self.adaptive = adaptive
+        self.idle = adaptive
+
+        # 空闲时未检测的帧数
+        self.idle_skipped = 0
+
+    def set_idle(self, idle: bool) -> None:
+        if self.adaptive:
+            self.idle = idle
+
+    def sampled_count(self, frame_count: int) -> int:
+        return (frame_count // self.detect_gap_frames) * DIAGNOSIS_MAGNIFICATION_RATIO
+
+    def tag(self, idx: int) -> FRAME_TAG:
+        tag = self.full_rate_tag(idx)
+
+        if self.idle and tag != FRAME_TAG.IGNORED:
+            if tag == FRAME_TAG.SHOULD_DETECT and (idx - 1) % self.idle_gap_frames == 0:
+                return tag
+
+            self.idle_skipped += 1
+            return FRAME_TAG.IGNORED
+
+        return tag
+
+    def full_rate_tag(self, idx: int) -> FRAME_TAG:
+        reminder = (idx - 1) % self.detect_gap_frames
+
+        if reminder == 0:
+            return FRAME_TAG.SHOULD_DETECT
+        elif (reminder % self.undetect_gap_frames == 0 and
+              reminder // self.undetect_gap_frames < DIAGNOSIS_MAGNIFICATION_RATIO):
+            return FRAME_TAG.DETECT_LATER
+        else:
+            return FRAME_TAG.IGNORED
+
+
+# 只解码一次视频，并将帧分发给不同检测频率的采样器
+class SharedFrameSource:
+    def __init__(self, video_path: str, video_types: List[str], set_end_flag: bool = False,
+                 skip_decode: bool = False, working_width: int = 0, adaptive: bool = False,
+                 live: bool = False) -> None:
+        '''
+        yields (tags, idx, msec, frame) where tags[i] is the tag given by the sampler
+        of video_types[i], a frame is yielded if any sampler does not ignore it. if
+        skip_decode is True, the frames ignored by all samplers are only grabbed. if
+        working_width is positive and smaller than the width of the video, the frames
+        are decoded to this width (working_scale is the ratio to the source). if
+        adaptive is True, the samplers are driven by the feedback() channels. if live
+        is True, video_path is a stream or a directory of recorded segments (see
+        LiveVideo), the frames can not be read again so working_width and adaptive
+        are ignored
+        '''
         self.video_path = video_path
-        self.video = Video(self.video_path)
+        self.live = live
+        self.video = LiveVideo(self.video_path) if live else Video(self.video_path)
+
+        if live:
+            working_width, adaptive = 0, False
+
+        self.working_scale = 1.0
+        self.working_size = None
+        source_width, source_height = self.video.source_size()
+        if 0 < working_width < source_width:
+            self.working_scale = working_width / source_width
+            self.working_size = (working_width, int(round(source_height * self.working_scale)))
+
+            self.video.close()
+            self.video = Video(self.video_path, size=self.working_size)
+
         self.fps = self.video.fps()
         self.computed_fps = self.video.computed_fps()
 
-        computed_fps = self.computed_fps
-        if video_type == 'tv':
-            self.detect_gap_frames = round(computed_fps / SCREEN_DETECTION_FREQUENCY)
-        else:
-            self.detect_gap_frames = round(computed_fps / FOG_DETECTION_FREQUENCY)
-        self.undetect_gap_frames = round(self.detect_gap_frames / DIAGNOSIS_MAGNIFICATION_RATIO)
+        self.samplers = [FrameSampler(self.computed_fps, video_type, adaptive) for video_type in video_types]
+        self._backfill_video: Optional[Video] = None
 
         self.set_end_flag = set_end_flag
 
         self.idx = -1
 
-        self.detector = detector
+        self.skip_decode = skip_decode
+        # 解码统计：完整解码的帧数与仅跳过（grab）的帧数
+        self.decoded_frames = 0
+        self.skipped_frames = 0
 
     def close(self) -> None:
         self.video.close()
 
+        if self._backfill_video is not None:
+            self._backfill_video.close()
+            self._backfill_video = None
+
+    def feedback(self, sampler_idx: int = 0) -> 'SamplerFeedback':
+        return SamplerFeedback(self, self.samplers[sampler_idx])
+
+    def backfill(self, sampler: FrameSampler, after_idx: int, before_idx: int) -> List[Tuple[FRAME_TAG, int, float, np.ndarray]]:
+        '''
+        reads again the frames in (after_idx, before_idx) which are tagged by the sampler
+        at full rate, the frames are read by another video so the decoding is not disturbed
+        '''
+        wanted = []
+        for idx in range(max(after_idx + 1, 0), before_idx):
+            tag = sampler.full_rate_tag(idx)
+            if tag != FRAME_TAG.IGNORED:
+                wanted.append((tag, idx))
+
+        if not wanted:
+            return []
+
+        if self._backfill_video is None:
+            self._backfill_video = Video(self.video_path, size=self.working_size)
+
+        video = self._backfill_video
+        video.seek_to(wanted[0][1])
+
+        ret = []
+        for tag, idx in wanted:
+            video.advance_to(idx)
+            frame = video.read()
+            if frame is None:
+                break
+            ret.append((tag, idx, 1000 * float(idx) / self.fps, frame))
+
+        return ret
+
     def video_total_time(self) -> float:
         return self.video.frame_count() / self.computed_fps
 
-    def __len__(self) -> int:
-        return (self.video.frame_count() // self.detect_gap_frames) * DIAGNOSIS_MAGNIFICATION_RATIO
+    def frame_count(self) -> int:
+        return self.video.frame_count()
 
-    def __iter__(self):
+    def __len__(self) -> int:
+        return max(sampler.sampled_count(self.video.frame_count()) for sampler in self.samplers)
+
+    def decode_savings(self) -> float:
+        '''
+        the ratio of frames which are skipped without decoding
+        '''
+        total = self.decoded_frames + self.skipped_frames
+        return self.skipped_frames / total if total > 0 else 0.0
+
+    def decode_report(self) -> str:
+        return (f'{self.video_path}: decoded {self.decoded_frames}, skipped {self.skipped_frames} '
+                f'({100 * self.decode_savings():.1f}% saved)')
+
+    def _decode(self):
+        '''
+        yields (tags, idx, msec, frame) for every frame, including the ignored ones
+        '''
         while True:
-            reminder = self.idx % self.detect_gap_frames
-
-            if self.detector is not None:
-                start_time = datetime.now()
-
             self.idx += 1
-            frame = self.video.read()
+            tags = tuple(sampler.tag(self.idx) for sampler in self.samplers)
+
+            # 被所有采样器忽略的帧只前进不解码
+            if self.skip_decode and all(tag == FRAME_TAG.IGNORED for tag in tags):
+                frame = None
+                has_frame = self.video.grab()
+                if has_frame:
+                    self.skipped_frames += 1
+            else:
+                frame = self.video.read()
+                has_frame = frame is not None
+                if has_frame:
+                    self.decoded_frames += 1
             # msec = self.video.pos_mesc()
             msec = 1000 * float(self.idx) / self.fps
 
-            if self.detector is not None:
-                frame_read_time = (datetime.now() - start_time).total_seconds()
-
-            if frame is None:
-                if self.set_end_flag:
-                    yield None, -1, None, None
+            if not has_frame:
+                if self.skip_decode:
+                    logging.info(self.decode_report())
 
                 return
 
-            if reminder == 0:
+            yield tags, self.idx, msec, frame
 
-                if self.detector is not None:
-                    self.detector(FRAME_TAG.SHOULD_DETECT, self.idx, frame, frame_read_time)
+    def __iter__(self):
+        for tags, idx, msec, frame in self._decode():
+            if any(tag != FRAME_TAG.IGNORED for tag in tags):
+                yield tags, idx, msec, frame
 
-                yield FRAME_TAG.SHOULD_DETECT, self.idx, msec, frame
+        if self.set_end_flag:
+            yield None, -1, None, None
 
-            elif (reminder % self.undetect_gap_frames == 0 and
-                  reminder // self.undetect_gap_frames < DIAGNOSIS_MAGNIFICATION_RATIO):
 
-                if self.detector is not None:
-                    self.detector(FRAME_TAG.DETECT_LATER, self.idx, frame, frame_read_time)
+# Sectionalizer 向采样器反馈工序状态：工序外降低采样率，进入工序时补齐跳过的帧
+class SamplerFeedback:
+    def __init__(self, frame_source: SharedFrameSource, sampler: FrameSampler) -> None:
+        self.frame_source = frame_source
+        self.sampler = sampler
 
-                yield FRAME_TAG.DETECT_LATER, self.idx, msec, frame
+        self.backfilled = 0
 
-            else:
+    def set_idle(self, idle: bool) -> None:
+        self.sampler.set_idle(idle)
 
-                if self.detector is not None:
-                    self.detector(FRAME_TAG.IGNORED, self.idx, frame, frame_read_time)
+    def backfill(self, after_idx: int, before_idx: int) -> List[Tuple[FRAME_TAG, int, float, np.ndarray]]:
+        frames = self.frame_source.backfill(self.sampler, after_idx, before_idx)
+        self.backfilled += len(frames)
+        return frames
+
+    def report(self) -> str:
+        return f'adaptive sampling: {self.sampler.idle_skipped} frames skipped while idle, {self.backfilled} backfilled'
+
+
+# 按帧号从原视频中读取全分辨率的帧（用于缩小解码时的关键帧）
+class KeyFrameLoader:
+    def __init__(self, video_path: str) -> None:
+        self.video_path = video_path
+        self._video: Optional[Video] = None
+
+    def load(self, frame_no: int) -> Optional[np.ndarray]:
+        if self._video is None:
+            self._video = Video(self.video_path)
+
+        self._video.seek_to(frame_no)
+        return self._video.read()
+
+    def close(self) -> None:
+        if self._video is not None:
+            self._video.close()
+            self._video = None
+
+
+# 在后台线程中提前解码并打标签，通过有界队列把帧交给检测流程
+class FramePrefetcher:
+    _END = object()
+
+    def __init__(self, frame_source, depth: Optional[int] = None) -> None:
+        '''
+        iterates frame_source in a background thread, at most depth items are decoded
+        ahead, the decoder blocks when the queue is full (backpressure)
+        '''
+        self.frame_source = frame_source
+        self.depth = get_prefetch_depth() if depth is None else depth
+        assert self.depth > 0, f'invalid prefetch depth {self.depth}'
+
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+        # 队列指标：解码线程因队列满而等待的时间说明检测是瓶颈，
+        # 检测流程因队列空而等待的时间说明解码是瓶颈
+        self.produced = 0
+        self.consumed = 0
+        self.decoder_blocked_time = 0.0
+        self.consumer_starved_time = 0.0
+        self._depth_sum = 0
+        self.max_queue_depth = 0
+
+    def __len__(self) -> int:
+        return len(self.frame_source)
+
+    def _put(self, item) -> bool:
+        start_time = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                self.decoder_blocked_time += time.perf_counter() - start_time
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _produce(self) -> None:
+        try:
+            for item in self.frame_source:
+                if not self._put(item):
+                    return
+                self.produced += 1
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._put(self._END)
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+        try:
+            while True:
+                depth = self._queue.qsize()
+                self._depth_sum += depth
+                self.max_queue_depth = max(self.max_queue_depth, depth)
+
+                start_time = time.perf_counter()
+                item = self._queue.get()
+                self.consumer_starved_time += time.perf_counter() - start_time
+
+                if item is self._END:
+                    break
+
+                self.consumed += 1
+                yield item
+        finally:
+            self.close()
+
+        if self._error is not None:
+            raise self._error
+
+    def close(self) -> None:
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def mean_queue_depth(self) -> float:
+        return self._depth_sum / (self.consumed + 1)
+
+    def report(self) -> str:
+        return (f'prefetch depth {self.depth}: mean queue depth {self.mean_queue_depth():.1f}, '
+                f'max {self.max_queue_depth}, decoder blocked {self.decoder_blocked_time:.1f}s, '
+                f'consumer starved {self.consumer_starved_time:.1f}s')
+
+
+# 画面相对上一次检测没有变化时，复用上一次的检测结果而不调用模型
+class MotionGate:
+    def __init__(self, threshold: Optional[float] = None, max_stale: Optional[int] = None) -> None:
+        '''
+        a frame is unchanged if the mean absolute difference between its grayscale
+        thumbnail and the thumbnail of the last detected frame is below threshold, at
+        most max_stale frames in a row reuse the result of the same detected frame
+        '''
+        self.threshold = get_motion_gate_threshold() if threshold is None else threshold
+        self.max_stale = get_motion_gate_max_stale() if max_stale is None else max_stale
+
+        self._reference: Optional[np.ndarray] = None
+        self._reference_result = None
+        self._stale = 0
+
+        self.detected = 0
+        self.reused = 0
+
+    def _thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        height, width = frame.shape[:2]
+        size = (MOTION_GATE_THUMBNAIL_WIDTH, max(int(round(height * MOTION_GATE_THUMBNAIL_WIDTH / width)), 1))
+
+        thumbnail = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if thumbnail.ndim == 3:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+
+        return thumbnail.astype(np.int16)
+
+    def detect(self, frames: List[np.ndarray], detect: Callable[[List[np.ndarray]], List]) -> List:
+        '''
+        frames are in time order, only the changed frames are passed to detect
+        '''
+        # sources[i] 为第 i 帧结果的来源：待检测列表中的下标，或 -1 表示上一批次的参考结果
+        sources = []
+        detect_frames = []
+
+        reference, stale = self._reference, self._stale
+        for frame in frames:
+            thumbnail = self._thumbnail(frame)
+
+            if (reference is not None and stale < self.max_stale and
+                    np.abs(thumbnail - reference).mean() < self.threshold):
+                sources.append(sources[-1] if sources else -1)
+                stale += 1
+                continue
+
+            reference, stale = thumbnail, 0
+            sources.append(len(detect_frames))
+            detect_frames.append(frame)
+
+        results = list(detect(detect_frames)) if detect_frames else []
+
+        ans = [self._reference_result if source < 0 else results[source] for source in sources]
+
+        self._reference, self._stale = reference, stale
+        if results:
+            self._reference_result = results[-1]
+
+        self.detected += len(detect_frames)
+        self.reused += len(frames) - len(detect_frames)
+
+        return ans
+
+    def skip_ratio(self) -> float:
+        total = self.detected + self.reused
+        return self.reused / total if total > 0 else 0.0
+
+    def report(self) -> str:
+        return (f'motion gate: detected {self.detected}, reused {self.reused} '
+                f'({100 * self.skip_ratio():.1f}% skipped)')
+
+
+class SectionBuffer:
+    '''
+    structure-of-arrays buffer of the frames of a section: the frame numbers, msec,
+    bboxes (NaN rows if nothing is detected) and the detected mask are kept in
+    preallocated arrays which grow by doubling, the frames in a dict by frame number.
+    the frames must be appended in order, so ranges are found by binary search. the
+    first and last detected rows are tracked as the frames are appended
+    '''
+    def __init__(self, capacity: int = 256) -> None:
+        self._size = 0
+        self._first_detected: Optional[int] = None
+        self._last_detected: Optional[int] = None
+        self._frame_nos = np.empty(capacity, dtype=np.int64)
+        self._msecs = np.empty(capacity, dtype=np.float64)
+        self._bboxes = np.empty((capacity, 6), dtype=np.float64)
+        self._detected = np.empty(capacity, dtype=bool)
+        self.frames: Dict[int, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _reserve(self, size: int) -> None:
+        capacity = len(self._frame_nos)
+        if size <= capacity:
+            return
+
+        while capacity < size:
+            capacity *= 2
+
+        for name in ('_frame_nos', '_msecs', '_bboxes', '_detected'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def extend(self, frames: List[Tuple[int, float, np.ndarray]], results: Optional[List] = None) -> None:
+        '''
+        frames are (frame_no, msec, frame), results are the bboxes (or None) of the frames
+        '''
+        if len(frames) == 0:
+            return
+
+        assert self._size == 0 or frames[0][0] > self._frame_nos[self._size - 1], 'frames must be appended in order'
+
+        start = self._size
+        self._reserve(start + len(frames))
+
+        for i, (frame_no, msec, frame) in enumerate(frames, start):
+            self._frame_nos[i] = frame_no
+            self._msecs[i] = msec
+            self.frames[frame_no] = frame
+
+        end = start + len(frames)
+        if results is None:
+            self._bboxes[start:end] = np.nan
+            self._detected[start:end] = False
+        else:
+            for i, bbox in enumerate(results, start):
+                if bbox is None:
+                    self._bboxes[i] = np.nan
+                    self._detected[i] = False
+                else:
+                    self._bboxes[i] = bbox
+                    self._detected[i] = True
+
+                    if self._first_detected is None:
+                        self._first_detected = i
+                    self._last_detected = i
+
+        self._size = end
+
+    def clear(self) -> None:
+        self._size = 0
+        self._first_detected = None
+        self._last_detected = None
+        self.frames.clear()
+
+    @property
+    def frame_nos(self) -> np.ndarray:
+        return self._frame_nos[:self._size]
+
+    @property
+    def detected(self) -> np.ndarray:
+        return self._detected[:self._size]
+
+    def frame_no(self, i: int) -> int:
+        return int(self._frame_nos[i])
+
+    def bbox(self, i: int) -> Optional[Tuple]:
+        return tuple(self._bboxes[i].tolist()) if self._detected[i] else None
+
+    def first_detected(self) -> Optional[int]:
+        return self._first_detected
+
+    def last_detected(self) -> Optional[int]:
+        return self._last_detected
+
+    def range_of(self, start_frame_no: int, end_frame_no: int) -> Tuple[int, int]:
+        '''
+        the rows [lo, hi) whose frame numbers are in [start_frame_no, end_frame_no]
+        '''
+        frame_nos = self.frame_nos
+        return (int(np.searchsorted(frame_nos, start_frame_no, 'left')),
+                int(np.searchsorted(frame_nos, end_frame_no, 'right')))
+
+    def rows(self, lo: int, hi: int):
+        '''
+        (frame_no, msec, frame, bbox) of the rows [lo, hi)
+        '''
+        for i in range(lo, hi):
+            frame_no = int(self._frame_nos[i])
+            yield frame_no, float(self._msecs[i]), self.frames[frame_no], self.bbox(i)
+
+
+class SectionProfile:
+    '''
+    what the Sectionalizer looks for: detect(frames, bs, conf_thres) returns a bbox or
+    None for every frame, conf_thres overrides the threshold of the Sectionalizer if it is
+    given. a section starts at the first detection and ends when nothing is detected
+    in the last tail_time seconds, sections shorter than minimum_duration are dropped,
+    and a partial section is returned when cache_maximum frames are buffered
+    '''
+    def __init__(self, name: str, detect: Callable[[List[np.ndarray], int, float], List], batch_size: int,
+                 frequency: int, tail_time: int, minimum_duration: int, cache_maximum: int,
+                 conf_thres: Optional[float] = None) -> None:
+        self.name = name
+        self.detect = detect
+        self.batch_size = batch_size
+        self.conf_thres = conf_thres
+        # 以检测帧计的长尾与最短时长
+        self.tail_frames = tail_time * frequency
+        self.minimum_frames = minimum_duration * frequency
+        self.cache_maximum = cache_maximum
+
+
+SCREEN_SECTION_PROFILE = SectionProfile('screen', detect_screen_with_batch, SCREEN_DETECTION_BATCH_SIZE,
+                                        SCREEN_DETECTION_FREQUENCY, SCREEN_DETECTION_TAIL_TIME,
+                                        SCREEN_DETECTION_MINIMUM_DURATION, SCREEN_DETECTION_CACHE_MAXIMUM)
+FOG_SECTION_PROFILE = SectionProfile('fog', detect_fog_with_batch, FOG_DETECTION_BATCH_SIZE,
+                                     FOG_DETECTION_FREQUENCY, FOG_DETECTION_TAIL_TIME,
+                                     FOG_DETECTION_MINIMUM_DURATION, FOG_DETECTION_CACHE_MAXIMUM, conf_thres=0.3)
 
 
 # 将视频按帧划分
@@ -128,17 +622,30 @@ class Sectionalizer:
         OUT_OF_SECTION = 2
 
     def __init__(self, conf_thres: float,
-                 detector: Callable[[bool, int, int, np.ndarray, Optional[Tuple]], None] = None) -> None:
+                 detector: Callable[[bool, int, int, np.ndarray, Optional[Tuple]], None] = None,
+                 feedback: Optional[SamplerFeedback] = None, motion_gate: Optional[MotionGate] = None,
+                 profile: SectionProfile = SCREEN_SECTION_PROFILE) -> None:
+        '''
+        profile is what to detect (the screens by default). if feedback is given, the
+        sampler is set idle out of sections, and the frames skipped by the idle sampler
+        are backfilled around the start of a section. if motion_gate is given, the
+        batches of immediate frames are detected through it
+        '''
         self.state = self.State.OUT_OF_SECTION
 
-        self.conf_thres = conf_thres
+        self.profile = profile
+        self.conf_thres = conf_thres if profile.conf_thres is None else profile.conf_thres
 
         self.immediate_frames: List[np.ndarray] = []
         self.deferred_frames: List[np.ndarray] = []
 
         self.ready = False
-        self.section_info = ([], [], [])
-        self.section_detect_flags = []
+        # 已检测的帧与延后检测的帧
+        self.detected_frames = SectionBuffer()
+        self.undetected_frames = SectionBuffer()
+        # 工序内已检测的帧数，以及最后一次检测到目标之后的帧数
+        self._section_detections = 0
+        self._frames_since_detection = 0
         self.section = None
 
         self.section_idx = 0
@@ -146,6 +653,12 @@ class Sectionalizer:
 
         self.is_unfinished = False
 
+        self.feedback = feedback
+        self.motion_gate = motion_gate
+        # 最近加入的帧号，以及上一批次最后一帧的帧号，用于补帧
+        self._last_idx = -1
+        self._prev_batch_last_idx = -1
+
     def is_ready(self) -> bool:
         return self.ready
 
@@ -160,292 +673,204 @@ class Sectionalizer:
             self._finish()
             return
 
+        self._fill_gap(idx)
+        self._last_idx = idx
+
         if tag == FRAME_TAG.DETECT_LATER:
             self.deferred_frames.append((idx, msec, frame))
         # 如果当前帧需要被检测，加入序列
         elif tag == FRAME_TAG.SHOULD_DETECT:
             self.immediate_frames.append((idx, msec, frame))
 
-            # 如果当前批次数量已够，调用yolov5依次检测每一帧的屏面玻璃位置----------------->
-            if len(self.immediate_frames) == SCREEN_DETECTION_BATCH_SIZE:
-                ans = detect_screen_with_batch([
-                    frame for _, _, frame in self.immediate_frames
-                ], SCREEN_DETECTION_BATCH_SIZE, self.conf_thres)
+            # 如果当前批次数量已够，依次检测每一帧中的目标（屏面玻璃、fog 等）----------------->
+            if len(self.immediate_frames) == self.profile.batch_size:
+                ans = self._gated_detect(self.immediate_frames, self._detect)
 
-                # 如果新开始检测一个批次帧 且 检测到了屏面玻璃
+                # 如果新开始检测一个批次帧 且 检测到了目标
                 if self.state == self.State.OUT_OF_SECTION:
                     if self._found_screen(ans):
                         self.state = self.State.IN_SECTION
+                        ans = self._backfill_section_start(ans, self._detect)
 
-                        self.section_info[0].extend(self.immediate_frames)
-                        self.section_info[1].extend(self.deferred_frames)
-                        self.section_info[2].extend(ans)
-                        self.section_detect_flags.extend(None if frame_res is None else 1 for frame_res in ans)
+                        self._extend_section(ans)
 
                 elif self.state == self.State.IN_SECTION:
-                    self.section_info[0].extend(self.immediate_frames)
-                    self.section_info[1].extend(self.deferred_frames)
-                    self.section_info[2].extend(ans)
-                    self.section_detect_flags.extend(None if frame_res is None else 1 for frame_res in ans)
+                    self._extend_section(ans)
 
                     if self._section_is_over():
                         self.state = self.State.OUT_OF_SECTION
+                        self._set_idle(True)
 
                         self.parse(is_over=True)
 
                         self.immediate_frames.clear()
                         self.deferred_frames.clear()
+                        self._prev_batch_last_idx = idx
 
                         return
 
                 self.immediate_frames.clear()
                 self.deferred_frames.clear()
+                self._prev_batch_last_idx = idx
 
                 # 判断当前缓存是否已满
-                if len(self.section_info[0]) + len(self.section_info[1]) >= SCREEN_DETECTION_CACHE_MAXIMUM:
+                if len(self.detected_frames) + len(self.undetected_frames) >= self.profile.cache_maximum:
                     self.parse(is_over=False)
 
-    def add_frame_fog(self, tag: FRAME_TAG, idx: int, msec: float, frame: np.ndarray) -> None:
-        if idx < 0:
-            self._finish_fog()
-            return
-
-        if tag == FRAME_TAG.DETECT_LATER:
-            self.deferred_frames.append((idx, msec, frame))
-        # 如果当前帧需要被检测，加入序列
-        elif tag == FRAME_TAG.SHOULD_DETECT:
-            self.immediate_frames.append((idx, msec, frame))
-
-            # 如果当前批次数量已够，调用yolov5依次检测每一帧的屏面玻璃位置----------------->
-            if len(self.immediate_frames) == FOG_DETECTION_BATCH_SIZE:
-                ans = detect_fog_with_batch([
-                    frame for _, _, frame in self.immediate_frames
-                ], FOG_DETECTION_BATCH_SIZE, conf_thres=0.3)
-
-                # 如果新开始检测一个批次帧 且 检测到了fog
-                if self.state == self.State.OUT_OF_SECTION:
-                    if self._found_screen(ans):
-                        self.state = self.State.IN_SECTION
-
-                        self.section_info[0].extend(self.immediate_frames)
-                        self.section_info[1].extend(self.deferred_frames)
-                        self.section_info[2].extend(ans)
-                        self.section_detect_flags.extend(None if frame_res is None else 1 for frame_res in ans)
-
-                elif self.state == self.State.IN_SECTION:
-                    self.section_info[0].extend(self.immediate_frames)
-                    self.section_info[1].extend(self.deferred_frames)
-                    self.section_info[2].extend(ans)
-                    self.section_detect_flags.extend(None if frame_res is None else 1 for frame_res in ans)
-
-                    if self._section_is_over_fog():
-                        self.state = self.State.OUT_OF_SECTION
-
-                        self.parse_fog(is_over=True)
-
-                        self.immediate_frames.clear()
-                        self.deferred_frames.clear()
-
-                        return
-
-                self.immediate_frames.clear()
-                self.deferred_frames.clear()
-
-                # 判断当前缓存是否已满
-                if len(self.section_info[0]) + len(self.section_info[1]) >= FOG_DETECTION_CACHE_MAXIMUM:
-                    self.parse_fog(is_over=False)
-
     def _finish(self) -> None:
         # 对最后一个需要检测的帧重复add_frame中的操作
-        ans = detect_screen_with_batch([
-            frame for _, _, frame in self.immediate_frames
-        ], SCREEN_DETECTION_BATCH_SIZE, self.conf_thres)
+        ans = self._gated_detect(self.immediate_frames, self._detect)
 
         if self.state == self.State.IN_SECTION or self._found_screen(ans):
-            self.section_info[0].extend(self.immediate_frames)
-            self.section_info[1].extend(self.deferred_frames)
-            self.section_info[2].extend(ans)
-            self.section_detect_flags.extend(None if frame_res is None else 1 for frame_res in ans)
+            self._extend_section(ans)
 
             self.state = self.State.OUT_OF_SECTION
+            self._set_idle(True)
 
             self.parse(is_over=True)
 
         self.immediate_frames.clear()
         self.deferred_frames.clear()
 
-    def _finish_fog(self) -> None:
-        # 对最后一个需要检测的帧重复add_frame_fog中的操作
-        ans = detect_fog_with_batch([
-            frame for _, _, frame in self.immediate_frames
-        ], FOG_DETECTION_BATCH_SIZE, conf_thres=0.3)
-
-        if self.state == self.State.IN_SECTION or self._found_screen(ans):
-            self.section_info[0].extend(self.immediate_frames)
-            self.section_info[1].extend(self.deferred_frames)
-            self.section_info[2].extend(ans)
-            self.section_detect_flags.extend(None if frame_res is None else 1 for frame_res in ans)
-
-            self.state = self.State.OUT_OF_SECTION
-
-            self.parse_fog(is_over=True)
-
-        self.immediate_frames.clear()
-        self.deferred_frames.clear()
-
-    def _found_screen(self, flags) -> bool:
-        # print("flags:", flags)
-        return any(flag is not None for flag in flags)
+    def _extend_section(self, ans: List) -> None:
+        self.detected_frames.extend(self.immediate_frames, ans)
+        self.undetected_frames.extend(self.deferred_frames)
+        for frame_res in ans:
+            self._section_detections += 1
+            self._frames_since_detection = 0 if frame_res is not None else self._frames_since_detection + 1
 
-    def _section_is_over(self) -> bool:
-        tail_frames = SCREEN_DETECTION_TAIL_TIME * SCREEN_DETECTION_FREQUENCY
-        return not self._found_screen(self.section_detect_flags[- tail_frames:])
+    def _clear_section(self) -> None:
+        self.detected_frames.clear()
+        self.undetected_frames.clear()
 
-    def _section_is_over_fog(self) -> bool:
-        tail_frames = FOG_DETECTION_TAIL_TIME * FOG_DETECTION_FREQUENCY
-        return not self._found_screen(self.section_detect_flags[- tail_frames:])
+    def _detect(self, frames: List[np.ndarray]) -> List:
+        return self.profile.detect(frames, self.profile.batch_size, self.conf_thres)
 
-    def parse(self, is_over: bool=True) -> None:
-        self.ready = True
+    def _gated_detect(self, frames, detect: Callable[[List[np.ndarray]], List]) -> List:
+        images = [frame for _, _, frame in frames]
 
-        detected_frames = self.section_info[0]
-        undetected_frames = self.section_info[1]
-        detected_results = self.section_info[2]
+        if self.motion_gate is None:
+            return detect(images)
 
-        first_idx = index_of_first(detected_results)
-        if first_idx is None:
-            self.section = []
+        return self.motion_gate.detect(images, detect)
 
-            for item in self.section_info:
-                item.clear()
-
-            if is_over:
-                self.is_unfinished = False
-                self.section_idx += 1
-                self.section_detect_flags.clear()
+    def _set_idle(self, idle: bool) -> None:
+        if self.feedback is not None:
+            self.feedback.set_idle(idle)
 
+    def _fill_gap(self, idx: int) -> None:
+        '''
+        in a section, adds the frames before idx which were skipped by the idle sampler
+        (the sampler wakes up with a delay when the frames are prefetched)
+        '''
+        if self.feedback is None or self.state != self.State.IN_SECTION or idx <= self._last_idx + 1:
             return
 
-        last_idx = index_of_last(detected_results) + 1
-        last_idx = last_idx if last_idx < len(detected_results) else last_idx - 1
+        for tag, frame_no, msec, frame in self.feedback.backfill(self._last_idx, idx):
+            self.add_frame(tag, frame_no, msec, frame)
+            self._last_idx = frame_no
 
-        if not self.is_unfinished:
-            if last_idx - first_idx < SCREEN_DETECTION_MINIMUM_DURATION * SCREEN_DETECTION_FREQUENCY:
+    def _backfill_section_start(self, ans: List, detect: Callable[[List[np.ndarray]], List]) -> List:
+        '''
+        called when a section starts in the current batch, wakes the sampler up and merges
+        the frames skipped by the idle sampler since the last batch into the current batch,
+        returns the detection results of the merged immediate frames
+        '''
+        if self.feedback is None:
+            return ans
 
-                if self.detector is not None:
-                    section_start = detected_frames[first_idx][0]
-                    section_end = detected_frames[last_idx][0]
+        self._set_idle(False)
 
-                    for (frame_no, _, frame), bbox in zip(detected_frames, detected_results):
-                        if section_start <= frame_no <= section_end:
-                            self.detector(False, self.section_idx, frame_no, frame, bbox)
+        existing = set(frame_no for frame_no, _, _ in self.immediate_frames)
+        existing.update(frame_no for frame_no, _, _ in self.deferred_frames)
 
-                self.section = None
-                for item in self.section_info:
-                    item.clear()
-                self.section_detect_flags.clear()
-                return
-
-        self.is_unfinished = not is_over
-
-        section_start = detected_frames[first_idx][0]
-        section_end = detected_frames[last_idx][0]
-
-        section = []
-        for (frame_no, msec, frame), bbox in zip(detected_frames, detected_results):
-            if section_start <= frame_no <= section_end:
-                section.append((frame_no, msec, frame, bbox))
+        filled_immediate, filled_deferred = [], []
+        for tag, frame_no, msec, frame in self.feedback.backfill(self._prev_batch_last_idx, self._last_idx):
+            if frame_no in existing:
+                continue
 
-        additional_frames = [(frame_no, msec, frame) for frame_no, msec, frame in undetected_frames if
-                             section_start <= frame_no <= section_end]
+            if tag == FRAME_TAG.SHOULD_DETECT:
+                filled_immediate.append((frame_no, msec, frame))
+            else:
+                filled_deferred.append((frame_no, msec, frame))
 
-        if len(additional_frames) > 0:
-            ans = detect_screen_with_batch(
-                (frame for _, _, frame in additional_frames),
-                SCREEN_DETECTION_BATCH_SIZE,
-                self.conf_thres
-            )
+        if filled_immediate:
+            filled_ans = detect([frame for _, _, frame in filled_immediate])
 
-            for (frame_no, msec, frame), bbox in zip(additional_frames, ans):
-                section.append((frame_no, msec, frame, bbox))
+            merged = sorted(zip(self.immediate_frames + filled_immediate, list(ans) + list(filled_ans)),
+                            key=lambda item: item[0][0])
+            self.immediate_frames = [item for item, _ in merged]
+            ans = [frame_res for _, frame_res in merged]
 
-        # TODO: 最后很可能有空
+        if filled_deferred:
+            self.deferred_frames = sorted(self.deferred_frames + filled_deferred, key=lambda item: item[0])
 
-        section.sort(key=lambda item: item[0])
+        return ans
 
-        if self.detector:
-            for frame_no, _, frame, bbox in section:
-                self.detector(True, self.section_idx, frame_no, frame, bbox)
+    def _found_screen(self, flags) -> bool:
+        # print("flags:", flags)
+        return any(flag is not None for flag in flags)
 
-        self.section = section
+    def _reset_tail(self) -> None:
+        self._section_detections = 0
+        self._frames_since_detection = 0
 
-        for item in self.section_info:
-            item.clear()
+    def _tail_is_empty(self, tail_frames: int) -> bool:
+        '''
+        whether nothing is detected in the last tail_frames detected frames of the section
+        '''
+        return self._frames_since_detection >= min(tail_frames, self._section_detections)
 
-        if not self.is_unfinished:
-            self.section_idx += 1
-            self.section_detect_flags.clear()
+    def _section_is_over(self) -> bool:
+        return self._tail_is_empty(self.profile.tail_frames)
 
-    def parse_fog(self, is_over: bool = True) -> None:
+    def parse(self, is_over: bool = True) -> None:
         self.ready = True
 
-        detected_frames = self.section_info[0]
-        undetected_frames = self.section_info[1]
-        detected_results = self.section_info[2]
+        detected_frames = self.detected_frames
+        undetected_frames = self.undetected_frames
 
-        first_idx = index_of_first(detected_results)
+        first_idx = detected_frames.first_detected()
         if first_idx is None:
             self.section = []
 
-            for item in self.section_info:
-                item.clear()
+            self._clear_section()
 
             if is_over:
                 self.is_unfinished = False
                 self.section_idx += 1
-                self.section_detect_flags.clear()
+                self._reset_tail()
 
             return
 
-        last_idx = index_of_last(detected_results) + 1
-        last_idx = last_idx if last_idx < len(detected_results) else last_idx - 1
+        last_idx = detected_frames.last_detected() + 1
+        last_idx = last_idx if last_idx < len(detected_frames) else last_idx - 1
+
+        section_start = detected_frames.frame_no(first_idx)
+        section_end = detected_frames.frame_no(last_idx)
+        lo, hi = detected_frames.range_of(section_start, section_end)
 
         if not self.is_unfinished:
-            if last_idx - first_idx < FOG_DETECTION_MINIMUM_DURATION * FOG_DETECTION_FREQUENCY:
+            if last_idx - first_idx < self.profile.minimum_frames:
 
                 if self.detector is not None:
-                    section_start = detected_frames[first_idx][0]
-                    section_end = detected_frames[last_idx][0]
-
-                    for (frame_no, _, frame), bbox in zip(detected_frames, detected_results):
-                        if section_start <= frame_no <= section_end:
-                            self.detector(False, self.section_idx, frame_no, frame, bbox)
+                    for frame_no, _, frame, bbox in detected_frames.rows(lo, hi):
+                        self.detector(False, self.section_idx, frame_no, frame, bbox)
 
                 self.section = None
-                for item in self.section_info:
-                    item.clear()
-                self.section_detect_flags.clear()
+                self._clear_section()
+                self._reset_tail()
                 return
 
         self.is_unfinished = not is_over
 
-        section_start = detected_frames[first_idx][0]
-        section_end = detected_frames[last_idx][0]
+        section = list(detected_frames.rows(lo, hi))
 
-        section = []
-        for (frame_no, msec, frame), bbox in zip(detected_frames, detected_results):
-            if section_start <= frame_no <= section_end:
-                section.append((frame_no, msec, frame, bbox))
-
-        additional_frames = [(frame_no, msec, frame) for frame_no, msec, frame in undetected_frames if
-                             section_start <= frame_no <= section_end]
+        additional_frames = [(frame_no, msec, frame) for frame_no, msec, frame, _ in
+                             undetected_frames.rows(*undetected_frames.range_of(section_start, section_end))]
 
         if len(additional_frames) > 0:
-            ans = detect_fog_with_batch(
-                (frame for _, _, frame in additional_frames),
-                FOG_DETECTION_BATCH_SIZE,
-                conf_thres=0.3
-            )
+            ans = self._detect([frame for _, _, frame in additional_frames])
 
             for (frame_no, msec, frame), bbox in zip(additional_frames, ans):
                 section.append((frame_no, msec, frame, bbox))
@@ -460,12 +885,11 @@ class Sectionalizer:
 
         self.section = section
 
-        for item in self.section_info:
-            item.clear()
+        self._clear_section()
 
         if not self.is_unfinished:
             self.section_idx += 1
-            self.section_detect_flags.clear()
+            self._reset_tail()
 
 
 class FogDetector:
@@ -544,6 +968,53 @@ class FogDetector:
         return self.first_frame_no, self.last_frame_no, self.start_msec, self.end_msec, self.result, percentage, frame, frame_no, frame_no * self.end_msec / self.last_frame_no
 
 
+# 同一帧派生出的、被多个模型共用的图像（目前只有裁剪出的屏幕，荧光粉与锥屏分离共用），
+# 按 (frame_no, op, size) 缓存，超过容量时淘汰最久未使用的图像。
+# 缓存的是副本，容量按实际占用的内存计算。送入模型的缩放由 *_with_batch 中的 letterbox_batch 一次完成，不缓存
+class DerivedImageCache:
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        self.max_bytes = get_derived_image_cache_mb() * 1024 * 1024 if max_bytes is None else max_bytes
+
+        self._images = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, frame_no: int, op: str, size: Optional[int],
+            make: Callable[[], Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        '''
+        returns the cached image of (frame_no, op, size), or calls make() to compute it
+        '''
+        key = (frame_no, op, size)
+        if key in self._images:
+            self._images.move_to_end(key)
+            self.hits += 1
+            return self._images[key]
+
+        self.misses += 1
+
+        image = make()
+        if image is None or image.nbytes > self.max_bytes:
+            return image
+
+        self._images[key] = image
+        self._bytes += image.nbytes
+
+        while self._bytes > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+        return image
+
+    def clear(self) -> None:
+        self._images.clear()
+        self._bytes = 0
+
+    def report(self) -> str:
+        return f'derived image cache: {self.hits} hits, {self.misses} misses, {self._bytes / 1024 / 1024:.1f}MB'
+
+
 # 屏幕状态种类，按顺序分别是：
 # 合格、荧光粉残留、锥体玻璃残留、碎屏、荧光粉水印、荧光粉白印
 class SECTION_CATEGORY(enum.Enum):
@@ -568,6 +1039,9 @@ class Classifier:
             else:
                 self._frames.append((frame_no, frame))
 
+        def items(self) -> List:
+            return list(self._frames)
+
         def get(self, ret_frame_no: int) -> [np.ndarray]:
             ret_frame = None
             for frame_no, frame in self._frames:
@@ -595,7 +1069,8 @@ class Classifier:
             self._nones.clear()
 
     def __init__(self,
-                 detector: Callable[[int, np.ndarray, Tuple, Optional[float], Optional[float]], None] = None) -> None:
+                 detector: Callable[[int, np.ndarray, Tuple, Optional[float], Optional[float]], None] = None,
+                 image_cache: Optional[DerivedImageCache] = None) -> None:
         # self.frames_in_1s = SCREEN_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO
 
         self.broken_frame_cache = Classifier.BatchCache(BROKEN_DETECTION_BATCH_SIZE)  # 碎屏图像帧
@@ -618,6 +1093,13 @@ class Classifier:
         self.result = SECTION_CATEGORY.PASS
 
         self.detector = detector
+        # 屏幕裁剪与模型输入的缩放在各模型之间共享
+        self.image_cache = DerivedImageCache() if image_cache is None else image_cache
+
+        # 碎屏优先级最高，确认后即可跳过荧光粉残留与锥屏分离的推理
+        self.broken_confirmed = False
+        # 各模型因提前结束而省去推理的帧数
+        self.skipped = {'state_test': 0, 'segmentation': 0}
 
     def push_partial_section(self, is_over: bool, psection):
         if psection:
@@ -637,34 +1119,51 @@ class Classifier:
         if self._finished():
             return
 
-        # 遍历批次帧，判断是否存在碎屏和荧光粉残留
+        # 遍历批次帧，先判断是否存在碎屏
         frame_amount = len(psection)
         for frame_idx, (frame_no, msec, frame, bbox) in enumerate(psection):
             is_last_frame = frame_idx + 1 == frame_amount and (
                 is_over or self.detector is not None
             )
-            # 判断是否有碎屏和荧光粉残留
-            self._push_frame(frame_no, frame, bbox, is_last_frame)
+            self._push_broken_frame(frame_no, frame, is_last_frame)
 
             # 将尾部帧加入检测，用于判断锥屏分离
             self.tail_frames.append((frame_no, frame, bbox))
 
-            if self._finished():
-                break
+        # 碎屏只看工序末尾的帧，工序结束时才能确认，所以提前结束只省去工序最后一部分
+        # 的荧光粉检测与锥屏分离，之前各部分的推理不变
+        if is_over and self._broken_run()[0] >= BROKEN_THRESHOLD:
+            self.broken_confirmed = True
+
+        # 再判断是否存在荧光粉残留
+        if self._finished():
+            self.skipped['state_test'] += len(self.phosphor_frame_cache.items()) + \
+                sum(bbox is not None for _, _, _, bbox in psection)
+            self.phosphor_frame_cache.clear()
+        else:
+            for frame_idx, (frame_no, msec, frame, bbox) in enumerate(psection):
+                is_last_frame = frame_idx + 1 == frame_amount and (
+                    is_over or self.detector is not None
+                )
+                self._push_phosphor_frame(frame_no, frame, bbox, is_last_frame)
 
         self.tail_frames = self.tail_frames[- 3 * SCREEN_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO:]
 
         # 如果当前视频遍历完毕，再判断是否锥屏分离
-        if is_over:
+        if is_over and self._finished():
+            self.skipped['segmentation'] += sum(bbox is not None for _, _, bbox in self.tail_frames)
+        elif is_over:
             for idx, (frame_no, frame, bbox) in enumerate(self.tail_frames):
-                screen = self._crop_screen(frame, bbox)
+                screen = self._screen(frame_no, frame, bbox)
 
                 self.cone_frame_cache.push(frame_no, screen)
 
                 if self.cone_frame_cache.is_full() or idx + 1 == len(self.tail_frames):
                     # 判断锥屏是否分离-------------------->
-                    cone_batch_ans = segment_cone_with_batch(self.cone_frame_cache.frames(), CONE_DETECTION_BATCH_SIZE)
-                    cone_batch_ans = [(mask, np.sum(mask) // 255 if np.sum(mask) // 255 > 1 else 0) for mask in cone_batch_ans]
+                    cone_batch_ans = segment_cone_with_batch(
+                        self.cone_frame_cache.frames(), CONE_DETECTION_BATCH_SIZE,
+                        counts_only=True, debug_size=self._debug_mask_size())
+                    cone_batch_ans = [(mask, count if count > 1 else 0) for count, mask in cone_batch_ans]
                     cache_results = self.cone_frame_cache.join_nones(cone_batch_ans, clear=True)
                     self.cone_detection_results.extend(cache_results)
 
@@ -674,13 +1173,13 @@ class Classifier:
             # assert len(self.broken_detection_results) == len(psection)
             # assert len(self.broken_detection_results) == len(self.phosphor_detection_results)
 
+            # 分割结果为 (缩小的掩膜, 设备上统计的像素数)，掩膜只用于可视化
             segment_map = dict(self.cone_detection_results)
+            broken_map = dict(self.broken_detection_results)
             phosphor_map = dict(self.phosphor_detection_results)
             for frame_no, msec, frame, bbox in psection:
-                segment_ans = segment_map.get(frame_no, None)
-                phosphor_ans = phosphor_map.get(frame_no, None)
-                self.detector(frame_no, frame, bbox, phosphor_ans,
-                              segment_ans if segment_ans is None else segment_ans[0])
+                self.detector(frame_no, frame, bbox, phosphor_map.get(frame_no, None),
+                              broken_map.get(frame_no, None), segment_map.get(frame_no, None))
 
     # 根据每一帧保存的检测结果进行最后的判断并输出
     def classify(self) -> Tuple[Any, Any, Any, Any, SECTION_CATEGORY, Any, Optional[Any], Any, Any]:
@@ -767,9 +1266,45 @@ class Classifier:
 
         return screen
 
+    def _screen(self, frame_no: int, frame: np.ndarray, bbox) -> Optional[np.ndarray]:
+        def _make():
+            # crop_square 返回的是原帧的视图，缓存副本，否则缓存会让整帧一直留在内存中
+            screen = self._crop_screen(frame, bbox)
+            return None if screen is None else screen.copy()
+
+        return self.image_cache.get(frame_no, 'screen', None, _make)
+
+    def _debug_mask_size(self) -> Optional[int]:
+        # 只有保存调试结果时才需要掩膜
+        return None if self.detector is None else SEGMENTATION_DEBUG_MASK_SIZE
+
     def _finished(self) -> bool:
-        ...
-        return False
+        '''
+        whether the verdict of the section is settled, i.e. the screen is broken, which
+        outranks the other defects, so the remaining frames need no other inference
+        '''
+        return self.broken_confirmed
+
+    def report(self) -> str:
+        if not self.broken_confirmed:
+            return 'early exit: not taken'
+
+        return 'early exit: skipped ' + ', '.join(f'{count} {model_cat}' for model_cat, count in self.skipped.items())
+
+    def _broken_run(self) -> Tuple[int, int, List]:
+        '''
+        the longest run of broken frames (tolerating one gap) in the tail of the broken
+        results, its last index and the tail
+        '''
+        broken_res = [(frame_no, None if broken_ans is None else broken_ans[1]) for frame_no, broken_ans in self.broken_detection_results]
+        # head_range = int(round(3.0 * SCREEN_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO))
+        tail_range = int(round(3.5 * SCREEN_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO))
+        # sub_res1 = broken_res[:head_range]
+        sub_res = broken_res[-tail_range:]
+        # sub_res = sub_res1 + sub_res2
+
+        broken_max_len, broken_last = max_seq_len_with_torlenance(sub_res, 1, key=lambda ans: ans[1])
+        return broken_max_len, broken_last, sub_res
 
     def _broken_examination(self) -> Tuple[bool, Any]:
         # tail_range = int(round(1.5 * SCREEN_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO))
@@ -785,19 +1320,11 @@ class Classifier:
         # else:
         #     return False, -1
 
-        broken_threshold = 9
-        broken_res = [(frame_no, None if broken_ans is None else broken_ans[1]) for frame_no, broken_ans in self.broken_detection_results]
-        # head_range = int(round(3.0 * SCREEN_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO))
-        tail_range = int(round(3.5 * SCREEN_DETECTION_FREQUENCY * DIAGNOSIS_MAGNIFICATION_RATIO))
-        # sub_res1 = broken_res[:head_range]
-        sub_res = broken_res[-tail_range:]
-        # sub_res = sub_res1 + sub_res2
+        broken_max_len, broken_last, sub_res = self._broken_run()
 
         # print(sub_res)
-        broken_max_len, broken_last = max_seq_len_with_torlenance(sub_res, 1, key=lambda ans: ans[1])
-
         print('broken_max_len:', broken_max_len)
-        if broken_max_len >= broken_threshold:
+        if broken_max_len >= BROKEN_THRESHOLD:
             while sub_res[broken_last][1] is None:
                 broken_last -= 1
             frame_no = sub_res[broken_last][0]
@@ -835,21 +1362,26 @@ class Classifier:
         else:
             return False, -1
 
-    # 判断当前帧中是否存在碎屏和荧光粉残留
-    def _push_frame(self, frame_no, frame, bbox, is_last_frame) -> None:
-        screen = self._crop_screen(frame, bbox)  # 将屏面玻璃分割出来
-
+    # 判断当前帧中是否存在碎屏
+    def _push_broken_frame(self, frame_no, frame, is_last_frame) -> None:
         # 使用分割网络判断是否存在碎屏-------------------->
         self.broken_frame_cache.push(frame_no, frame)
         if self.broken_frame_cache.is_full() or is_last_frame:
-            broken_batch_ans = segment_broken_with_batch(self.broken_frame_cache.frames(), BROKEN_DETECTION_BATCH_SIZE)
-            broken_batch_ans = [(mask, np.sum(mask) // 255 if np.sum(mask) // 255 > 1 else 0) for mask in broken_batch_ans]
+            broken_batch_ans = segment_broken_with_batch(
+                self.broken_frame_cache.frames(), BROKEN_DETECTION_BATCH_SIZE,
+                counts_only=True, debug_size=self._debug_mask_size())
+            broken_batch_ans = [(mask, count if count > 1 else 0) for count, mask in broken_batch_ans]
             cache_results = self.broken_frame_cache.join_nones(broken_batch_ans, clear=True)
             self.broken_detection_results.extend(cache_results)
 
+    # 判断当前帧中是否存在荧光粉残留
+    def _push_phosphor_frame(self, frame_no, frame, bbox, is_last_frame) -> None:
+        screen = self._screen(frame_no, frame, bbox)  # 将屏面玻璃分割出来
+
         # 使用resnet模型判断是否有荧光粉残留-------------------->
         self.phosphor_frame_cache.push(frame_no, screen)
         if self.phosphor_frame_cache.is_full() or is_last_frame:
-            phosphor_batch_ans = classify_state_with_batch(self.phosphor_frame_cache.frames(), PHOSPHOR_DETECTION_BATCH_SIZE)
+            phosphor_batch_ans = classify_state_with_batch(
+                self.phosphor_frame_cache.frames(), PHOSPHOR_DETECTION_BATCH_SIZE)
             cache_results = self.phosphor_frame_cache.join_nones(phosphor_batch_ans, clear=True)
             self.phosphor_detection_results.extend(cache_results)
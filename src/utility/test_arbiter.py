@@ -0,0 +1,31 @@
+'''
+checks of utility.arbiter, run from src/ as
+
+    python -m pytest utility/test_arbiter.py
+'''
+import numpy as np
+
+from utility import dip
+from utility.arbiter import ClassifierDetector
+
+
+def test_skipped_frames_are_labelled(monkeypatch, tmp_path):
+    labels = {}
+
+    def rectangle_and_text(image, bbox, contents, **kwargs):
+        labels[int(image[0, 0, 0])] = contents[0][0]
+        return image
+
+    monkeypatch.setattr(dip, 'rectangle_and_text', rectangle_and_text)
+
+    detector = ClassifierDetector(tmp_path)
+    mask = np.zeros((128, 128, 1), np.uint8)
+    bbox = (0, 0, 4, 4, 0.9, 0)
+    # 确认碎屏后跳过的帧没有荧光粉检测结果
+    detector(0, np.full((8, 8, 3), 0, np.uint8), bbox, 0.9, (mask, 0), (mask, 0))
+    detector(1, np.full((8, 8, 3), 1, np.uint8), bbox, None, (mask, 5000), None)
+    detector.save_result()
+
+    assert labels == {0: ['FAIL (0.9)'], 1: ['SKIPPED']}
+    assert (tmp_path / 'pt' / 'results.txt').read_text(encoding='utf-8').split('\n')[2:8] == \
+        ['phosphor', '0.9, None', 'broken', '0, 5000', 'cone', '0, -1']
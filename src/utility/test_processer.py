@@ -0,0 +1,180 @@
+'''
+checks of utility.processer, run from src/ as
+
+    python -m pytest utility/test_processer.py
+'''
+import copy
+import random
+from typing import List, Optional
+
+import numpy as np
+
+import utility.processer
+from utility.processer import (
+    FRAME_TAG,
+    FOG_SECTION_PROFILE,
+    SCREEN_SECTION_PROFILE,
+    SECTION_CATEGORY,
+    Classifier,
+    SectionBuffer,
+    Sectionalizer
+)
+
+
+# 与增量计数等价的旧实现：每次扫描整个检测标记列表
+class _ListSectionBuffer(SectionBuffer):
+    def first_detected(self) -> Optional[int]:
+        detected = self.detected
+        if len(detected) == 0:
+            return None
+
+        i = int(np.argmax(detected))
+        return i if detected[i] else None
+
+    def last_detected(self) -> Optional[int]:
+        detected = self.detected
+        if len(detected) == 0:
+            return None
+
+        i = len(detected) - 1 - int(np.argmax(detected[::-1]))
+        return i if detected[i] else None
+
+
+class _ListSectionalizer(Sectionalizer):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.detected_frames = _ListSectionBuffer()
+        self.section_detect_flags = []
+
+    def _extend_section(self, ans: List) -> None:
+        super()._extend_section(ans)
+        self.section_detect_flags.extend(frame_res is not None for frame_res in ans)
+
+    def _reset_tail(self) -> None:
+        super()._reset_tail()
+        self.section_detect_flags.clear()
+
+    def _tail_is_empty(self, tail_frames: int) -> bool:
+        return not any(self.section_detect_flags[-tail_frames:])
+
+
+def _random_pattern(rng: random.Random, n: int) -> List[bool]:
+    '''
+    whether the target is in each frame: runs of various lengths with 5% noise
+    '''
+    pattern, on = [], False
+    while len(pattern) < n:
+        length = rng.choice([rng.randint(1, 20), rng.randint(20, 400)])
+        pattern += [on if rng.random() > 0.05 else not on for _ in range(length)]
+        on = not on
+
+    return pattern[:n]
+
+
+def _random_tags(rng: random.Random, n: int) -> List[FRAME_TAG]:
+    period = rng.choice([2, 3, 5, 8])
+    return [
+        FRAME_TAG.SHOULD_DETECT if i % period == 0 else
+        FRAME_TAG.DETECT_LATER if rng.random() < 0.5 else FRAME_TAG.IGNORED
+        for i in range(n)
+    ]
+
+
+def _sections(sectionalizer_type, profile, pattern: List[bool], tags: List[FRAME_TAG]) -> List:
+    '''
+    (frame_idx, finished, section_idx, [(frame_no, msec, bbox)]) of every section returned
+    '''
+    def detect(frames, bs, conf_thres):
+        return [(1.0, 2.0, 3.0, 4.0, 0.9, 0.0) if pattern[int(frame[0, 0])] else None for frame in frames]
+
+    profile = copy.copy(profile)
+    profile.detect = detect
+    sectionalizer = sectionalizer_type(0.5, profile=profile)
+
+    sections = []
+    for i, tag in enumerate(tags + [None]):
+        if tag is None:
+            sectionalizer.add_frame(None, -1, -1, None)
+        else:
+            sectionalizer.add_frame(tag, i, i * 40.0, np.full((2, 2), i, dtype=np.int32))
+
+        if sectionalizer.is_ready():
+            finished, section = sectionalizer.retrieve_section()
+            if section is not None:
+                section = [(frame_no, msec, bbox) for frame_no, msec, _, bbox in section]
+            sections.append((i, finished, sectionalizer.section_idx, section))
+
+    return sections
+
+
+def test_section_boundaries_match_list_scan():
+    rng = random.Random(0)
+    for _ in range(100):
+        n = rng.randint(50, 2000)
+        pattern, tags = _random_pattern(rng, n), _random_tags(rng, n)
+
+        for profile in (SCREEN_SECTION_PROFILE, FOG_SECTION_PROFILE):
+            expected = _sections(_ListSectionalizer, profile, pattern, tags)
+            assert _sections(Sectionalizer, profile, pattern, tags) == expected
+
+
+def test_section_buffer_detected_rows():
+    rng = random.Random(1)
+    buffer, reference = SectionBuffer(capacity=4), _ListSectionBuffer(capacity=4)
+    frame_no = 0
+    for _ in range(500):
+        if rng.random() < 0.1:
+            buffer.clear()
+            reference.clear()
+
+        frames = [(frame_no + i, 40.0 * (frame_no + i), None) for i in range(rng.randint(1, 8))]
+        results = [(0.0, 0.0, 1.0, 1.0, 0.9, 0.0) if rng.random() < 0.2 else None for _ in frames]
+        frame_no += len(frames)
+
+        buffer.extend(frames, results)
+        reference.extend(frames, results)
+
+        assert buffer.first_detected() == reference.first_detected()
+        assert buffer.last_detected() == reference.last_detected()
+
+
+def _stub_classifier_models(monkeypatch, broken):
+    '''
+    the frames are filled with their frame numbers, frames in broken are broken, no
+    screen has phosphor residue and no cone is separated
+    '''
+    def segment_broken(images, bs, counts_only=False, debug_size=None):
+        return [(5000 if int(image[0, 0, 0]) in broken else 0, np.zeros((debug_size, debug_size, 1), np.uint8))
+                for image in images]
+
+    def segment_cone(images, bs, counts_only=False, debug_size=None):
+        return [(0, np.zeros((debug_size, debug_size, 1), np.uint8)) for _ in images]
+
+    monkeypatch.setattr(utility.processer, 'segment_broken_with_batch', segment_broken)
+    monkeypatch.setattr(utility.processer, 'segment_cone_with_batch', segment_cone)
+    monkeypatch.setattr(utility.processer, 'classify_state_with_batch', lambda images, bs: [0.1 for _ in images])
+
+
+def test_confirmed_broken_section_skips_the_last_partial_section(monkeypatch):
+    n, partial = 200, 50
+    _stub_classifier_models(monkeypatch, broken=set(range(n - 40, n)))
+
+    answers = {}
+    classifier = Classifier(lambda frame_no, frame, bbox, phosphor_ans, broken_ans, cone_ans:
+                            answers.setdefault(frame_no, (phosphor_ans, broken_ans, cone_ans)))
+
+    frames = [(i, 40.0 * i, np.full((8, 8, 3), i, dtype=np.uint8), (0, 0, 4, 4, 0.9, 0)) for i in range(n)]
+    for start in range(0, n, partial):
+        classifier.push_partial_section(start + partial >= n, frames[start:start + partial])
+
+    assert classifier.classify()[4] == SECTION_CATEGORY.BROKEN
+    assert classifier.skipped == {'state_test': partial, 'segmentation': 18}
+    assert len(answers) == n
+
+    # 只有最后一部分工序跳过推理，跳过的帧没有荧光粉与锥屏分离的结果，而不是默认值
+    for frame_no, (phosphor_ans, broken_ans, cone_ans) in answers.items():
+        skipped = frame_no >= n - partial
+        assert (phosphor_ans is None) == skipped
+        assert cone_ans is None
+        assert broken_ans[1] == (5000 if frame_no >= n - 40 else 0)
+        assert broken_ans[0].shape == (128, 128, 1)
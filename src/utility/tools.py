@@ -11,6 +11,17 @@ def get_home_directory() -> Optional[str]:
         return None
 
 
+def file_key(filename: str) -> Optional[str]:
+    '''
+    identifies the content of a file by its absolute path, modification time and size
+    '''
+    if not os.path.isfile(filename):
+        return None
+
+    stat = os.stat(filename)
+    return f'{os.path.abspath(filename)}|{stat.st_mtime_ns}|{stat.st_size}'
+
+
 def index_of_first(array: List, func=None, key=None) -> Optional[int]:
     res = None
     for i, item in enumerate(array):
@@ -4,9 +4,18 @@ from typing import Callable, Optional, Tuple, Union
 import cv2
 from numpy import ndarray
 from os import path
+import json
 import math
+import os
+import threading
+import time
 import logging
 
+import utility.config
+from utility.tools import file_key
+from utility.video_backend import create_backend
+from utility.video_index import VideoIndex, load_video_index
+
 
 def parse_fourcc_number(n: Union[int, float]) -> str:
     n = int(n)
@@ -17,27 +26,120 @@ def parse_fourcc_number(n: Union[int, float]) -> str:
 
     return ''.join(fourcc)
 
+
+class VideoMetaCache:
+    '''
+    caches the probed metadata of videos in memory and in app_data, the key is
+    made of the absolute path, the modification time and the size of the file,
+    so a modified video is probed again. the entries of missing or modified files
+    are pruned when saving, and at most max_entries recent entries are kept
+    '''
+    def __init__(self, cache_file: str, max_entries: int = 1000) -> None:
+        self._cache_file = cache_file
+        self.max_entries = max_entries
+        self._entries: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if path.exists(self._cache_file):
+            try:
+                with open(self._cache_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                logging.warn(f'broken video meta cache {self._cache_file}, ignored')
+
+        return {}
+
+    def get(self, filename: str) -> Optional[dict]:
+        key = file_key(filename)
+        if key is None:
+            return None
+
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+
+            if key not in self._entries:
+                # other processes may have probed the video
+                self._entries.update(self._load())
+
+            return self._entries.get(key)
+
+    def put(self, filename: str, meta: dict) -> None:
+        key = file_key(filename)
+        if key is None:
+            return
+
+        with self._lock:
+            entries = self._load()
+            # 重新插入，使其成为最近的条目
+            entries.pop(key, None)
+            entries[key] = meta
+
+            entries = {k: v for k, v in entries.items() if file_key(k.rsplit('|', 2)[0]) == k}
+            entries = dict(list(entries.items())[-self.max_entries:])
+            self._entries = entries
+
+            tmp_file = f'{self._cache_file}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f, ensure_ascii=False, indent=4)
+                os.replace(tmp_file, self._cache_file)
+            except OSError:
+                logging.warn(f'can not save video meta cache {self._cache_file}')
+
+
+video_meta_cache = VideoMetaCache(utility.config.get_video_meta_file())
+
+
 """
 @see local: file:///C:/Users/ifuijx/Files/projects/TelevisionRecycling/codes/reference/4.4.0/d4/d15/group__videoio__flags__base.html#gaeb8dd9c89c10a5c63c139bf7c4f5704d
 """
 class Video:
-    def __init__(self, filename: str) -> None:
+    def __init__(self, filename: str, backend: Optional[str] = None, size: Optional[Tuple[int, int]] = None) -> None:
+        '''
+        backend is the name of the decode backend ('opencv' or 'pyav'), the one in the
+        config is used if it is None. if size (width, height) is given, the frames are
+        decoded to this size
+        '''
         self._filename = filename
-        self.cap = cv2.VideoCapture(self._filename)
+        self._backend_name = utility.config.get_decode_backend() if backend is None else backend
+        self.cap = create_backend(self._backend_name, self._filename, size, utility.config.get_decode_threads())
 
         assert self.cap is not None, f'can not read {self._filename}'
 
-        test_frames = 100
-
         self._has_exception = False
 
+        meta = video_meta_cache.get(self._filename)
+        if meta is None:
+            meta = self._probe()
+            video_meta_cache.put(self._filename, meta)
+
+        self._real_frame_interval = meta['frame_interval']
+
+        self._index: Optional[VideoIndex] = None
+        self._index_loaded = False
+
+    def _probe(self) -> dict:
+        '''
+        computes the real frame interval from the timestamps of the first frames,
+        the frames are only grabbed, not decoded. the frame count and fps are read
+        from the container header, so they are not cached
+        '''
+        test_frames = 100
+
         for _ in range(test_frames):
-            self.read()
+            self.grab()
 
-        self._real_frame_interval = self.pos_mesc() / test_frames
+        meta = {
+            'frame_interval': self.pos_mesc() / test_frames
+        }
 
+        self._has_exception = False
         self.seek_to_start()
 
+        return meta
+
     def __enter__(self) -> 'Video':
         return self
 
@@ -55,41 +157,47 @@ class Video:
         return self._filename
 
     def frame_width(self) -> int:
-        return int(self._query(cv2.CAP_PROP_FRAME_WIDTH))
+        return self.frame_size()[0]
 
     def frame_height(self) -> int:
-        return int(self._query(cv2.CAP_PROP_FRAME_HEIGHT))
+        return self.frame_size()[1]
 
     def frame_size(self) -> Tuple[int, int]:
         '''
-        (width, height)
+        (width, height) of the read frames
         '''
-        return self.frame_width(), self.frame_height()
+        return self.cap.frame_size()
+
+    def source_size(self) -> Tuple[int, int]:
+        '''
+        (width, height) of the encoded frames
+        '''
+        return self.cap.source_size()
 
     def fps(self) -> float:
-        return self._query(cv2.CAP_PROP_FPS)
+        return self.cap.fps()
 
     def computed_fps(self) -> float:
         return 1000 / self._real_frame_interval
 
     # the position in milliseconds
     def pos_mesc(self) -> float:
-        return self._query(cv2.CAP_PROP_POS_MSEC)
+        return self.cap.pos_mesc()
 
     def pos_frames(self) -> int:
-        return int(self._query(cv2.CAP_PROP_POS_FRAMES))
+        return self.cap.pos_frames()
 
     def pos_avi_ratio(self) -> float:
-        return self._query(cv2.CAP_PROP_POS_AVI_RATIO)
+        return self.cap.pos_avi_ratio()
 
     def frame_count(self) -> int:
-        return int(self._query(cv2.CAP_PROP_FRAME_COUNT))
+        return self.cap.frame_count()
 
     def backend_name(self) -> str:
-        return self.cap.getBackendName()
+        return self.cap.backend_name()
 
     def fourcc(self) -> int:
-        return int(self._query(cv2.CAP_PROP_FOURCC))
+        return self.cap.fourcc()
 
     def forucc_str(self) -> str:
         return parse_fourcc_number(self.fourcc())
@@ -98,7 +206,8 @@ class Video:
         assert self.pos_frames() <= pos
 
         while self.pos_frames() < pos:
-            self.read()
+            if not self.grab():
+                break
 
         assert self.pos_frames() == pos, f'{self._filename} can not advance to pos {pos}'
 
@@ -106,24 +215,46 @@ class Video:
         if self.pos_frames() == 0:
             return
 
-        self.close()
-        self.cap = cv2.VideoCapture(self._filename)
+        self.cap.reopen()
+        self._has_exception = False
+
+    def index(self) -> Optional[VideoIndex]:
+        '''
+        the frame/pts/keyframe index of the video, it is built at the first time and
+        saved in app_data, None if it can not be built (e.g. PyAV is not installed)
+        '''
+        if not self._index_loaded:
+            self._index = load_video_index(self._filename)
+            self._index_loaded = True
+
+        return self._index
 
     def seek_to(self, pos: int) -> None:
         '''
-        may be time-consuming
+        jumps to the nearest keyframe by the index and decodes forward, may be
+        time-consuming if there is no index and the backend is not seekable
         '''
+        if pos == self.pos_frames():
+            return
+
+        index = self.index()
+
+        if self.cap.seekable():
+            self.cap.seek(pos, None if index is None else index.pts_of(pos))
+            self._has_exception = False
+            return
+
+        if index is not None:
+            keyframe = index.keyframe_of(pos)
+            # 当前位置已在目标所在的 GOP 内时直接向前解码
+            if not keyframe <= self.pos_frames() <= pos and self.cap.seek_keyframe(keyframe):
+                self._has_exception = False
+
         if self.pos_frames() > pos:
             self.seek_to_start()
 
         self.advance_to(pos)
 
-    def _query(self, property: int) -> float:
-        return self.cap.get(property)
-
-    def _update(self, property: int, value) -> None:
-        self.cap.set(property, value)
-
     def read(self) -> Optional[ndarray]:
         if self._has_exception:
             return None
@@ -139,6 +270,24 @@ class Video:
         else:
             return frame
 
+    def grab(self) -> bool:
+        '''
+        advances to the next frame without decoding it into a BGR image,
+        returns False if there is no more frame
+        '''
+        if self._has_exception:
+            return False
+
+        if self.pos_frames() >= self.frame_count():
+            return False
+
+        ret = self.cap.grab()
+        if not ret and self.pos_frames() != self.frame_count():
+            logging.warn(f"{self._filename} stopped at frame {self.pos_frames()}, not {self.frame_count()}")
+            self._has_exception = True
+
+        return ret
+
     def info(self) -> str:
         d = {
             'filename': path.split(self._filename)[1],
@@ -198,6 +347,9 @@ class VideoProxy:
         '''
         return self._video.frame_size()
 
+    def source_size(self) -> Tuple[int, int]:
+        return self._video.source_size()
+
     def fps(self) -> float:
         return self._video.fps()
 
@@ -238,13 +390,174 @@ class VideoProxy:
         '''
         self._video.seek_to(pos)
 
+    def index(self) -> Optional[VideoIndex]:
+        return self._video.index()
+
     def read(self) -> ndarray:
         return self._video.read()
 
+    def grab(self) -> bool:
+        return self._video.grab()
+
     def info(self) -> str:
         return self._video.info()
 
 
+# 直播流无法事先探测帧间隔时使用的帧率
+LIVE_DEFAULT_FPS = 25
+LIVE_SEGMENT_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.ts', '.flv')
+
+
+class LiveVideo:
+    '''
+    a video which is still being recorded: a stream (e.g. rtsp://...) or a directory
+    into which the recorder writes segment files. the frames are read in order until
+    the stream ends or no new frame arrives within idle_timeout seconds, there is no
+    frame count and no seeking. a segment is read when a later segment appears (the
+    recorder has finished it), the last one is read when the recorder stops
+    '''
+    def __init__(self, source: str, backend: Optional[str] = None, size: Optional[Tuple[int, int]] = None,
+                 idle_timeout: Optional[float] = None, poll_interval: float = 1.0) -> None:
+        self._source = source
+        self._backend_name = utility.config.get_decode_backend() if backend is None else backend
+        self._size = size
+        self._idle_timeout = utility.config.get_live_idle_timeout() if idle_timeout is None else idle_timeout
+        self._poll_interval = poll_interval
+
+        self._is_segmented = path.isdir(self._source)
+        # 本地文件读完即结束，只有直播流断开后才重连
+        self._can_reconnect = not self._is_segmented and not path.isfile(self._source)
+        self._segments = []
+        self._segment_idx = -1
+
+        self.cap = None
+        self._pos = 0
+        self._ended = False
+        self._opened = False
+        # 重连直播流时已取出一帧
+        self._pending_grab = False
+
+        assert self._open_next(), f'can not read {self._source}'
+
+        fps = self.cap.fps()
+        self._fps = fps if 0 < fps <= 240 else LIVE_DEFAULT_FPS
+
+    def __enter__(self) -> 'LiveVideo':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+    def _list_segments(self) -> list:
+        names = sorted(name for name in os.listdir(self._source)
+                       if path.splitext(name)[1].lower() in LIVE_SEGMENT_EXTENSIONS)
+        return [path.join(self._source, name) for name in names]
+
+    def _open_next(self) -> bool:
+        '''
+        opens the next segment (or reconnects the stream), waits at most idle_timeout
+        seconds for it
+        '''
+        self.close()
+
+        if self._opened and not self._is_segmented and not self._can_reconnect:
+            return False
+
+        deadline = time.time() + self._idle_timeout
+        while True:
+            if self._is_segmented:
+                self._segments = self._list_segments()
+                next_idx = self._segment_idx + 1
+
+                # 后面已有新片段说明该片段已录制完成；超时则认为录制结束，读取最后一个片段
+                if next_idx + 1 < len(self._segments) or (next_idx < len(self._segments) and time.time() >= deadline):
+                    self._segment_idx = next_idx
+                    self.cap = create_backend(self._backend_name, self._segments[next_idx], self._size,
+                                              utility.config.get_decode_threads())
+                    return True
+            else:
+                cap = create_backend(self._backend_name, self._source, self._size, utility.config.get_decode_threads())
+                if cap.grab():
+                    self.cap = cap
+                    self._opened = True
+                    self._pending_grab = True
+                    return True
+                cap.release()
+
+            if time.time() >= deadline:
+                return False
+
+            time.sleep(self._poll_interval)
+
+    def filename(self) -> str:
+        return self._source
+
+    def frame_width(self) -> int:
+        return self.frame_size()[0]
+
+    def frame_height(self) -> int:
+        return self.frame_size()[1]
+
+    def frame_size(self) -> Tuple[int, int]:
+        return self.cap.frame_size()
+
+    def source_size(self) -> Tuple[int, int]:
+        return self.cap.source_size()
+
+    def fps(self) -> float:
+        return self._fps
+
+    def computed_fps(self) -> float:
+        return self._fps
+
+    def pos_frames(self) -> int:
+        return self._pos
+
+    def pos_mesc(self) -> float:
+        return 1000 * self._pos / self._fps
+
+    def frame_count(self) -> int:
+        '''
+        unknown until the recording ends
+        '''
+        return 0
+
+    def backend_name(self) -> str:
+        return self.cap.backend_name()
+
+    def grab(self) -> bool:
+        if self._ended:
+            return False
+
+        while True:
+            if self.cap is not None:
+                if self._pending_grab:
+                    self._pending_grab = False
+                    self._pos += 1
+                    return True
+
+                if self.cap.grab():
+                    self._pos += 1
+                    return True
+
+            if not self._open_next():
+                logging.info(f'{self._source} ended at frame {self._pos}')
+                self._ended = True
+                self.close()
+                return False
+
+    def read(self) -> Optional[ndarray]:
+        if not self.grab():
+            return None
+
+        return self.cap.retrieve()
+
+
 class VideoWriter:
     AVI_YUV_LOSSLESS = cv2.VideoWriter_fourcc('I', '4', '2', '0')
     AVI_MPEG_1 = cv2.VideoWriter_fourcc('P', 'I', 'M', 'I')
@@ -331,11 +644,31 @@ class VideoSegmentTraveler:
     def _is_ratio_segment(self) -> bool:
         return self._seg_type == VideoSegmentTraveler.RATIO_SEGMENT
 
+    def _start_frame(self) -> int:
+        '''
+        a frame not later than the start of the range
+        '''
+        if self._is_frame_segment():
+            return int(self._start)
+
+        if self._is_mesc_segment():
+            index = self._video.index()
+            if index is not None:
+                return max(index.frame_at_msec(self._start) - 1, 0)
+            return max(int(self._start * self._video.computed_fps() / 1000) - 1, 0)
+
+        return max(int(self._start * self._video.frame_count()) - 1, 0)
+
     def run(self, handler: Callable[[Video, Tuple[int, float, float], ndarray, int, int], None]) -> None:
         '''
         call handler(video, (frame_pos, mesc_pos, ratio_pos), frame, idx, total_frames) every time find 
         frame in the specified range
         '''
+        # 直接跳到范围起点附近，而不是从当前位置逐帧读取
+        start_frame = self._start_frame()
+        if start_frame > self._video.pos_frames():
+            self._video.seek_to(start_frame)
+
         entered = False
         computed_frame_count :int = None
         idx = 0
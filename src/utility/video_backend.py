@@ -0,0 +1,317 @@
+from abc import ABC, abstractmethod
+import logging
+from typing import Optional, Tuple
+import cv2
+from numpy import ndarray
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+class DecodeBackend(ABC):
+    '''
+    the decoder used by Video. a backend decodes frames sequentially, grab() advances
+    to the next frame and retrieve() converts the grabbed frame to a BGR image. if
+    size (width, height) is given, the frames are decoded straight to this size.
+    seek() is only needed by the backends whose seekable() is True
+    '''
+    def __init__(self, filename: str, size: Optional[Tuple[int, int]] = None, threads: int = 0) -> None:
+        self._filename = filename
+        self._size = size
+        self._threads = threads
+
+    @abstractmethod
+    def reopen(self) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def release(self) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def grab(self) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieve(self) -> Optional[ndarray]:
+        raise NotImplementedError
+
+    def read(self) -> Tuple[bool, Optional[ndarray]]:
+        if not self.grab():
+            return False, None
+
+        return True, self.retrieve()
+
+    def seekable(self) -> bool:
+        '''
+        whether seek() jumps to a frame without decoding from the start
+        '''
+        return False
+
+    def seek(self, pos: int, pts: Optional[int] = None) -> None:
+        '''
+        the next grabbed frame will be the frame at pos, the pts of the frame can be
+        given if it is known (e.g. from an index)
+        '''
+        raise NotImplementedError
+
+    def seek_keyframe(self, pos: int) -> bool:
+        '''
+        jumps to the keyframe at pos, returns False if it is not supported
+        '''
+        return False
+
+    @abstractmethod
+    def source_size(self) -> Tuple[int, int]:
+        '''
+        (width, height) of the encoded frames
+        '''
+        raise NotImplementedError
+
+    def frame_size(self) -> Tuple[int, int]:
+        '''
+        (width, height) of the retrieved frames
+        '''
+        return self._size if self._size is not None else self.source_size()
+
+    @abstractmethod
+    def fps(self) -> float:
+        raise NotImplementedError
+
+    @abstractmethod
+    def frame_count(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def pos_frames(self) -> int:
+        '''
+        the index of the next frame
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def pos_mesc(self) -> float:
+        '''
+        the timestamp of the last grabbed frame in milliseconds
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def pos_avi_ratio(self) -> float:
+        raise NotImplementedError
+
+    @abstractmethod
+    def fourcc(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def backend_name(self) -> str:
+        raise NotImplementedError
+
+
+class OpenCVBackend(DecodeBackend):
+    '''
+    cv2.VideoCapture, seeking is done by decoding linearly unless the keyframe
+    of the target is known (see VideoIndex)
+    '''
+    def __init__(self, filename: str, size: Optional[Tuple[int, int]] = None, threads: int = 0) -> None:
+        super().__init__(filename, size, threads)
+        self.cap = cv2.VideoCapture(self._filename)
+
+    def reopen(self) -> None:
+        self.release()
+        self.cap = cv2.VideoCapture(self._filename)
+
+    def release(self) -> None:
+        self.cap.release()
+
+    def grab(self) -> bool:
+        return self.cap.grab()
+
+    def retrieve(self) -> Optional[ndarray]:
+        ret, frame = self.cap.retrieve()
+        if not ret:
+            return None
+
+        if self._size is not None:
+            frame = cv2.resize(frame, self._size, interpolation=cv2.INTER_AREA)
+
+        return frame
+
+    def seek_keyframe(self, pos: int) -> bool:
+        # 仅在目标是关键帧时可靠
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, pos)
+        return self.pos_frames() == pos
+
+    def source_size(self) -> Tuple[int, int]:
+        return int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def fps(self) -> float:
+        return self.cap.get(cv2.CAP_PROP_FPS)
+
+    def frame_count(self) -> int:
+        return int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def pos_frames(self) -> int:
+        return int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    def pos_mesc(self) -> float:
+        return self.cap.get(cv2.CAP_PROP_POS_MSEC)
+
+    def pos_avi_ratio(self) -> float:
+        return self.cap.get(cv2.CAP_PROP_POS_AVI_RATIO)
+
+    def fourcc(self) -> int:
+        return int(self.cap.get(cv2.CAP_PROP_FOURCC))
+
+    def backend_name(self) -> str:
+        return self.cap.getBackendName()
+
+
+class PyAVBackend(DecodeBackend):
+    '''
+    FFmpeg through PyAV, supports keyframe seeking, threaded decoding and scaling
+    in the decoder (libswscale) instead of after the BGR conversion
+    '''
+    def __init__(self, filename: str, size: Optional[Tuple[int, int]] = None, threads: int = 0) -> None:
+        assert av is not None, 'PyAV is not installed'
+
+        super().__init__(filename, size, threads)
+        self._open()
+
+    def _open(self) -> None:
+        self.container = av.open(self._filename)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'
+        self.stream.thread_count = self._threads
+
+        self._time_base = float(self.stream.time_base)
+        self._start_pts = self.stream.start_time or 0
+        self._fps = float(self.stream.average_rate or self.stream.guessed_rate or 0)
+
+        self._frames = self.container.decode(self.stream)
+        # 已取出但尚未返回的帧（seek 时会多解码一帧）
+        self._pending = None
+        self._grabbed = None
+        self._pos = 0
+
+    def reopen(self) -> None:
+        self.release()
+        self._open()
+
+    def release(self) -> None:
+        self.container.close()
+
+    def _next_frame(self):
+        if self._pending is not None:
+            frame, self._pending = self._pending, None
+            return frame
+
+        try:
+            return next(self._frames)
+        except (StopIteration, av.error.EOFError):
+            return None
+
+    def grab(self) -> bool:
+        frame = self._next_frame()
+        if frame is None:
+            return False
+
+        self._grabbed = frame
+        self._pos += 1
+        return True
+
+    def retrieve(self) -> Optional[ndarray]:
+        if self._grabbed is None:
+            return None
+
+        if self._size is not None:
+            width, height = self._size
+            return self._grabbed.to_ndarray(format='bgr24', width=width, height=height)
+
+        return self._grabbed.to_ndarray(format='bgr24')
+
+    def seekable(self) -> bool:
+        return self._fps > 0
+
+    def pts_of(self, pos: int) -> int:
+        return self._start_pts + int(round(pos / self._fps / self._time_base))
+
+    def seek(self, pos: int, pts: Optional[int] = None) -> None:
+        '''
+        seeks to the nearest keyframe before pos and decodes forward to pos
+        '''
+        target_pts = self.pts_of(pos) if pts is None else pts
+
+        self.container.seek(target_pts, stream=self.stream, backward=True, any_frame=False)
+        self._frames = self.container.decode(self.stream)
+        self._pending = None
+        self._grabbed = None
+
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                break
+
+            if frame.pts is not None and frame.pts >= target_pts:
+                self._pending = frame
+                break
+
+            self._grabbed = frame
+
+        self._pos = pos
+
+    def source_size(self) -> Tuple[int, int]:
+        return self.stream.codec_context.width, self.stream.codec_context.height
+
+    def fps(self) -> float:
+        return self._fps
+
+    def frame_count(self) -> int:
+        if self.stream.frames > 0:
+            return self.stream.frames
+
+        if self.stream.duration is not None:
+            return int(round(self.stream.duration * self._time_base * self._fps))
+
+        return 0
+
+    def pos_frames(self) -> int:
+        return self._pos
+
+    def pos_mesc(self) -> float:
+        if self._grabbed is None or self._grabbed.pts is None:
+            return 0.0
+
+        return (self._grabbed.pts - self._start_pts) * self._time_base * 1000
+
+    def pos_avi_ratio(self) -> float:
+        frame_count = self.frame_count()
+        return self._pos / frame_count if frame_count > 0 else 0.0
+
+    def fourcc(self) -> int:
+        tag = self.stream.codec_context.codec_tag or ''
+        tag = (tag + '\0' * 4)[:4]
+        return sum(ord(c) << (8 * i) for i, c in enumerate(tag))
+
+    def backend_name(self) -> str:
+        return 'PyAV'
+
+
+BACKENDS = {
+    'opencv': OpenCVBackend,
+    'pyav': PyAVBackend
+}
+
+
+def create_backend(name: str, filename: str, size: Optional[Tuple[int, int]] = None,
+                   threads: int = 0) -> DecodeBackend:
+    if name == 'pyav' and av is None:
+        logging.warn('PyAV is not installed, fall back to the opencv decode backend')
+        name = 'opencv'
+
+    assert name in BACKENDS, f'unknown decode backend {name}'
+
+    return BACKENDS[name](filename, size, threads)
@@ -0,0 +1,138 @@
+import hashlib
+import logging
+from os import path
+from typing import Dict, Optional
+import numpy as np
+
+import utility.config
+from utility.tools import file_key
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+class VideoIndex:
+    '''
+    maps frame number <-> pts <-> nearest keyframe (its frame number and byte offset),
+    all arrays are indexed by the frame number in presentation order
+    '''
+    def __init__(self, pts: np.ndarray, keyframe_no: np.ndarray, keyframe_offset: np.ndarray,
+                 time_base: float, start_pts: int) -> None:
+        self.pts = pts
+        self.keyframe_no = keyframe_no
+        self.keyframe_offset = keyframe_offset
+        self.time_base = time_base
+        self.start_pts = start_pts
+
+    @staticmethod
+    def build(filename: str) -> Optional['VideoIndex']:
+        '''
+        demuxes the video without decoding, returns None if PyAV is not installed
+        '''
+        if av is None:
+            return None
+
+        items = []
+        with av.open(filename) as container:
+            stream = container.streams.video[0]
+            time_base = float(stream.time_base)
+            start_pts = stream.start_time or 0
+
+            for packet in container.demux(stream):
+                # 最后的空包用于冲刷解码器
+                if packet.pts is None:
+                    continue
+                items.append((packet.pts, packet.is_keyframe, -1 if packet.pos is None else packet.pos))
+
+        items.sort(key=lambda item: item[0])
+
+        pts = np.array([item[0] for item in items], dtype=np.int64)
+        keyframe_no = np.zeros(len(items), dtype=np.int64)
+        keyframe_offset = np.zeros(len(items), dtype=np.int64)
+
+        last_keyframe, last_offset = 0, items[0][2] if items else -1
+        for i, (_, is_keyframe, offset) in enumerate(items):
+            if is_keyframe:
+                last_keyframe, last_offset = i, offset
+            keyframe_no[i] = last_keyframe
+            keyframe_offset[i] = last_offset
+
+        return VideoIndex(pts, keyframe_no, keyframe_offset, time_base, start_pts)
+
+    @staticmethod
+    def load(index_file: str) -> 'VideoIndex':
+        data = np.load(index_file)
+        return VideoIndex(data['pts'], data['keyframe_no'], data['keyframe_offset'],
+                          float(data['time_base']), int(data['start_pts']))
+
+    def save(self, index_file: str) -> None:
+        with open(index_file, 'wb') as f:
+            np.savez(f, pts=self.pts, keyframe_no=self.keyframe_no, keyframe_offset=self.keyframe_offset,
+                     time_base=self.time_base, start_pts=self.start_pts)
+
+    def frame_count(self) -> int:
+        return len(self.pts)
+
+    def pts_of(self, pos: int) -> Optional[int]:
+        if not 0 <= pos < len(self.pts):
+            return None
+
+        return int(self.pts[pos])
+
+    def msec_of(self, pos: int) -> Optional[float]:
+        pts = self.pts_of(pos)
+        if pts is None:
+            return None
+
+        return (pts - self.start_pts) * self.time_base * 1000
+
+    def frame_at_msec(self, msec: float) -> int:
+        '''
+        the first frame whose timestamp is not earlier than msec
+        '''
+        pts = self.start_pts + msec / 1000 / self.time_base
+        return int(np.searchsorted(self.pts, pts - 0.5))
+
+    def keyframe_of(self, pos: int) -> int:
+        return int(self.keyframe_no[min(max(pos, 0), len(self.keyframe_no) - 1)])
+
+    def keyframe_offset_of(self, pos: int) -> int:
+        return int(self.keyframe_offset[min(max(pos, 0), len(self.keyframe_offset) - 1)])
+
+
+_loaded_indexes: Dict[str, Optional[VideoIndex]] = {}
+
+
+def load_video_index(filename: str) -> Optional[VideoIndex]:
+    '''
+    loads the index of the video from app_data, builds and saves it at the first time
+    '''
+    key = file_key(filename)
+    if key is None:
+        return None
+
+    if key in _loaded_indexes:
+        return _loaded_indexes[key]
+
+    index_file = path.join(utility.config.get_video_index_dir(),
+                           hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+
+    index = None
+    if path.exists(index_file):
+        try:
+            index = VideoIndex.load(index_file)
+        except (OSError, ValueError, KeyError):
+            logging.warn(f'broken video index {index_file}, rebuild it')
+
+    if index is None:
+        index = VideoIndex.build(filename)
+        if index is not None and index.frame_count() > 0:
+            index.save(index_file)
+        else:
+            index = None
+
+    _loaded_indexes[key] = index
+
+    return index